@@ -52,6 +52,7 @@ resource_modules_lowercase = True          # whether all resource paths (i.e. mo
 camelcase_classes = True                   # whether class name generation should use CamelCase
 camelcase_enums = True                     # whether names for enums should be camelCased
 backbone_class_adds_parent = True          # if True, backbone class names prepend their parent's class name
+compact_instances = False                  # if True, generated classes use `__slots__` and only store properties that are set
 
 # All these files should be copied to `tpl_resource_target`: tuples of (path/to/file, module, array-of-class-names)
 # If the path is None, no file will be copied but the class names will still be recognized and it is assumed the class is present.
@@ -70,4 +71,9 @@ manual_profiles = [
     ('Sample/fhirinstant.py', 'fhirinstant', ['instant']),
     ('Sample/fhirtime.py', 'fhirtime', ['time']),
     ('Sample/_dateutils.py', '_dateutils', []),
+    ('Sample/fhirbulk.py', 'fhirbulk', []),
+    ('Sample/fhirreadcache.py', 'fhirreadcache', []),
+    ('Sample/fhirintern.py', 'fhirintern', []),
+    ('Sample/fhircolumns.py', 'fhircolumns', []),
+    ('Sample/fhirtracking.py', 'fhirtracking', []),
 ]
@@ -2,20 +2,56 @@
 # 2014-2024, SMART Health IT.
 
 import datetime
-from typing import Union
+import re
+from typing import Iterable, Pattern, Tuple, Union
+
+
+_unparsed = object()
+
+def _compile_spec_regex(pattern: str) -> Pattern:
+    """
+    Compiles a regex pulled from the spec with its groups made non-capturing.
+
+    We only ever check whether values match, and without captures matching is considerably faster.
+    """
+    return re.compile(re.sub(r"(?<!\\)\((?!\?)", "(?:", pattern))
+
+
+# NumPy datetime64 and timedelta64 values are integers counting units since 1970-01-01, or since
+# midnight for our times, with the smallest integer meaning NaT
+_NAT = -2 ** 63
+_EPOCH = datetime.datetime(1970, 1, 1)
+_EPOCH_UTC = _EPOCH.replace(tzinfo=datetime.timezone.utc)
+_EPOCH_ORDINAL = _EPOCH.toordinal()
+_MICROSECOND = datetime.timedelta(microseconds=1)
+_NUMPY_DTYPES = {'date': 'datetime64[D]', 'datetime': 'datetime64[us]', 'time': 'timedelta64[us]'}
 
 
 class _FHIRDateTimeMixin:
     """
     Private mixin to provide helper methods for our date and time classes.
 
-    Users of this mixin need to provide _REGEX and _FIELD properties and a from_string() method.
+    Users of this mixin need to provide _REGEX and _FIELD properties, a from_string() method
+    and a property named like _FIELD, created with `_value_property()`. The original string
+    and the value are kept in the two slots declared here; instances still have a `__dict__`,
+    which is only allocated when other attributes are set on them.
+
+    Values are validated against _REGEX when an instance is created. With `lazy_parsing` set
+    on a class, parsing them into Python objects is deferred until they are first accessed;
+    strings that match the format but don't name a valid date (like "2023-02-31") then only
+    raise when accessed.
     """
 
+    __slots__ = ('_value', '_orig_json')
+
+    lazy_parsing: bool = False
+
+    intern_table = None  # an `FHIRInternTable` sharing strings and parsed values, see `interning()`
+
     def __init__(self, jsonval: Union[str, None] = None):
         super().__init__()
 
-        setattr(self, self._FIELD, None)
+        self._value = None
 
         if jsonval is not None:
             if not isinstance(jsonval, str):
@@ -23,14 +59,47 @@ class _FHIRDateTimeMixin:
                     .format(type(self), type(jsonval)))
             if not self._REGEX.fullmatch(jsonval):
                 raise ValueError("does not match expected format")
-            setattr(self, self._FIELD, self._from_string(jsonval))
+            table = self.intern_table
+            if table is not None:
+                jsonval = table.intern(jsonval)
+            if self.lazy_parsing:
+                self._value = _unparsed
+            elif table is not None:
+                self._value = table.parsed(type(self), jsonval)
+            else:
+                self._value = self._from_string(jsonval)
 
         self._orig_json: Union[str, None] = jsonval
 
-    def __setattr__(self, prop, value):
-        if self._FIELD == prop:
+    @staticmethod
+    def _value_property(doc: str) -> property:
+        """Creates the property holding the Python representation, parsing it on first access."""
+        def get_value(self):
+            value = self._value
+            if value is _unparsed:
+                value = self._value = self._from_string(self._orig_json)
+            return value
+
+        def set_value(self, value):
+            self._value = value
             self._orig_json = None
-        object.__setattr__(self, prop, value)
+
+        return property(get_value, set_value, doc=doc)
+
+    def __getstate__(self):
+        unparsed = self._value is _unparsed
+        return (self._orig_json, None if unparsed else self._value, unparsed, getattr(self, '__dict__', None) or None)
+
+    def __setstate__(self, state):
+        if isinstance(state, dict):
+            # pickled before values moved to slots, with all attributes in `__dict__`
+            state = dict(state)
+            state = (state.pop('_orig_json', None), state.pop(self._FIELD, None), False, state)
+        self._orig_json, self._value, unparsed, attributes = state
+        if unparsed:
+            self._value = _unparsed
+        if attributes:
+            self.__dict__.update(attributes)
 
     @property
     def isostring(self) -> Union[str, None]:
@@ -72,6 +141,57 @@ class _FHIRDateTimeMixin:
         """
         return cls.with_json(jsonobj)
 
+    @classmethod
+    def parse_many(cls, values: Iterable[Union[str, None]], as_numpy: bool = False) -> Tuple[list, list]:
+        """
+        Parses many FHIR JSON strings at once, into what the property named like _FIELD would
+        hold for each of them, without creating instances.
+
+        Values that aren't strings, don't match the expected format or are out of range give
+        None and are marked False in the returned validity mask. Each distinct string is
+        parsed once, so columns with repeated values are cheap.
+
+        With `as_numpy`, NumPy arrays are returned instead of lists: datetime64[D] for dates,
+        datetime64[us] for datetimes and timedelta64[us] since midnight for times, with NaT
+        for invalid values. NumPy has no timezones, so aware datetimes are converted to UTC;
+        naive ones are kept as they are.
+
+        :param values: An iterable of strings, or None for missing values
+        :param as_numpy: Whether to return NumPy arrays; needs NumPy to be installed
+        :returns: A tuple of the parsed values and the validity mask
+        """
+        match = cls._REGEX.fullmatch
+        from_string = cls._from_string
+        missing = _NAT if as_numpy else None
+        seen = {}
+        parsed = []
+        valid = []
+        for value in values:
+            if value.__class__ is not str:
+                parsed.append(missing)
+                valid.append(False)
+                continue
+            result = seen.get(value, _unparsed)
+            if result is _unparsed:
+                result = missing
+                if match(value):
+                    try:
+                        result = from_string(value)
+                    except ValueError:
+                        pass
+                    else:
+                        if as_numpy:
+                            result = _numpy_value(result)
+                seen[value] = result
+            parsed.append(result)
+            valid.append(result is not missing)
+
+        if as_numpy:
+            import numpy
+            return (numpy.array(parsed, dtype=numpy.int64).view(_NUMPY_DTYPES[cls._FIELD]),
+                    numpy.array(valid, dtype=bool))
+        return parsed, valid
+
     @staticmethod
     def _strip_leap_seconds(value: str) -> str:
         """
@@ -121,3 +241,13 @@ class _FHIRDateTimeMixin:
     def _parse_time(cls, value: str) -> datetime.time:
         value = cls._strip_leap_seconds(value)
         return datetime.time.fromisoformat(value)
+
+
+def _numpy_value(value) -> int:
+    """Converts a parsed value to the integer NumPy stores for it as datetime64 or timedelta64."""
+    if isinstance(value, datetime.datetime):
+        epoch = _EPOCH if value.tzinfo is None else _EPOCH_UTC
+        return (value - epoch) // _MICROSECOND
+    if isinstance(value, datetime.date):
+        return value.toordinal() - _EPOCH_ORDINAL
+    return ((value.hour * 60 + value.minute) * 60 + value.second) * 1000000 + value.microsecond
@@ -4,8 +4,12 @@
 #  Base class for all FHIR elements.
 
 import sys
+import json
+import struct
 import logging
 
+from json.encoder import encode_basestring as _encode_str, encode_basestring_ascii as _encode_str_ascii
+
 
 class FHIRValidationError(Exception):
     """ Exception raised when one or more errors occurred during model
@@ -38,19 +42,587 @@ class FHIRValidationError(Exception):
         applied. """
         path = '{}.{}'.format(path_prefix, self.path) if self.path is not None else path_prefix
         return self.__class__(self.errors, path)
+    
+    def __reduce__(self):
+        """ Pickles errors and path rather than the formatted message, so
+        errors can be passed between processes. """
+        return (self.__class__, (self.errors, self.path))
+
+
+class FHIRElementTable(object):
+    """ Per-class description of an element's properties, derived once from
+    `elementProperties()` and shared by all instances of the class.
+    """
+    
+    def __init__(self, properties):
+        """ Initializer.
+        
+        :param properties: An iterable of ("name", "json_name", type, is_list,
+            "of_many", not_optional) tuples, as returned by `elementProperties()`
+        """
+        self.properties = tuple(tuple(prop) for prop in properties)
+        """ The property tuples, in declaration order. """
+        
+        self.by_name = {}
+        """ Maps Python property names to their property tuple. """
+        
+        self.by_jsname = {}
+        """ Maps JSON property names to their property tuple. """
+        
+        self.of_many = {}
+        """ Maps "of_many" names (`value[x]`) to a tuple of the JSON names of
+        all their expansions. """
+        
+        self.readers = {}
+        """ Maps JSON property names to precomputed ("name", factory, is_list,
+        type_check, "found_name") tuples, used by `update_with_json()`. """
+        
+        self.trusted_readers = {}
+        """ Maps JSON property names to ("name", element_class, factory)
+        tuples, used by `update_with_json()` for trusted data. """
+        
+        self.binary_fields = []
+        """ ("name", type, is_list, is_element, is_date) tuples, indexed by
+        the field numbers `as_binary()` uses. """
+        
+        self.writers = []
+        """ Precomputed ("name", '"json_name"', type, is_list, type_check,
+        "found_name") tuples, in declaration order, used by `write_json()`. """
+        
+        valid = set(['resourceType'])
+        nonoptionals = set()
+        for prop in self.properties:
+            name, jsname, typ, is_list, of_many, not_optional = prop
+            self.by_name[name] = prop
+            self.by_jsname[jsname] = prop
+            factory = getattr(typ, 'with_json_and_owner', None)
+            type_check = (int, float) if typ in (int, float) else typ
+            self.readers[jsname] = (name, factory, is_list, type_check, of_many or jsname)
+            is_element = isinstance(typ, type) and issubclass(typ, FHIRAbstractBase)
+            self.trusted_readers[jsname] = (name, typ if is_element else None, None if is_element else factory)
+            self.writers.append((name, '"'+jsname+'"', typ, is_list, type_check, of_many or jsname))
+            self.binary_fields.append((name, typ, is_list, is_element, factory is not None and not is_element))
+            valid.add(jsname)
+            if of_many is not None:
+                valid.add(of_many)
+                self.of_many[of_many] = self.of_many.get(of_many, ()) + (jsname,)
+            if not_optional:
+                nonoptionals.add(of_many or jsname)
+        
+        self.valid_keys = frozenset(valid)
+        """ JSON keys accepted in data for this element, except for `_name`
+        keys carrying primitive extensions. """
+        
+        self.nonoptionals = frozenset(nonoptionals)
+        """ JSON names (or "of_many" names) that must have a value. """
+        
+        self.writers = tuple(self.writers)
+        self.binary_fields = tuple(self.binary_fields)
+        self.extension_keys = frozenset('_'+jsname for jsname in self.by_jsname)
+        """ The `_name` keys that may carry primitive extensions. """
+        
+        self._projections = {}
+    
+    def projection(self, elements, resource_type=None):
+        """ Resolves element paths, like those of FHIR's `_elements` search
+        parameter, against the receiver's properties. Paths are dotted JSON
+        names, may start with the resource type and may use "of_many" names
+        (`value` or `value[x]`) to select all their expansions. Paths that
+        don't match any property are ignored.
+        
+        :param frozenset elements: The element paths to resolve
+        :param str resource_type: The resource type paths may start with
+        :returns: A tuple of (property tuple, sub-paths) tuples, in declaration
+            order; sub-paths are a frozenset or None to select all children
+        """
+        projection = self._projections.get(elements)
+        if projection is None:
+            subpaths = {}
+            for path in elements:
+                head, _, rest = path.partition('.')
+                if head == resource_type and rest:
+                    head, _, rest = rest.partition('.')
+                head = head.replace('[x]', '')
+                jsnames = self.of_many.get(head) or ((head,) if head in self.by_jsname else ())
+                for jsname in jsnames:
+                    if not rest:
+                        subpaths[jsname] = None
+                    elif subpaths.get(jsname, ()) is not None:
+                        subpaths.setdefault(jsname, set()).add(rest)
+            
+            projection = tuple((prop, frozenset(subpaths[prop[1]]) if subpaths[prop[1]] is not None else None)
+                for prop in self.properties if prop[1] in subpaths)
+            self._projections[elements] = projection
+        return projection
+
+
+class FHIRJSONWriter(object):
+    """ Writes JSON text to a file-like object, piece by piece, as elements
+    are serialized by `FHIRAbstractBase.write_json()`. Pieces are buffered
+    and handed to the file in batches.
+    """
+    
+    buffer_size = 4096
+    """ Number of pieces to collect before writing them to the file. """
+    
+    def __init__(self, fp, separators=None, ensure_ascii=True):
+        """ Initializer.
+        
+        :param fp: A file-like object with a `write()` method accepting str
+        :param separators: An `(item_separator, key_separator)` tuple, as for
+            `json.dump()`
+        :param bool ensure_ascii: Whether to escape non-ASCII characters
+        """
+        self.fp = fp
+        self.parts = []
+        self.encode = json.JSONEncoder(ensure_ascii=ensure_ascii, separators=separators).encode
+        self.encode_str = _encode_str_ascii if ensure_ascii else _encode_str
+        self.item_separator, self.key_separator = separators or (', ', ': ')
+    
+    def write_value(self, value):
+        """ Writes an element, a date or a JSON value. """
+        if isinstance(value, FHIRAbstractBase):
+            value._write_json(self)
+        elif hasattr(value, 'as_json'):
+            self.parts.append(self.encode(value.as_json()))
+        else:
+            self.parts.append(self.encode(value))
+    
+    def flush(self):
+        """ Writes all buffered pieces to the file. """
+        if self.parts:
+            self.fp.writelines(self.parts)
+            del self.parts[:]
+
+
+# MARK: Binary Format
+#
+# `as_binary()` writes MessagePack: elements are maps from field numbers,
+# their properties' positions in `elementProperties()`, to values, and dates
+# and times are their original strings. Elements whose type differs from the
+# declared one, and the outermost element, are preceded by the otherwise unused
+# byte 0xc1 and their resource type.
+
+_pack_tag8 = struct.Struct('>BB').pack
+_pack_tag16 = struct.Struct('>BH').pack
+_pack_tag32 = struct.Struct('>BI').pack
+_pack_int32 = struct.Struct('>Bi').pack
+_pack_int64 = struct.Struct('>Bq').pack
+_pack_uint64 = struct.Struct('>BQ').pack
+_pack_float = struct.Struct('>Bd').pack
+_unpack_uint8 = struct.Struct('>B').unpack_from
+_unpack_uint16 = struct.Struct('>H').unpack_from
+_unpack_uint32 = struct.Struct('>I').unpack_from
+_unpack_int8 = struct.Struct('>b').unpack_from
+_unpack_int16 = struct.Struct('>h').unpack_from
+_unpack_int32 = struct.Struct('>i').unpack_from
+_unpack_int64 = struct.Struct('>q').unpack_from
+_unpack_uint64 = struct.Struct('>Q').unpack_from
+_unpack_float32 = struct.Struct('>f').unpack_from
+_unpack_float64 = struct.Struct('>d').unpack_from
+
+_TYPED = 0xc1
+
+
+def _pack_header(out, length, fix, fix_limit, tag16):
+    """ Writes the header of a map (fix 0x80), array (0x90) or string (0xa0)
+    of the given length.
+    """
+    if length < fix_limit:
+        out.append(fix | length)
+    elif tag16 == 0xda and length < 0x100:
+        out += _pack_tag8(0xd9, length)
+    elif length < 0x10000:
+        out += _pack_tag16(tag16, length)
+    else:
+        out += _pack_tag32(tag16 + 1, length)
+
+
+def _pack_value(out, value):
+    """ Writes a JSON primitive value. """
+    cls = value.__class__
+    if cls is str:
+        data = value.encode('utf-8')
+        _pack_header(out, len(data), 0xa0, 32, 0xda)
+        out += data
+    elif cls is bool:
+        out.append(0xc3 if value else 0xc2)
+    elif cls is int:
+        if 0 <= value < 0x80:
+            out.append(value)
+        elif -0x20 <= value < 0:
+            out.append(value & 0xff)
+        elif -0x80000000 <= value < 0x80000000:
+            out += _pack_int32(0xd2, value)
+        elif -0x8000000000000000 <= value < 0x8000000000000000:
+            out += _pack_int64(0xd3, value)
+        elif 0 < value <= 0xffffffffffffffff:
+            out += _pack_uint64(0xcf, value)
+        else:
+            raise ValueError("Can't write integer {} in binary format, it only holds 64-bit integers".format(value))
+    elif cls is float:
+        out += _pack_float(0xcb, value)
+    elif value is None:
+        out.append(0xc0)
+    else:
+        raise TypeError("Can't write {} in binary format".format(type(value)))
+
+
+def _pack_element(out, element, declared):
+    """ Writes an element as a map from field numbers to values, preceded by
+    its resource type if it isn't of the declared type.
+    """
+    if declared is None or element.resource_type != declared.resource_type:
+        out.append(_TYPED)
+        _pack_value(out, element.resource_type)
+    
+    fields = []
+    for number, field in enumerate(element.elementTable().binary_fields):
+        value = getattr(element, field[0])
+        if value is not None and (not field[2] or len(value) > 0):
+            fields.append((number, field, value))
+    _pack_header(out, len(fields), 0x80, 16, 0xde)
+    
+    for number, (name, typ, is_list, is_element, is_date), value in fields:
+        _pack_value(out, number)
+        if is_list:
+            _pack_header(out, len(value), 0x90, 16, 0xdc)
+        else:
+            value = (value,)
+        for item in value:
+            if is_element and isinstance(item, FHIRAbstractBase):
+                _pack_element(out, item, typ)
+                continue
+            if is_date and hasattr(item, 'as_json'):
+                item = item.as_json()
+            if item.__class__ is str and len(item) < 32 and item.isascii():
+                out.append(0xa0 | len(item))
+                out += item.encode('ascii')
+            else:
+                _pack_value(out, item)
+
+
+def _unpack_length(data, pos, tag, fix, fix_limit, tag16):
+    """ Reads the length of a map, array or string whose header starts with
+    `tag` at `pos - 1`, returning the length and the position after it.
+    """
+    if fix <= tag < fix + fix_limit:
+        return tag - fix, pos
+    if tag == 0xd9:
+        return data[pos], pos + 1
+    if tag == tag16:
+        return _unpack_uint16(data, pos)[0], pos + 2
+    if tag == tag16 + 1:
+        return _unpack_uint32(data, pos)[0], pos + 4
+    raise ValueError("Unexpected byte 0x{:02x} at position {} of binary data".format(tag, pos - 1))
+
+
+def _unpack_value(data, pos):
+    """ Reads a MessagePack value, other than a map or an array, returning it
+    and the position after it.
+    """
+    tag = data[pos]
+    pos += 1
+    if tag < 0x80:
+        return tag, pos
+    if 0xa0 <= tag < 0xc0 or 0xd9 <= tag <= 0xdb:
+        length, pos = _unpack_length(data, pos, tag, 0xa0, 32, 0xda)
+        end = pos + length
+        return data[pos:end].decode('utf-8'), end
+    if tag >= 0xe0:
+        return tag - 0x100, pos
+    if tag == 0xc2 or tag == 0xc3:
+        return tag == 0xc3, pos
+    if tag == 0xc0:
+        return None, pos
+    unpack, size = _UNPACKERS.get(tag, (None, 0))
+    if unpack is None:
+        raise ValueError("Unexpected byte 0x{:02x} at position {} of binary data".format(tag, pos - 1))
+    return unpack(data, pos)[0], pos + size
+
+
+_UNPACKERS = {
+    0xca: (_unpack_float32, 4), 0xcb: (_unpack_float64, 8),
+    0xcc: (_unpack_uint8, 1), 0xcd: (_unpack_uint16, 2), 0xce: (_unpack_uint32, 4), 0xcf: (_unpack_uint64, 8),
+    0xd0: (_unpack_int8, 1), 0xd1: (_unpack_int16, 2), 0xd2: (_unpack_int32, 4), 0xd3: (_unpack_int64, 8),
+}
+
+
+def _unpack_element(data, pos, klass, owner):
+    """ Reads an element written by `_pack_element()`, returning it and the
+    position after it.
+    """
+    tag = data[pos]
+    if tag == _TYPED:
+        resource_type, pos = _unpack_value(data, pos + 1)
+        klass = klass._class_for_json({'resourceType': resource_type})
+        tag = data[pos]
+    count, pos = _unpack_length(data, pos + 1, tag, 0x80, 16, 0xde)
+    
+    element = klass()
+    element._owner = owner
+    fields = klass.elementTable().binary_fields
+    for _ in range(count):
+        number = data[pos]
+        if number < 0x80:
+            pos += 1
+        else:
+            number, pos = _unpack_value(data, pos)
+        try:
+            name, typ, is_list, is_element, is_date = fields[number]
+        except (IndexError, TypeError):
+            raise ValueError("Unknown field number {} for {} in binary data".format(number, klass.__name__))
+        if is_list:
+            tag = data[pos]
+            length, pos = _unpack_length(data, pos + 1, tag, 0x90, 16, 0xdc)
+            value = []
+            for _ in range(length):
+                if is_element:
+                    item, pos = _unpack_element(data, pos, typ, element)
+                else:
+                    item, pos = _unpack_value(data, pos)
+                    if is_date:
+                        item = typ(item)
+                value.append(item)
+        elif is_element:
+            value, pos = _unpack_element(data, pos, typ, element)
+        else:
+            tag = data[pos]
+            if 0xa0 <= tag < 0xc0:
+                end = pos + 1 + tag - 0xa0
+                value = data[pos + 1:end].decode('utf-8')
+                pos = end
+            else:
+                value, pos = _unpack_value(data, pos)
+            if is_date:
+                value = typ(value)
+        setattr(element, name, value)
+    return element, pos
+
+
+def _unpickle(cls, state):
+    """ Recreates an element pickled by `FHIRAbstractBase.__reduce_ex__()`
+    from its class and its alternating field numbers and values, making it
+    the owner of its child elements.
+    """
+    element = cls()
+    fields = cls.elementTable().binary_fields
+    values = iter(state)
+    for number, value in zip(values, values):
+        name, typ, is_list, is_element, is_date = fields[number]
+        if is_element:
+            for item in (value if is_list else (value,)):
+                if isinstance(item, FHIRAbstractBase):
+                    item._owner = element
+        elif is_date:
+            value = [typ(item) for item in value] if is_list else typ(value)
+        setattr(element, name, value)
+    return element
+
+
+def _date_json(value):
+    return value.as_json() if hasattr(value, 'as_json') else value
+
+
+def _intern_functions(table):
+    """ Returns the `intern()` function of an intern table, and its `share()`
+    function if the table shares elements, or None for each.
+    """
+    if table is None:
+        return None, None
+    return table.intern, table.share if table.shared_types else None
+
+
+def _interned(intern, value):
+    """ Returns the shared copy of a string, or a list with the shared copies
+    of the strings in it, from an intern function. Other values are returned
+    as they are.
+    """
+    if value.__class__ is str:
+        return intern(value)
+    if value.__class__ is list:
+        return [intern(v) if v.__class__ is str else v for v in value]
+    return value
+
+
+def _patch_value(value):
+    """ Returns the JSON of an element, a date or a list of them, for JSON
+    Patch operations. JSON values, from lazy instances, are copied.
+    """
+    if value.__class__ is list:
+        return [_patch_value(item) for item in value]
+    if hasattr(value, 'as_json'):
+        return value.as_json()
+    return _copy_json(value)
+
+
+def _diff_value(value, other, path, ops):
+    """ Appends the JSON Patch operations turning a property value, or a
+    list item, into `other` to `ops`. Elements of the same class are patched,
+    other values replaced if their JSON differs.
+    """
+    if value is other:
+        return
+    if isinstance(value, FHIRAbstractBase) and isinstance(other, FHIRAbstractBase) \
+        and value.elementTable() is other.elementTable():
+        value._diff(other, path, ops)
+        return
+    js = _date_json(value)
+    other_js = _date_json(other)
+    if js != other_js or js.__class__ is not other_js.__class__:
+        ops.append({'op': 'replace', 'path': path, 'value': other_js})
+
+
+def _diff_json(js, other, path, ops):
+    """ Appends the JSON Patch operations turning a JSON value into `other`
+    to `ops`. None stands for a missing value.
+    """
+    if js is None or other is None:
+        if other is not None:
+            ops.append({'op': 'add', 'path': path, 'value': _copy_json(other)})
+        elif js is not None:
+            ops.append({'op': 'remove', 'path': path})
+    elif js.__class__ is dict and other.__class__ is dict:
+        for key, value in js.items():
+            _diff_json(value, other.get(key), path + '/' + key, ops)
+        for key, value in other.items():
+            if key not in js:
+                _diff_json(None, value, path + '/' + key, ops)
+    elif js.__class__ is list and other.__class__ is list:
+        _diff_lists(js, other, path, ops, _diff_json)
+    elif js != other or js.__class__ is not other.__class__:
+        ops.append({'op': 'replace', 'path': path, 'value': _copy_json(other)})
+
+
+def _diff_lists(items, other, path, ops, diff_item):
+    """ Appends the JSON Patch operations turning a list into `other` to
+    `ops`, comparing items by position with `diff_item`.
+    """
+    for i, (item, other_item) in enumerate(zip(items, other)):
+        diff_item(item, other_item, '{}/{}'.format(path, i), ops)
+    for i in range(len(items) - 1, len(other) - 1, -1):
+        ops.append({'op': 'remove', 'path': '{}/{}'.format(path, i)})
+    for other_item in other[len(items):]:
+        ops.append({'op': 'add', 'path': path + '/-', 'value': _patch_value(other_item)})
+
+
+_unmaterialized = object()
+""" Marks properties of lazy instances that have not been created yet. """
+
+_index_version = 0
+""" Counts changes of `_IndexedKey` properties, so that indexes of lists by
+these properties know when they may miss items. """
+
+
+class _IndexedKey(object):
+    """ Descriptor for a property that lists are indexed by, like resource ids
+    and Bundle entries' `fullUrl`, see `fhirreference._find_indexed()`:
+    stores the value like a plain attribute or the class' slot would, and
+    counts changes to a value that was set before in `_index_version`.
+    Lazy instances creating the property don't change it.
+    """
+    
+    __slots__ = ('name', 'slot')
+    
+    def __init__(self, name, slot=None):
+        self.name = name
+        self.slot = slot
+    
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        if self.slot is not None:
+            return self.slot.__get__(instance, owner)
+        try:
+            return instance.__dict__[self.name]
+        except KeyError:
+            raise AttributeError(self.name)     # makes lazy instances create it
+    
+    def __set__(self, instance, value):
+        global _index_version
+        if self.slot is not None:
+            try:
+                if self.slot.__get__(instance) != value:
+                    _index_version += 1
+            except AttributeError:
+                pass
+            self.slot.__set__(instance, value)
+        else:
+            if instance.__dict__.get(self.name, value) != value:
+                _index_version += 1
+            instance.__dict__[self.name] = value
+    
+    def __delete__(self, instance):
+        global _index_version
+        _index_version += 1
+        if self.slot is not None:
+            self.slot.__delete__(instance)
+        else:
+            try:
+                del instance.__dict__[self.name]
+            except KeyError:
+                raise AttributeError(self.name)
+
+
+def _copy_json(value):
+    """ Returns a deep copy of a JSON value, so that JSON passed through from
+    lazy instances can be changed without changing the instances.
+    """
+    if value.__class__ is dict:
+        return {key: _copy_json(item) for key, item in value.items()}
+    if value.__class__ is list:
+        return [_copy_json(item) for item in value]
+    return value
 
 
 class FHIRAbstractBase(object):
     """ Abstract base class for all FHIR elements.
+    
+    Classes generated with `compact_instances` declare their properties in
+    `__slots__`, so their instances don't need a `__dict__` unless other
+    attributes are set on them.
+    
+    Lazy instances, created with `with_json(..., lazy=True)`, skip the
+    generated `__init__()`: their properties are missing until first
+    accessed, at which point `__getattr__()` creates them from `_lazy_json`.
     """
     
-    def __init__(self, jsondict=None, strict=True):
+    __slots__ = ('_owner', '__dict__', '__weakref__')
+    
+    _lazy_json = None
+    """ The JSON dictionary a lazy instance was created from. """
+    
+    _resolved = None
+    """ References resolved by instances owned by the receiver, by
+    reference id, see `didResolveReference()`. """
+    
+    intern_table = None
+    """ An `FHIRInternTable` sharing the strings and elements of instances
+    created from JSON, see `fhirintern.interning()`. """
+    
+    fullUrl = _IndexedKey('fullUrl')
+    """ Bundle entries are indexed by their `fullUrl`. """
+    
+    def __init_subclass__(cls, **kwargs):
+        """ Keeps `_IndexedKey` properties working in classes declaring them
+        in `__slots__`, whose slots would hide them.
+        """
+        super(FHIRAbstractBase, cls).__init_subclass__(**kwargs)
+        for name in cls.__dict__.get('__slots__', ()):
+            if isinstance(getattr(cls.__mro__[1], name, None), _IndexedKey):
+                setattr(cls, name, _IndexedKey(name, cls.__dict__[name]))
+    
+    def __init__(self, jsondict=None, strict=True, elements=None, trusted=False):
         """ Initializer. If strict is true, raises on errors, otherwise uses
         `logging.warning()`.
         
         :raises: FHIRValidationError on validation errors, unless strict is False
         :param dict jsondict: A JSON dictionary to use for initialization
         :param bool strict: If True (the default), invalid variables will raise a TypeError
+        :param elements: Optional element paths to restrict initialization
+            to, see `update_with_json()`
+        :param bool trusted: Whether the JSON data is known to be valid, in
+            which case it is not validated at all, see `update_with_json()`
         """
         
         self._owner = None
@@ -58,38 +630,67 @@ class FHIRAbstractBase(object):
         
         if jsondict is not None:
             if strict:
-                self.update_with_json(jsondict)
+                self.update_with_json(jsondict, elements=elements, trusted=trusted)
             else:
                 try:
-                    self.update_with_json(jsondict)
+                    self.update_with_json(jsondict, elements=elements, trusted=trusted)
                 except FHIRValidationError as e:
                     for err in e.errors:
                         logging.warning(err)
     
+    def __getattr__(self, name):
+        """ Only called if `name` is not found the regular way. For lazy
+        instances, creates the property of that name from JSON data.
+        
+        :raises: FHIRValidationError if the property's JSON data is invalid
+        """
+        if self._lazy_json is not None:
+            prop = self.elementTable().by_name.get(name)
+            if prop is not None:
+                return self._materialize(prop)
+        raise AttributeError("'{}' object has no attribute '{}'"
+            .format(type(self).__name__, name))
+    
     
     # MARK: Instantiation from JSON
     
     @classmethod
-    def with_json(cls, jsonobj):
+    def with_json(cls, jsonobj, lazy=False, elements=None, trusted=False):
         """ Initialize an element from a JSON dictionary or array.
         
         If the JSON dictionary has a "resourceType" entry and the specified
         resource type is not the receiving classes type, uses
         `FHIRElementFactory` to return a correct class instance.
         
+        Lazy instances keep the JSON dictionary and only create a property
+        (and validate its data) when it is first accessed; `as_json()` passes
+        the data of properties that were never accessed straight through.
+        Use `validate()` to validate all of their data at once.
+        
+        When given `elements`, only the properties selected by these element
+        paths are created, see `update_with_json()`. Lazy instances ignore
+        `elements`.
+        
+        With `trusted`, data is not validated while creating instances; only
+        use it for data known to be valid, like data that was validated before
+        being stored. Lazy and projected instances ignore `trusted`.
+        
         :raises: TypeError on anything but dict or list of dicts
         :raises: FHIRValidationError if instantiation fails
         :param jsonobj: A dict or list of dicts to instantiate from
+        :param bool lazy: Whether to create lazy instances
+        :param elements: Optional element paths to restrict instantiation to
+        :param bool trusted: Whether the JSON data is known to be valid
         :returns: An instance or a list of instances created from JSON data
         """
         if isinstance(jsonobj, dict):
-            return cls._with_json_dict(jsonobj)
+            return cls._with_json_dict(jsonobj, lazy=lazy, elements=elements, trusted=trusted)
         
         if isinstance(jsonobj, list):
             arr = []
             for jsondict in jsonobj:
                 try:
-                    arr.append(cls._with_json_dict(jsondict))
+                    arr.append(cls._with_json_dict(jsondict, lazy=lazy, elements=elements, trusted=trusted))
                 except FHIRValidationError as e:
                     raise e.prefixed(str(len(arr)))
             return arr
@@ -98,20 +699,74 @@ class FHIRAbstractBase(object):
             .format(cls, type(jsonobj)))
     
     @classmethod
-    def _with_json_dict(cls, jsondict):
+    def from_json_bytes(cls, data, lazy=False, elements=None, trusted=False):
+        """ Initialize an element from JSON text, like `with_json()` does
+        with the decoded JSON.
+        
+        The text is decoded by the `json` module's C decoder in one go, then
+        instances are created by the key-driven path of `update_with_json()`,
+        which only visits the keys present in the data.
+        
+        :raises: ValueError if the data is not valid JSON
+        :raises: TypeError on anything but a JSON object or array of objects
+        :raises: FHIRValidationError if instantiation fails
+        :param data: JSON text as bytes (UTF-8, -16 or -32, optionally with a
+            BOM) or str
+        :param bool lazy: Whether to create lazy instances
+        :param elements: Optional element paths to restrict instantiation to
+        :param bool trusted: Whether the JSON data is known to be valid, in
+            which case it is not validated at all, see `update_with_json()`
+        :returns: An instance or a list of instances created from JSON data
+        """
+        if isinstance(data, (bytearray, memoryview)):
+            data = bytes(data)
+        return cls.with_json(json.loads(data), lazy=lazy, elements=elements, trusted=trusted)
+    
+    @classmethod
+    def from_json_file(cls, source, lazy=False, elements=None, trusted=False):
+        """ Initialize an element from a JSON file, see `from_json_bytes()`.
+        
+        :raises: ValueError if the file does not contain valid JSON
+        :raises: TypeError on anything but a JSON object or array of objects
+        :raises: FHIRValidationError if instantiation fails
+        :param source: A file path, or a file opened in binary or text mode
+        :param bool lazy: Whether to create lazy instances
+        :param elements: Optional element paths to restrict instantiation to
+        :param bool trusted: Whether the JSON data is known to be valid, see
+            `from_json_bytes()`
+        :returns: An instance or a list of instances created from JSON data
+        """
+        if isinstance(source, str):
+            with open(source, 'rb') as handle:
+                return cls.from_json_bytes(handle.read(), lazy=lazy, elements=elements, trusted=trusted)
+        return cls.from_json_bytes(source.read(), lazy=lazy, elements=elements, trusted=trusted)
+    
+    @classmethod
+    def _with_json_dict(cls, jsondict, lazy=False, elements=None, trusted=False):
         """ Internal method to instantiate from JSON dictionary.
         
         :raises: TypeError on anything but dict
         :raises: FHIRValidationError if instantiation fails
+        :param bool lazy: Whether to create a lazy instance
+        :param elements: Optional element paths to restrict instantiation to
+        :param bool trusted: Whether the JSON data is known to be valid
         :returns: An instance created from dictionary data
         """
         if not isinstance(jsondict, dict):
             raise TypeError("Can only use `_with_json_dict()` on {} with a dictionary, got {}"
-                .format(type(self), type(jsondict)))
+                .format(cls, type(jsondict)))
+        if lazy:
+            instance = cls.__new__(cls)
+            instance._prepare_lazy(jsondict)
+            return instance
+        if elements is not None:
+            return cls(jsondict, elements=elements)
+        if trusted:
+            return cls(jsondict, trusted=True)
         return cls(jsondict)
     
     @classmethod
-    def with_json_and_owner(cls, jsonobj, owner):
+    def with_json_and_owner(cls, jsonobj, owner, lazy=False, elements=None, trusted=False):
         """ Instantiates by forwarding to `with_json()`, then remembers the
         "owner" of the instantiated elements. The "owner" is the resource
         containing the receiver and is used to resolve contained resources.
@@ -120,9 +775,12 @@ class FHIRAbstractBase(object):
         :raises: FHIRValidationError if instantiation fails
         :param dict jsonobj: Decoded JSON dictionary (or list thereof)
         :param FHIRElement owner: The owning parent
+        :param bool lazy: Whether to create lazy instances
+        :param elements: Optional element paths to restrict instantiation to
+        :param bool trusted: Whether the JSON data is known to be valid
         :returns: An instance or a list of instances created from JSON data
         """
-        instance = cls.with_json(jsonobj)
+        instance = cls.with_json(jsonobj, lazy=lazy, elements=elements, trusted=trusted)
         if isinstance(instance, list):
             for inst in instance:
                 inst._owner = owner
@@ -132,19 +790,93 @@ class FHIRAbstractBase(object):
         return instance
     
     
+    # MARK: Lazy Instances
+    
+    def _prepare_lazy(self, jsondict):
+        """ Sets up an instance created without calling `__init__()` to lazily
+        create its properties from the given JSON dictionary. Subclasses that
+        set up instance state in `__init__()` must do so here, too.
+        
+        :param dict jsondict: The JSON dictionary to create properties from
+        """
+        self._owner = None
+        self._lazy_json = jsondict
+    
+    def _materialize(self, prop):
+        """ Creates the value of a lazy instance's property from its JSON data
+        and stores it on the receiver. Child elements are lazy themselves.
+        
+        :raises: FHIRValidationError if the JSON data is invalid
+        :param tuple prop: The property's tuple from `elementProperties()`
+        :returns: The property's value
+        """
+        value = self._lazy_json.get(prop[1])
+        if value is not None:
+            value = self._property_value(prop, value, lazy=True)
+        setattr(self, prop[0], value)
+        return value
+    
+    def _stored_value(self, name):
+        """ Returns the value stored on the receiver for the given property,
+        bypassing `__getattr__()`, or `_unmaterialized` if there is none.
+        """
+        try:
+            return object.__getattribute__(self, name)
+        except AttributeError:
+            return _unmaterialized
+    
+    def validate(self):
+        """ Validates the JSON data of a lazy instance as if the instance had
+        been created eagerly. Other instances have been validated when they
+        were created, so this does nothing for them.
+        
+        :raises: FHIRValidationError on validation errors
+        """
+        if self._lazy_json is not None:
+            self.__class__(self._lazy_json)
+    
+    
     # MARK: (De)Serialization
     
     def elementProperties(self):
         """ Returns a list of tuples, one tuple for each property that should
         be serialized, as: ("name", "json_name", type, is_list, "of_many", not_optional)
+        
+        The result must be the same for all instances of a class since it is
+        only consulted once per class, see `elementTable()`.
         """
         return []
     
-    def update_with_json(self, jsondict):
+    @classmethod
+    def elementTable(cls):
+        """ Returns the receiving class' `FHIRElementTable`, creating it from
+        `elementProperties()` on first use.
+        
+        :returns: The FHIRElementTable shared by all instances of the class
+        """
+        table = cls.__dict__.get('_element_table')
+        if table is None:
+            table = FHIRElementTable(cls.elementProperties(cls.__new__(cls)))
+            cls._element_table = table
+        return table
+    
+    def update_with_json(self, jsondict, elements=None, trusted=False):
         """ Update the receiver with data in a JSON dictionary.
         
+        Valid data is consumed by `_update_with_json_fast()`; if that bails
+        out, the data is run through `_update_with_json_checked()`, which
+        collects all validation errors.
+        
+        If `elements` are given, only the properties selected by these element
+        paths are updated, by `_update_with_json_projected()`. Otherwise, if
+        the data is `trusted`, it is consumed by `_update_with_json_trusted()`
+        without any validation.
+        
         :raises: FHIRValidationError on validation errors
         :param dict jsondict: The JSON dictionary to use to update the receiver
+        :param elements: Optional element paths (e.g. "code" or
+            "Observation.subject.reference") to restrict the update to
+        :param bool trusted: Whether the JSON data is known to be valid
         :returns: None on success, a list of errors if there were errors
         """
         if jsondict is None:
@@ -154,16 +886,126 @@ class FHIRAbstractBase(object):
             raise FHIRValidationError("Non-dict type {} fed to `update_with_json` on {}"
                 .format(type(jsondict), type(self)))
         
+        if elements is not None:
+            self._update_with_json_projected(jsondict, elements)
+        elif trusted:
+            self._update_with_json_trusted(jsondict)
+        elif not self._update_with_json_fast(jsondict):
+            self._update_with_json_checked(jsondict)
+    
+    def _update_with_json_fast(self, jsondict):
+        """ Updates the receiver by looping over the keys in the dictionary
+        (instead of over all properties), using the precomputed readers of the
+        class' element table.
+        
+        Does not report errors: as soon as anything is off, returns False and
+        leaves it to `_update_with_json_checked()` to update the receiver and
+        collect the errors.
+        
+        :param dict jsondict: The JSON dictionary to use to update the receiver
+        :returns: True if the receiver was updated with valid data
+        """
+        table = self.elementTable()
+        readers = table.readers
+        found = set() if table.nonoptionals else None
+        intern, share = _intern_functions(self.intern_table)
+        for jsname, value in jsondict.items():
+            reader = readers.get(jsname)
+            if reader is None:
+                if jsname in table.valid_keys:
+                    continue
+                if value is not None and jsname in table.extension_keys:
+                    continue
+                return False
+            if value is None:
+                continue
+            
+            name, factory, is_list, type_check, found_name = reader
+            if factory is not None:
+                try:
+                    value = factory(value, self)
+                except Exception:
+                    return False
+                if share is not None:
+                    value = share(value)
+            
+            if is_list:
+                if not isinstance(value, list):
+                    return False
+                if len(value) > 0 and value[0] is not None and not isinstance(value[0], type_check):
+                    return False
+            elif not isinstance(value, type_check):
+                return False
+            
+            if intern is not None and type_check is str:
+                value = intern(value) if value.__class__ is str else _interned(intern, value)
+            setattr(self, name, value)
+            if found is not None:
+                found.add(found_name)
+        
+        return found is None or table.nonoptionals <= found
+    
+    def _update_with_json_trusted(self, jsondict):
+        """ Updates the receiver with data known to be valid, looping over the
+        keys in the dictionary. Nothing is checked: values are not type
+        checked, missing non-optional properties are not reported and unknown
+        keys are skipped.
+        
+        :param dict jsondict: The JSON dictionary to use to update the receiver
+        """
+        readers = self.elementTable().trusted_readers
+        intern, share = _intern_functions(self.intern_table)
+        for jsname, value in jsondict.items():
+            reader = readers.get(jsname)
+            if reader is None or value is None:
+                continue
+            name, element_class, factory = reader
+            if element_class is not None:
+                value = element_class._with_json_trusted(value, self)
+                if share is not None:
+                    value = share(value)
+            elif factory is not None:
+                value = factory(value, self)
+            elif intern is not None:
+                value = _interned(intern, value)
+            setattr(self, name, value)
+    
+    @classmethod
+    def _with_json_trusted(cls, jsonobj, owner):
+        """ Instantiates from JSON data known to be valid, like
+        `with_json_and_owner()` does but without any checks.
+        
+        :param jsonobj: A dict or list of dicts to instantiate from
+        :param FHIRElement owner: The owning parent
+        :returns: An instance or a list of instances created from JSON data
+        """
+        if isinstance(jsonobj, list):
+            return [cls._with_json_trusted(jsondict, owner) for jsondict in jsonobj]
+        instance = cls._class_for_json(jsonobj)()
+        instance._owner = owner
+        instance._update_with_json_trusted(jsonobj)
+        return instance
+    
+    @classmethod
+    def _class_for_json(cls, jsondict):
+        """ Returns the class to instantiate for the given JSON dictionary,
+        the receiver itself unless overridden.
+        """
+        return cls
+    
+    def _update_with_json_checked(self, jsondict):
+        """ Updates the receiver by looping over all properties, collecting
+        all validation errors.
+        
+        :raises: FHIRValidationError on validation errors
+        :param dict jsondict: The JSON dictionary to use to update the receiver
+        """
         # loop all registered properties and instantiate
+        table = self.elementTable()
         errs = []
-        valid = set(['resourceType'])
         found = set()
-        nonoptionals = set()
-        for name, jsname, typ, is_list, of_many, not_optional in self.elementProperties():
-            valid.add(jsname)
-            if of_many is not None:
-                valid.add(of_many)
-            
+        intern, share = _intern_functions(self.intern_table)
+        for name, jsname, typ, is_list, of_many, not_optional in table.properties:
             # bring the value in shape
             err = None
             value = jsondict.get(jsname)
@@ -189,43 +1031,114 @@ class FHIRAbstractBase(object):
                     err = TypeError("Wrong type {} for property \"{}\" on {}, expecting {}"
                         .format(type(testval), name, type(self), typ))
                 else:
+                    if intern is not None and typ is str:
+                        value = _interned(intern, value)
+                    elif share is not None:
+                        value = share(value)
                     setattr(self, name, value)
                 
                 found.add(jsname)
                 if of_many is not None:
                     found.add(of_many)
             
-            # not optional and missing, report (we clean `of_many` later on)
-            elif not_optional:
-                nonoptionals.add(of_many or jsname)
-            
-            # TODO: look at `_name` only if this is a primitive!
-            _jsname = '_'+jsname
-            _value = jsondict.get(_jsname)
-            if _value is not None:
-                valid.add(_jsname)
-                found.add(_jsname)
-            
             # report errors
             if err is not None:
                 errs.append(err.prefixed(name) if isinstance(err, FHIRValidationError) else FHIRValidationError([err], name))
         
         # were there missing non-optional entries?
-        if len(nonoptionals) > 0:
-            for miss in nonoptionals - found:
+        if len(table.nonoptionals) > 0:
+            for miss in table.nonoptionals - found:
                 errs.append(KeyError("Non-optional property \"{}\" on {} is missing"
                     .format(miss, self)))
         
         # were there superfluous dictionary keys?
-        if len(set(jsondict.keys()) - valid) > 0:
-            for supflu in set(jsondict.keys()) - valid:
-                errs.append(AttributeError("Superfluous entry \"{}\" in data for {}"
-                    .format(supflu, self)))
+        # TODO: look at `_name` only if this is a primitive!
+        superfluous = jsondict.keys() - table.valid_keys
+        for supflu in superfluous:
+            if supflu in table.extension_keys and jsondict[supflu] is not None:
+                continue
+            errs.append(AttributeError("Superfluous entry \"{}\" in data for {}"
+                .format(supflu, self)))
         
         if len(errs) > 0:
             raise FHIRValidationError(errs)
     
-    def as_json(self):
+    def _update_with_json_projected(self, jsondict, elements):
+        """ Updates the receiver with the properties selected by the given
+        element paths, passing sub-paths on to child elements. Other keys in
+        the dictionary are skipped without being looked at; non-optional
+        properties are only checked if they are selected.
+        
+        :raises: FHIRValidationError on validation errors
+        :param dict jsondict: The JSON dictionary to use to update the receiver
+        :param elements: The element paths to restrict the update to
+        """
+        if not isinstance(elements, frozenset):
+            elements = frozenset([elements] if isinstance(elements, str) else elements)
+        
+        table = self.elementTable()
+        errs = []
+        nonoptionals = set()
+        intern, share = _intern_functions(self.intern_table)
+        for prop, subelements in table.projection(elements, getattr(type(self), 'resource_type', None)):
+            name, jsname, typ, is_list, of_many, not_optional = prop
+            if not_optional:
+                nonoptionals.add(of_many or jsname)
+            value = jsondict.get(jsname)
+            if value is None:
+                continue
+            try:
+                value = self._property_value(prop, value, elements=subelements)
+            except FHIRValidationError as e:
+                errs.append(e)
+                continue
+            if intern is not None and typ is str:
+                value = _interned(intern, value)
+            elif share is not None:
+                value = share(value)
+            setattr(self, name, value)
+        
+        for nonop in nonoptionals:
+            if all(jsondict.get(jsname) is None for jsname in table.of_many.get(nonop, (nonop,))):
+                errs.append(KeyError("Non-optional property \"{}\" on {} is missing"
+                    .format(nonop, self)))
+        
+        if len(errs) > 0:
+            raise FHIRValidationError(errs)
+    
+    def _property_value(self, prop, value, **options):
+        """ Instantiates a property's value from JSON data and checks its type.
+        
+        :raises: FHIRValidationError, prefixed with the property name
+        :param tuple prop: The property's tuple from `elementProperties()`
+        :param value: The JSON value, not None
+        :param options: `lazy` and `elements` options for `with_json()` of
+            FHIRAbstractBase subclasses
+        :returns: The property's value
+        """
+        name, jsname, typ, is_list, of_many, not_optional = prop
+        try:
+            if isinstance(typ, type) and issubclass(typ, FHIRAbstractBase):
+                value = typ.with_json_and_owner(value, self, **options)
+            elif hasattr(typ, 'with_json_and_owner'):
+                value = typ.with_json_and_owner(value, self)
+        except FHIRValidationError as e:
+            raise e.prefixed(name)
+        except Exception as e:
+            raise FHIRValidationError([e], name)
+        
+        testval = value
+        if is_list:
+            if not isinstance(value, list):
+                raise FHIRValidationError([TypeError("Wrong type {} for list property \"{}\" on {}, expecting a list of {}"
+                    .format(type(value), name, type(self), typ))], name)
+            testval = value[0] if len(value) > 0 else None
+        if testval is not None and not self._matches_type(testval, typ):
+            raise FHIRValidationError([TypeError("Wrong type {} for property \"{}\" on {}, expecting {}"
+                .format(type(testval), name, type(self), typ))], name)
+        return value
+    
+    def as_json(self, trusted=False):
         """ Serializes to JSON by inspecting `elementProperties()` and creating
         a JSON dictionary of all registered properties. Checks:
         
@@ -234,20 +1147,32 @@ class FHIRAbstractBase(object):
         
         :raises: FHIRValidationError if properties have the wrong type or if
             required properties are empty
+        :param bool trusted: Whether the receiver is known to be valid, in
+            which case the checks are skipped, see `_as_json_trusted()`
         :returns: A validated dict object that can be JSON serialized
         """
+        if trusted:
+            return self._as_json_trusted()
+        
         js = {}
         errs = []
         
         # JSONify all registered properties
+        table = self.elementTable()
+        lazy_json = self._lazy_json
         found = set()
-        nonoptionals = set()
-        for name, jsname, typ, is_list, of_many, not_optional in self.elementProperties():
-            if not_optional:
-                nonoptionals.add(of_many or jsname)
-            
+        for name, jsname, typ, is_list, of_many, not_optional in table.properties:
             err = None
-            value = getattr(self, name)
+            if lazy_json is None:
+                value = getattr(self, name)
+            else:
+                value = self._stored_value(name)
+                if value is _unmaterialized:
+                    value = lazy_json.get(jsname)
+                    if value is not None:
+                        found.add(of_many or jsname)
+                        js[jsname] = _copy_json(value)
+                    continue
             if value is None:
                 continue
             
@@ -283,8 +1208,8 @@ class FHIRAbstractBase(object):
                 errs.append(err if isinstance(err, FHIRValidationError) else FHIRValidationError([err], name))
         
         # any missing non-optionals?
-        if len(nonoptionals - found) > 0:
-            for nonop in nonoptionals - found:
+        if len(table.nonoptionals - found) > 0:
+            for nonop in table.nonoptionals - found:
                 errs.append(KeyError("Property \"{}\" on {} is not optional, you must provide a value for it"
                     .format(nonop, self)))
         
@@ -292,6 +1217,228 @@ class FHIRAbstractBase(object):
             raise FHIRValidationError(errs)
         return js
     
+    def _as_json_trusted(self):
+        """ Serializes to JSON like `as_json()`, without any checks. Child
+        elements are serialized without checks, too.
+        
+        :returns: A dict object that can be JSON serialized
+        """
+        js = {}
+        lazy_json = self._lazy_json
+        for name, jsname, typ, is_list, of_many, not_optional in self.elementTable().properties:
+            if lazy_json is None:
+                value = getattr(self, name)
+            else:
+                value = self._stored_value(name)
+                if value is _unmaterialized:
+                    value = lazy_json.get(jsname)
+                    if value is not None:
+                        js[jsname] = _copy_json(value)
+                    continue
+            if value is None:
+                continue
+            
+            if is_list:
+                if len(value) > 0:
+                    js[jsname] = [v.as_json(trusted=True) if isinstance(v, FHIRAbstractBase)
+                        else v.as_json() if hasattr(v, 'as_json') else v for v in value]
+            elif isinstance(value, FHIRAbstractBase):
+                js[jsname] = value.as_json(trusted=True)
+            else:
+                js[jsname] = value.as_json() if hasattr(value, 'as_json') else value
+        return js
+    
+    def write_json(self, fp, separators=None, ensure_ascii=True):
+        """ Serializes to JSON text and writes it to `fp` as it goes, without
+        building the dictionary that `as_json()` returns. The text is the
+        same as that of `json.dump(self.as_json(), fp)` and the same checks
+        are performed; if they fail, the error is raised once all properties
+        have been visited and the text written is incomplete.
+        
+        :param fp: A file-like object with a `write()` method accepting str
+        :param separators: An `(item_separator, key_separator)` tuple, as for
+            `json.dump()`
+        :param bool ensure_ascii: Whether to escape non-ASCII characters
+        :raises: FHIRValidationError if properties have the wrong type or if
+            required properties are empty
+        """
+        writer = FHIRJSONWriter(fp, separators=separators, ensure_ascii=ensure_ascii)
+        try:
+            self._write_json(writer)
+        finally:
+            writer.flush()
+    
+    def as_binary(self):
+        """ Serializes to a compact binary format: MessagePack, with elements
+        written as maps from field numbers, their properties' positions in
+        `elementProperties()`, to values. Use `from_binary()` to read it.
+        
+        Reading gives back the same model, including the original strings of
+        dates and times. Nothing is validated; use it for caching instances,
+        not for exchanging data: field numbers change when models are
+        generated from a different FHIR version, so data written by one set of
+        models can't be read by another.
+        
+        :raises: TypeError if properties hold values that have no JSON
+            representation
+        :raises: ValueError if properties hold integers that don't fit into
+            64 bits
+        :returns: The binary data, as bytes
+        """
+        out = bytearray()
+        _pack_element(out, self, None)
+        return bytes(out)
+    
+    @classmethod
+    def from_binary(cls, data):
+        """ Instantiates an element from data written by `as_binary()`. Like
+        `with_json()`, returns an instance of the data's resource type, if the
+        receiver is a resource class.
+        
+        :raises: ValueError if the data is not valid
+        :param data: The binary data, as bytes, bytearray or memoryview
+        :returns: An instance created from the data
+        """
+        if not isinstance(data, bytes):
+            data = bytes(data)
+        try:
+            instance, pos = _unpack_element(data, 0, cls, None)
+        except (IndexError, TypeError, struct.error, UnicodeDecodeError) as e:
+            raise ValueError("Truncated or invalid binary data: {}".format(e))
+        if pos > len(data):
+            raise ValueError("Truncated or invalid binary data: {} bytes missing".format(pos - len(data)))
+        if pos < len(data):
+            raise ValueError("Extra data after position {} of binary data".format(pos))
+        return instance
+    
+    def __reduce_ex__(self, protocol):
+        """ Pickles only the properties that are set, as alternating field
+        numbers (see `as_binary()`) and values, with dates and times as their
+        original strings. Child elements get their `_owner` back when
+        unpickled; owners themselves, servers and caches are left out, so an
+        element pickled on its own comes back without owner.
+        
+        `copy.deepcopy()` uses this too; `copy.copy()` uses `__copy__()`.
+        """
+        state = []
+        for number, (name, typ, is_list, is_element, is_date) in enumerate(self.elementTable().binary_fields):
+            value = getattr(self, name)
+            if value is None or (is_list and len(value) == 0):
+                continue
+            if is_date:
+                value = [_date_json(item) for item in value] if is_list else _date_json(value)
+            state.append(number)
+            state.append(value)
+        return (_unpickle, (type(self), tuple(state)))
+    
+    def __copy__(self):
+        """ Returns a shallow copy, sharing all values with the receiver,
+        including child elements, which keep the receiver as their owner.
+        """
+        func, args, state = object.__reduce_ex__(self, 2)[:3]
+        copy = func(*args)
+        dict_state, slot_state = state if isinstance(state, tuple) else (state, None)
+        for name, value in (slot_state or {}).items():
+            object.__setattr__(copy, name, value)
+        if dict_state:
+            copy.__dict__.update(dict_state)
+        return copy
+    
+    def _write_json(self, writer):
+        """ Writes the JSON object text of the receiver to `writer`. Mirrors
+        `as_json()` and raises the same errors.
+        """
+        writer.parts.append('{')
+        errs, sep = self._write_json_members(writer, '')
+        writer.parts.append('}')
+        if len(writer.parts) >= writer.buffer_size:
+            writer.flush()
+        if len(errs) > 0:
+            raise FHIRValidationError(errs)
+    
+    def _write_json_members(self, writer, sep):
+        """ Writes all registered properties as JSON object members, the
+        first one preceded by `sep`.
+        
+        :returns: A tuple of the list of errors encountered and the separator
+            to put in front of the next member
+        """
+        errs = []
+        table = self.elementTable()
+        lazy_json = self._lazy_json
+        write = writer.parts.append
+        encode_str = writer.encode_str
+        item_sep = writer.item_separator
+        key_sep = writer.key_separator
+        found = set()
+        for name, key, typ, is_list, type_check, found_name in table.writers:
+            err = None
+            if lazy_json is None:
+                value = getattr(self, name)
+            else:
+                value = self._stored_value(name)
+                if value is _unmaterialized:
+                    value = lazy_json.get(key[1:-1])
+                    if value is not None:
+                        found.add(found_name)
+                        write(sep + key + key_sep + writer.encode(value))
+                        sep = item_sep
+                    continue
+            if value is None:
+                continue
+            
+            if is_list:
+                if not isinstance(value, list):
+                   err = TypeError("Expecting property \"{}\" on {} to be list, but is {}"
+                       .format(name, type(self), type(value)))
+                elif len(value) > 0:
+                    if not isinstance(value[0], type_check):
+                        err = TypeError("Expecting property \"{}\" on {} to be {}, but is {}"
+                            .format(name, type(self), typ, type(value[0])))
+                    else:
+                        found.add(found_name)
+                        write(sep + key + key_sep + '[')
+                        sep = item_sep
+                        written = 0
+                        for v in value:
+                            try:
+                                if written > 0:
+                                    write(item_sep)
+                                if v.__class__ is str:
+                                    write(encode_str(v))
+                                else:
+                                    writer.write_value(v)
+                                written += 1
+                            except FHIRValidationError as e:
+                                err = e.prefixed(str(written)).prefixed(name)
+                        write(']')
+            else:
+                if not isinstance(value, type_check):
+                    err = TypeError("Expecting property \"{}\" on {} to be {}, but is {}"
+                        .format(name, type(self), typ, type(value)))
+                elif value.__class__ is str:
+                    found.add(found_name)
+                    write(sep + key + key_sep + encode_str(value))
+                    sep = item_sep
+                else:
+                    try:
+                        found.add(found_name)
+                        write(sep + key + key_sep)
+                        sep = item_sep
+                        writer.write_value(value)
+                    except FHIRValidationError as e:
+                        err = e.prefixed(name)
+            
+            if err is not None:
+                errs.append(err if isinstance(err, FHIRValidationError) else FHIRValidationError([err], name))
+        
+        # any missing non-optionals?
+        if len(table.nonoptionals - found) > 0:
+            for nonop in table.nonoptionals - found:
+                errs.append(KeyError("Property \"{}\" on {} is not optional, you must provide a value for it"
+                    .format(nonop, self)))
+        return errs, sep
+    
     def _matches_type(self, value, typ):
         if value is None:
             return True
@@ -304,6 +1451,61 @@ class FHIRAbstractBase(object):
         return False
     
     
+    # MARK: Diffing
+    
+    def diff(self, other):
+        """ Returns the RFC 6902 JSON Patch operations that turn the JSON of
+        the receiver into that of `other`, an instance of the same class, like
+        a changed copy of the receiver.
+        
+        Instances are compared property by property, following the element
+        tables, and child elements both instances share are skipped, as are
+        properties of lazy instances that neither one has created yet. List
+        items are compared by position: changed items are patched, surplus
+        items are removed from the end and new ones appended. Values put into
+        operations are serialized with `as_json()`; nothing else is checked.
+        
+        :raises: TypeError if `other` is not an instance of the receiver's class
+        :raises: FHIRValidationError if values put into operations are invalid
+        :param other: The instance to compare the receiver to
+        :returns: A list of JSON Patch operations, as dictionaries
+        """
+        if not isinstance(other, FHIRAbstractBase) or other.elementTable() is not self.elementTable():
+            raise TypeError("Cannot diff {} against {}".format(type(self), type(other)))
+        ops = []
+        self._diff(other, '', ops)
+        return ops
+    
+    def _diff(self, other, path, ops):
+        """ Appends the JSON Patch operations turning the receiver into
+        `other`, of the same class, to `ops`, prefixing paths with `path`.
+        """
+        lazy_json = self._lazy_json
+        other_lazy_json = other._lazy_json
+        for name, jsname, typ, is_list, of_many, not_optional in self.elementTable().properties:
+            if lazy_json is not None and other_lazy_json is not None \
+                and self._stored_value(name) is _unmaterialized and other._stored_value(name) is _unmaterialized:
+                _diff_json(lazy_json.get(jsname), other_lazy_json.get(jsname), path + '/' + jsname, ops)
+                continue
+            
+            value = getattr(self, name)
+            other_value = getattr(other, name)
+            if value is other_value:
+                continue
+            if is_list:
+                value = value or None
+                other_value = other_value or None
+            if value is None:
+                if other_value is not None:
+                    ops.append({'op': 'add', 'path': path + '/' + jsname, 'value': _patch_value(other_value)})
+            elif other_value is None:
+                ops.append({'op': 'remove', 'path': path + '/' + jsname})
+            elif is_list:
+                _diff_lists(value, other_value, path + '/' + jsname, ops, _diff_value)
+            else:
+                _diff_value(value, other_value, path + '/' + jsname, ops)
+    
+    
     # MARK: Owner
     
     def owningResource(self):
@@ -323,4 +1525,32 @@ class FHIRAbstractBase(object):
         while owner is not None and not 'Bundle' == owner.resource_type:
             owner = owner._owner
         return owner
+    
+    def resolvedReference(self, refid):
+        """ Returns the resolved reference with the given id, if it has been
+        resolved already. If it hasn't, walks up the owner hierarchy.
+        
+        You should probably use `resolved()` on the `FHIRReference` itself.
+        
+        :param refid: The id of the resource to resolve
+        :returns: An instance of `Resource`, if it was found
+        """
+        owner = self
+        while owner is not None:
+            if owner._resolved is not None and refid in owner._resolved:
+                return owner._resolved[refid]
+            owner = owner._owner
+        return None
+    
+    def didResolveReference(self, refid, resolved):
+        """ Called by `FHIRReference` when it resolves a reference. Stores the
+        resolved reference in the receiver's `_resolved` dictionary.
+        
+        :param refid: The id of the resource that was resolved
+        :param resolved: The resolved resource, ready to be cached
+        """
+        if self._resolved is not None:
+            self._resolved[refid] = resolved
+        else:
+            self._resolved = {refid: resolved}
 
@@ -12,7 +12,12 @@ class FHIRAbstractResource(fhirabstractbase.FHIRAbstractBase):
     """
     resource_type = 'FHIRAbstractResource'
     
-    def __init__(self, jsondict=None, strict=True):
+    __slots__ = ('_server',)
+    
+    id = fhirabstractbase._IndexedKey('id')
+    """ Contained resources are indexed by their `id`. """
+    
+    def __init__(self, jsondict=None, strict=True, **kwargs):
         self._server = None
         """ The server the instance was read from. """
         
@@ -22,10 +27,10 @@ class FHIRAbstractResource(fhirabstractbase.FHIRAbstractBase):
             raise Exception("Attempting to instantiate {} with resource data that defines a resourceType of \"{}\""
                 .format(self.__class__, jsondict['resourceType']))
         
-        super(FHIRAbstractResource, self).__init__(jsondict=jsondict, strict=strict)
+        super(FHIRAbstractResource, self).__init__(jsondict=jsondict, strict=strict, **kwargs)
     
     @classmethod
-    def _with_json_dict(cls, jsondict):
+    def _with_json_dict(cls, jsondict, lazy=False, elements=None, trusted=False):
         """ Overridden to use a factory if called when "resourceType" is
         defined in the JSON but does not match the receiver's resource_type.
         """
@@ -35,14 +40,34 @@ class FHIRAbstractResource(fhirabstractbase.FHIRAbstractBase):
         
         res_type = jsondict.get('resourceType')
         if res_type and res_type != cls.resource_type:
-            return fhirelementfactory.FHIRElementFactory.instantiate(res_type, jsondict)
-        return super(FHIRAbstractResource, cls)._with_json_dict(jsondict)
+            return fhirelementfactory.FHIRElementFactory.instantiate(res_type, jsondict, lazy=lazy, elements=elements,
+                trusted=trusted)
+        return super(FHIRAbstractResource, cls)._with_json_dict(jsondict, lazy=lazy, elements=elements, trusted=trusted)
+    
+    @classmethod
+    def _class_for_json(cls, jsondict):
+        """ Overridden to use the factory's class for the "resourceType"
+        defined in the JSON, like `_with_json_dict()` does.
+        """
+        res_type = jsondict.get('resourceType')
+        if res_type and res_type != cls.resource_type:
+            return fhirelementfactory.FHIRElementFactory.element_class(res_type)
+        return cls
     
-    def as_json(self):
-        js = super(FHIRAbstractResource, self).as_json()
+    def _prepare_lazy(self, jsondict):
+        self._server = None
+        super(FHIRAbstractResource, self)._prepare_lazy(jsondict)
+    
+    def as_json(self, trusted=False):
+        js = super(FHIRAbstractResource, self).as_json(trusted=trusted)
         js['resourceType'] = self.resource_type
         return js
     
+    def _write_json_members(self, writer, sep):
+        errs, sep = super(FHIRAbstractResource, self)._write_json_members(writer, sep)
+        writer.parts.append(sep + '"resourceType"' + writer.key_separator + writer.encode_str(self.resource_type))
+        return errs, writer.item_separator
+    
     
     # MARK: Handling Paths
     
@@ -67,37 +92,44 @@ class FHIRAbstractResource(fhirabstractbase.FHIRAbstractBase):
         return self._server
     
     @classmethod
-    def read(cls, rem_id, server):
+    def read(cls, rem_id, server, cache=None):
         """ Read the resource with the given id from the given server. The
         passed-in server instance must support a `request_json()` method call,
         taking a relative path as first (and only mandatory) argument.
         
         :param str rem_id: The id of the resource on the remote server
         :param FHIRServer server: An instance of a FHIR server or compatible class
+        :param FHIRReadCache cache: An optional cache to read through
         :returns: An instance of the receiving class
         """
         if not rem_id:
             raise Exception("Cannot read resource without remote id")
         
         path = '{}/{}'.format(cls.resource_type, rem_id)
-        instance = cls.read_from(path, server)
+        instance = cls.read_from(path, server, cache=cache)
         instance._local_id = rem_id
         
         return instance
     
     @classmethod
-    def read_from(cls, path, server):
+    def read_from(cls, path, server, cache=None):
         """ Requests data from the given REST path on the server and creates
         an instance of the receiving class.
         
+        With a `cache`, the instance may come from the cache and be shared
+        with other readers, see `FHIRReadCache`.
+        
         :param str path: The REST path to read from
         :param FHIRServer server: An instance of a FHIR server or compatible class
+        :param FHIRReadCache cache: An optional cache to read through
         :returns: An instance of the receiving class
         """
         if not path:
             raise Exception("Cannot read resource without REST path")
         if server is None:
             raise Exception("Cannot read resource without server instance")
+        if cache is not None:
+            return cache.read(cls, path, server)
         
         ret = server.request_json(path)
         instance = cls(jsondict=ret)
@@ -141,6 +173,35 @@ class FHIRAbstractResource(fhirabstractbase.FHIRAbstractBase):
             return ret.json()
         return None
     
+    def patch(self, original, server=None):
+        """ Update the receiver's representation on the given server, issuing
+        a PATCH command with the JSON Patch operations that turn `original`
+        into the receiver, see `diff()`. Nothing is sent if there are none.
+        
+        The server must support a `patch_json()` method call, taking a
+        relative path and the list of operations, which it sends as
+        "application/json-patch+json".
+        
+        :param original: The receiver as the server has it, like a copy made
+            with `copy.deepcopy()` when it was read
+        :param FHIRServer server: The server to update the receiver on;
+            optional, will use the instance's `server` if needed.
+        :returns: None or the response JSON on success
+        """
+        srv = server or self.server
+        if srv is None:
+            raise Exception("Cannot update a resource that does not have a server")
+        if not self.id:
+            raise Exception("Cannot update a resource that does not have an id")
+        
+        ops = original.diff(self)
+        if len(ops) == 0:
+            return None
+        ret = srv.patch_json(self.relativePath(), ops)
+        if len(ret.text) > 0:
+            return ret.json()
+        return None
+    
     def delete(self):
         """ Delete the receiver from the given server with a DELETE command.
         
@@ -155,6 +216,123 @@ class FHIRAbstractResource(fhirabstractbase.FHIRAbstractBase):
         if len(ret.text) > 0:
             return ret.json()
         return None
+    
+    
+    # MARK: - Asynchronous Server Connection
+    #
+    # These methods work with servers implementing the asynchronous server
+    # protocol: the same methods as `FHIRServer`, but as coroutines. Like with
+    # `FHIRServer`, `request_json()` returns the decoded JSON while
+    # `post_json()`, `put_json()`, `patch_json()` and `delete_json()` return
+    # a response with a `text` attribute and a `json()` method, as those of
+    # `httpx` do.
+    
+    @classmethod
+    async def aread(cls, rem_id, server):
+        """ Asynchronous `read()`.
+        
+        :param str rem_id: The id of the resource on the remote server
+        :param server: An instance of an asynchronous FHIR server
+        :returns: An instance of the receiving class
+        """
+        if not rem_id:
+            raise Exception("Cannot read resource without remote id")
+        
+        path = '{}/{}'.format(cls.resource_type, rem_id)
+        instance = await cls.aread_from(path, server)
+        instance._local_id = rem_id
+        
+        return instance
+    
+    @classmethod
+    async def aread_from(cls, path, server):
+        """ Asynchronous `read_from()`.
+        
+        :param str path: The REST path to read from
+        :param server: An instance of an asynchronous FHIR server
+        :returns: An instance of the receiving class
+        """
+        if not path:
+            raise Exception("Cannot read resource without REST path")
+        if server is None:
+            raise Exception("Cannot read resource without server instance")
+        
+        ret = await server.request_json(path)
+        instance = cls(jsondict=ret)
+        instance._server = server
+        return instance
+    
+    async def acreate(self, server):
+        """ Asynchronous `create()`.
+        
+        :param server: The asynchronous server to create the receiver on
+        :returns: None or the response JSON on success
+        """
+        srv = server or self.server
+        if srv is None:
+            raise Exception("Cannot create a resource without a server")
+        if self.id:
+            raise Exception("This resource already has an id, cannot create")
+        
+        ret = await srv.post_json(self.relativeBase(), self.as_json())
+        if len(ret.text) > 0:
+            return ret.json()
+        return None
+    
+    async def aupdate(self, server=None):
+        """ Asynchronous `update()`.
+        
+        :param server: The asynchronous server to update the receiver on;
+            optional, will use the instance's `server` if needed.
+        :returns: None or the response JSON on success
+        """
+        srv = server or self.server
+        if srv is None:
+            raise Exception("Cannot update a resource that does not have a server")
+        if not self.id:
+            raise Exception("Cannot update a resource that does not have an id")
+        
+        ret = await srv.put_json(self.relativePath(), self.as_json())
+        if len(ret.text) > 0:
+            return ret.json()
+        return None
+    
+    async def apatch(self, original, server=None):
+        """ Asynchronous `patch()`.
+        
+        :param original: The receiver as the server has it
+        :param server: The asynchronous server to update the receiver on;
+            optional, will use the instance's `server` if needed.
+        :returns: None or the response JSON on success
+        """
+        srv = server or self.server
+        if srv is None:
+            raise Exception("Cannot update a resource that does not have a server")
+        if not self.id:
+            raise Exception("Cannot update a resource that does not have an id")
+        
+        ops = original.diff(self)
+        if len(ops) == 0:
+            return None
+        ret = await srv.patch_json(self.relativePath(), ops)
+        if len(ret.text) > 0:
+            return ret.json()
+        return None
+    
+    async def adelete(self):
+        """ Asynchronous `delete()`.
+        
+        :returns: None or the response JSON on success
+        """
+        if self.server is None:
+            raise Exception("Cannot delete a resource that does not have a server")
+        if not self.id:
+            raise Exception("Cannot delete a resource that does not have an id")
+        
+        ret = await self.server.delete_json(self.relativePath())
+        if len(ret.text) > 0:
+            return ret.json()
+        return None
 
 
 from . import fhirelementfactory
@@ -0,0 +1,624 @@
+"""Work with resources in bulk: NDJSON files, large Bundles, paged searches and batch requests."""
+# 2024, SMART Health IT.
+
+import asyncio
+import codecs
+import collections
+import concurrent.futures
+import json
+import queue
+import re
+import threading
+import uuid
+from typing import IO, AsyncIterator, Iterable, Iterator, List, Optional, Union
+
+from . import fhirelementfactory
+from .fhirabstractbase import FHIRJSONWriter, FHIRValidationError
+
+
+NDJSONResult = collections.namedtuple('NDJSONResult', ['line', 'resource', 'error'])
+NDJSONResult.__doc__ = """
+One line of an NDJSON file: the 1-based line number and either the resource
+instantiated from it or the error that prevented instantiation.
+"""
+
+BundleWriteResult = collections.namedtuple('BundleWriteResult', ['resource', 'status', 'id', 'error'])
+BundleWriteResult.__doc__ = """
+The outcome of writing one resource with `write_bundles()`: the resource, the
+HTTP status and the id the server reported for it, and the error if writing
+the resource failed.
+"""
+
+
+def iter_ndjson(source: Union[str, Iterable],
+                processes: int = 0,
+                chunk_size: int = 1000,
+                ordered: bool = True,
+                lazy: bool = False,
+                elements: Optional[Iterable[str]] = None) -> Iterator[NDJSONResult]:
+    """
+    Streams resources from NDJSON, as produced by FHIR Bulk Data exports.
+
+    Lines are read as needed and each one is decoded and dispatched through
+    `FHIRElementFactory.instantiate()` by its "resourceType". Blank lines are skipped.
+    Lines that can't be instantiated don't stop loading: their error is reported in the
+    result instead.
+
+    With `processes`, chunks of `chunk_size` lines are decoded and validated in a pool of
+    worker processes. At most two chunks per process are in flight, so memory stays bounded
+    no matter how large the input is. Results come back in input order unless `ordered` is
+    False, in which case chunks are yielded as soon as they are done.
+
+    :param source: A file path, or an iterable of lines such as a file opened in binary mode
+    :param processes: Number of worker processes; 0 (the default) loads in this process
+    :param chunk_size: Number of lines handed to a worker process at a time
+    :param ordered: Whether to yield results in input order when using worker processes
+    :param lazy: Whether to create lazy instances, see `FHIRAbstractBase.with_json()`
+    :param elements: Optional element paths to restrict instantiation to
+    :returns: A generator of `NDJSONResult`, one per non-blank line
+    """
+    if elements is not None:
+        elements = frozenset(elements)
+
+    if isinstance(source, str):
+        with open(source, 'rb') as handle:
+            yield from iter_ndjson(handle, processes, chunk_size, ordered, lazy, elements)
+        return
+
+    chunks = _chunked(source, chunk_size)
+    if not processes:
+        for chunk in chunks:
+            yield from _load_chunk(chunk, lazy, elements)
+        return
+
+    max_pending = 2 * processes
+    with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as pool:
+        pending = collections.deque()
+        try:
+            for chunk in chunks:
+                pending.append(pool.submit(_load_chunk, chunk, lazy, elements))
+                if len(pending) < max_pending:
+                    continue
+                if ordered:
+                    yield from pending.popleft().result()
+                else:
+                    done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        pending.remove(future)
+                        yield from future.result()
+
+            futures = pending if ordered else concurrent.futures.as_completed(list(pending))
+            for future in futures:
+                yield from future.result()
+            pending.clear()
+        finally:
+            # The caller stopped iterating (or something failed): don't work on chunks nobody reads
+            for future in pending:
+                future.cancel()
+
+
+def load_ndjson_line(line: Union[str, bytes], lazy: bool = False, elements: Optional[frozenset] = None):
+    """
+    Instantiates the resource in one NDJSON line.
+
+    :raises: ValueError if the line is not a JSON object with a "resourceType"
+    :raises: FHIRValidationError if instantiation fails
+    :returns: The resource instance
+    """
+    jsondict = json.loads(line)
+    if not isinstance(jsondict, dict) or not jsondict.get('resourceType'):
+        raise ValueError("Expecting a JSON object with a \"resourceType\"")
+    return fhirelementfactory.FHIRElementFactory.instantiate(jsondict['resourceType'], jsondict,
+                                                             lazy=lazy, elements=elements)
+
+
+def _chunked(lines: Iterable, chunk_size: int) -> Iterator[List[tuple]]:
+    """Groups lines into lists of (line number, line) tuples, skipping blank lines."""
+    chunk = []
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        chunk.append((number, line))
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _load_chunk(chunk: List[tuple], lazy: bool, elements: Optional[frozenset]) -> List[NDJSONResult]:
+    """Instantiates all (line number, line) tuples of a chunk; runs in worker processes, too."""
+    results = []
+    for number, line in chunk:
+        try:
+            results.append(NDJSONResult(number, load_ndjson_line(line, lazy, elements), None))
+        except Exception as e:
+            results.append(NDJSONResult(number, None, e))
+    return results
+
+
+def write_ndjson(resources: Iterable, destination: Union[str, IO], ensure_ascii: bool = True) -> int:
+    """
+    Writes resources as NDJSON, one compact JSON object per line.
+
+    Resources are serialized one at a time with `FHIRAbstractBase.write_json()`, so neither
+    their JSON dictionaries nor the whole output are held in memory. A resource that fails
+    validation stops writing with its error, prefixed with its 1-based line number; lines
+    written before it are complete and nothing of the invalid resource is written.
+
+    :param resources: An iterable of resource instances, such as a generator
+    :param destination: A file path, or a file opened in text mode
+    :param ensure_ascii: Whether to escape non-ASCII characters
+    :raises: FHIRValidationError if a resource fails validation
+    :returns: The number of lines written
+    """
+    if isinstance(destination, str):
+        with open(destination, 'w', encoding='utf-8', newline='\n') as handle:
+            return write_ndjson(resources, handle, ensure_ascii)
+
+    writer = FHIRJSONWriter(destination, separators=(',', ':'), ensure_ascii=ensure_ascii)
+    writer.buffer_size = float('inf')   # only flush complete lines
+    count = 0
+    for resource in resources:
+        start = len(writer.parts)
+        try:
+            resource._write_json(writer)
+        except FHIRValidationError as e:
+            del writer.parts[start:]
+            writer.flush()
+            raise e.prefixed('line {}'.format(count + 1)) from None
+        writer.parts.append('\n')
+        count += 1
+        if len(writer.parts) >= FHIRJSONWriter.buffer_size:
+            writer.flush()
+    writer.flush()
+    return count
+
+
+class BundleEntryReader:
+    """
+    Reads the entries of a Bundle one at a time, without decoding the whole document.
+
+    Meant for Bundles too large to hold in memory at once, like big transaction Bundles.
+    Iterating the reader yields a `BundleEntry` instance for each item in "entry", with its
+    `fullUrl`, `request` and `response` and with its `resource` dispatched through
+    `FHIRElementFactory`, just like when instantiating the whole Bundle. Only one entry is
+    decoded at a time.
+
+    The Bundle's other top-level properties are collected in `bundle_json` as they are
+    encountered; they are complete once iteration finishes. Entries are not attached to a
+    Bundle instance, so their `owningBundle()` is None.
+
+    Public properties:
+    - `bundle_json`: dict of the Bundle's JSON properties other than "entry"
+    """
+
+    def __init__(self, source: Union[str, IO], lazy: bool = False, elements: Optional[Iterable[str]] = None,
+                 chunk_size: int = 65536):
+        """
+        :param source: A file path, or a file opened in binary or text mode
+        :param lazy: Whether to create lazy instances, see `FHIRAbstractBase.with_json()`
+        :param elements: Optional element paths, relative to the entry (e.g.
+            "resource.Observation.code"), to restrict instantiation to
+        :param chunk_size: Number of bytes (or characters) to read at a time
+        """
+        self.bundle_json = {}
+        self._source = source
+        self._lazy = lazy
+        self._elements = frozenset(elements) if elements is not None else None
+        self._chunk_size = chunk_size
+
+    def __iter__(self) -> Iterator:
+        if isinstance(self._source, str):
+            with open(self._source, 'rb') as handle:
+                yield from self._entries(_JSONStream(handle, self._chunk_size))
+        else:
+            yield from self._entries(_JSONStream(self._source, self._chunk_size))
+
+    def _entries(self, stream: '_JSONStream') -> Iterator:
+        from . import bundle
+
+        stream.expect('{')
+        if stream.peek() == '}':
+            return
+        while True:
+            key = stream.value()
+            if not isinstance(key, str):
+                raise ValueError("Expecting a property name at position {}".format(stream.position))
+            stream.expect(':')
+
+            if key == 'entry':
+                stream.expect('[')
+                index = 0
+                if stream.peek() == ']':
+                    stream.expect(']')
+                else:
+                    while True:
+                        jsondict = stream.value()
+                        try:
+                            entry = bundle.BundleEntry.with_json(jsondict, lazy=self._lazy, elements=self._elements)
+                        except FHIRValidationError as e:
+                            raise e.prefixed(str(index)).prefixed('entry')
+                        yield entry
+                        index += 1
+                        if stream.expect(',]') == ']':
+                            break
+            else:
+                value = stream.value()
+                if key == 'resourceType' and value != 'Bundle':
+                    raise ValueError("Expecting a Bundle, but got a resource of type \"{}\"".format(value))
+                self.bundle_json[key] = value
+
+            if stream.expect(',}') == '}':
+                break
+
+
+def iter_bundle_entries(source: Union[str, IO], lazy: bool = False,
+                        elements: Optional[Iterable[str]] = None) -> Iterator:
+    """
+    Yields the entries of a Bundle one at a time, see `BundleEntryReader`.
+
+    :param source: A file path, or a file opened in binary or text mode
+    :param lazy: Whether to create lazy instances, see `FHIRAbstractBase.with_json()`
+    :param elements: Optional element paths, relative to the entry, to restrict instantiation to
+    :returns: A generator of `BundleEntry` instances
+    """
+    return iter(BundleEntryReader(source, lazy=lazy, elements=elements))
+
+
+def iter_search(server, path: str, prefetch: int = 1, lazy: bool = False,
+                elements: Optional[Iterable[str]] = None) -> Iterator:
+    """
+    Yields the resources of all pages of search results, following the "next" links of the
+    searchset Bundles.
+
+    Pages are requested with `server.request_json()`. While the resources of one page are
+    consumed, a background thread already requests up to `prefetch` following pages, so the
+    caller doesn't wait at page boundaries. When the caller stops iterating, no further pages
+    are requested. Resources are dispatched through `FHIRElementFactory` by "resourceType".
+
+    :param server: An instance of a FHIR server or compatible class
+    :param path: The search path, like "Patient?birthdate=ge2000-01-01"
+    :param prefetch: Number of pages to request ahead; 0 requests each page when needed
+    :param lazy: Whether to create lazy instances, see `FHIRAbstractBase.with_json()`
+    :param elements: Optional element paths to restrict instantiation to
+    :returns: A generator of resource instances
+    """
+    if elements is not None:
+        elements = frozenset(elements)
+
+    if prefetch <= 0:
+        url = path
+        while url:
+            page = server.request_json(url)
+            yield from _page_resources(page, server, lazy, elements)
+            url = _next_page_url(page)
+        return
+
+    pages = queue.Queue(maxsize=prefetch)
+    stop = threading.Event()
+
+    def put(item) -> bool:
+        # wait for room in the queue, unless the caller stopped iterating
+        while not stop.is_set():
+            try:
+                pages.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def fetch_pages():
+        url = path
+        try:
+            while url and not stop.is_set():
+                page = server.request_json(url)
+                if not put((page, None)):
+                    return
+                url = _next_page_url(page)
+        except Exception as e:
+            put((None, e))
+            return
+        put((None, None))
+
+    threading.Thread(target=fetch_pages, daemon=True).start()
+    try:
+        while True:
+            page, error = pages.get()
+            if error is not None:
+                raise error
+            if page is None:
+                return
+            yield from _page_resources(page, server, lazy, elements)
+    finally:
+        # the thread stops before the next page, or while waiting for room in the queue
+        stop.set()
+
+
+async def aiter_search(server, path: str, prefetch: int = 1, lazy: bool = False,
+                       elements: Optional[Iterable[str]] = None) -> AsyncIterator:
+    """
+    Asynchronous `iter_search()`, for servers with an awaitable `request_json()`. Following
+    pages are requested by a background task.
+
+    :param server: An instance of an asynchronous FHIR server
+    :param path: The search path, like "Patient?birthdate=ge2000-01-01"
+    :param prefetch: Number of pages to request ahead; 0 requests each page when needed
+    :param lazy: Whether to create lazy instances, see `FHIRAbstractBase.with_json()`
+    :param elements: Optional element paths to restrict instantiation to
+    :returns: An asynchronous generator of resource instances
+    """
+    if elements is not None:
+        elements = frozenset(elements)
+
+    if prefetch <= 0:
+        url = path
+        while url:
+            page = await server.request_json(url)
+            for resource in _page_resources(page, server, lazy, elements):
+                yield resource
+            url = _next_page_url(page)
+        return
+
+    pages = asyncio.Queue(maxsize=prefetch)
+
+    async def fetch_pages():
+        url = path
+        try:
+            while url:
+                page = await server.request_json(url)
+                await pages.put((page, None))
+                url = _next_page_url(page)
+        except Exception as e:
+            await pages.put((None, e))
+            return
+        await pages.put((None, None))
+
+    task = asyncio.ensure_future(fetch_pages())
+    try:
+        while True:
+            page, error = await pages.get()
+            if error is not None:
+                raise error
+            if page is None:
+                return
+            for resource in _page_resources(page, server, lazy, elements):
+                yield resource
+    finally:
+        task.cancel()
+
+
+def _page_resources(page: dict, server, lazy: bool, elements: Optional[frozenset]) -> Iterator:
+    """Instantiates the resources in the entries of a searchset Bundle."""
+    for entry in page.get('entry') or []:
+        jsondict = entry.get('resource')
+        if jsondict is None:
+            continue
+        resource = fhirelementfactory.FHIRElementFactory.instantiate(jsondict.get('resourceType'), jsondict,
+                                                                     lazy=lazy, elements=elements)
+        resource._server = server
+        yield resource
+
+
+def _next_page_url(page: dict) -> Optional[str]:
+    """Returns the URL of the "next" link of a searchset Bundle, if any."""
+    for link in page.get('link') or []:
+        if link.get('relation') == 'next':
+            return link.get('url')
+    return None
+
+
+def write_bundles(resources: Iterable,
+                  server,
+                  bundle_type: str = 'batch',
+                  chunk_size: int = 100,
+                  workers: int = 0) -> Iterator[BundleWriteResult]:
+    """
+    Creates and updates resources on a server with batch or transaction Bundles.
+
+    Resources with an id are updated with PUT, others are created with POST. Resources are
+    packed into Bundles of up to `chunk_size` entries, which are posted to the server's base
+    URL, and the entries of the response Bundles are mapped back to their resources. Resources
+    that fail validation are reported without being sent; in a transaction, the other
+    resources of their Bundle aren't sent either. If posting a Bundle fails, as a transaction
+    does as a whole when one of its entries fails, all of its resources report the error.
+
+    With `workers`, Bundles are posted from a pool of that many threads. At most two Bundles
+    per thread are in flight; results are still yielded in input order.
+
+    :param resources: An iterable of resource instances
+    :param server: A server instance with a `post_json()` method, like `FHIRServer`
+    :param bundle_type: "batch" or "transaction"
+    :param chunk_size: Maximum number of entries per Bundle
+    :param workers: Number of threads posting Bundles; 0 (the default) posts one at a time
+    :returns: A generator of `BundleWriteResult`, one per resource
+    """
+    if bundle_type not in ('batch', 'transaction'):
+        raise ValueError("Expecting a bundle_type of \"batch\" or \"transaction\", got \"{}\"".format(bundle_type))
+
+    chunks = _bundle_chunks(resources, chunk_size)
+    if not workers:
+        for chunk in chunks:
+            yield from _post_bundle(server, bundle_type, chunk)
+        return
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = collections.deque()
+        try:
+            for chunk in chunks:
+                pending.append(pool.submit(_post_bundle, server, bundle_type, chunk))
+                if len(pending) >= 2 * workers:
+                    yield from pending.popleft().result()
+            while pending:
+                yield from pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+def _bundle_chunks(resources: Iterable, chunk_size: int) -> Iterator[List[tuple]]:
+    """Groups resources into lists of (resource, Bundle entry JSON, error) tuples."""
+    chunk = []
+    for resource in resources:
+        try:
+            if resource.id:
+                request = {'method': 'PUT', 'url': resource.relativePath()}
+                entry = {'resource': resource.as_json(), 'request': request}
+            else:
+                request = {'method': 'POST', 'url': resource.relativeBase()}
+                entry = {'fullUrl': 'urn:uuid:{}'.format(uuid.uuid4()), 'resource': resource.as_json(), 'request': request}
+            chunk.append((resource, entry, None))
+        except FHIRValidationError as e:
+            chunk.append((resource, None, e))
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _post_bundle(server, bundle_type: str, chunk: List[tuple]) -> List[BundleWriteResult]:
+    """Posts the entries of a chunk as one Bundle; runs in worker threads, too."""
+    entries = [entry for _, entry, _ in chunk if entry is not None]
+    response_entries = []
+    failure = None
+    if bundle_type == 'transaction' and len(entries) < len(chunk):
+        # posting the rest would commit part of the transaction
+        entries = []
+        failure = Exception("Not sent, because another resource of the transaction failed validation")
+    if entries:
+        try:
+            ret = server.post_json('', {'resourceType': 'Bundle', 'type': bundle_type, 'entry': entries})
+            response_entries = ret.json().get('entry') or []
+            if len(response_entries) != len(entries):
+                raise Exception("Expecting {} entries in the response Bundle, but got {}"
+                                .format(len(entries), len(response_entries)))
+        except Exception as e:
+            failure = e
+
+    results = []
+    response_entries = iter(response_entries)
+    for resource, entry, error in chunk:
+        if entry is None:
+            results.append(BundleWriteResult(resource, None, None, error))
+        elif failure is not None:
+            results.append(BundleWriteResult(resource, None, None, failure))
+        else:
+            results.append(_entry_result(resource, next(response_entries)))
+    return results
+
+
+def _entry_result(resource, response_entry: dict) -> BundleWriteResult:
+    """Reads status, id and error from an entry of a batch or transaction response Bundle."""
+    response = response_entry.get('response') or {}
+    status = response.get('status') or ''
+    code = status.split(' ', 1)[0]
+    if not code.startswith('2'):
+        issues = (response.get('outcome') or {}).get('issue') or []
+        details = '; '.join(issue.get('diagnostics') or (issue.get('details') or {}).get('text') or issue.get('code', '')
+                            for issue in issues)
+        return BundleWriteResult(resource, status, None, Exception("{}{}".format(status, ': ' + details if details else '')))
+
+    res_id = (response_entry.get('resource') or {}).get('id')
+    location = response.get('location')
+    if res_id is None and location:
+        path = location.split('/_history/', 1)[0].rstrip('/')
+        res_id = path.rsplit('/', 1)[-1]
+    return BundleWriteResult(resource, status, res_id or resource.id, None)
+
+
+class _JSONStream:
+    """
+    Minimal pull parser over a JSON text read from a file, in chunks.
+
+    Callers step through the structure of the document with `expect()` and decode complete
+    values, one at a time, with `value()`. Text before the current position is discarded
+    when more is read, so memory is bounded by the largest single value.
+    """
+
+    _WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+    def __init__(self, handle: IO, chunk_size: int):
+        self._handle = handle
+        self._chunk_size = chunk_size
+        self._decoder = None
+        self._json = json.JSONDecoder()
+        self._buf = ''
+        self._pos = 0
+        self._offset = 0
+        self._eof = False
+
+    @property
+    def position(self) -> int:
+        """The character offset of the current position in the document."""
+        return self._offset + self._pos
+
+    def peek(self) -> str:
+        """Skips whitespace and returns the next character, or '' at the end of the document."""
+        while True:
+            self._pos = self._WHITESPACE.match(self._buf, self._pos).end()
+            if self._pos < len(self._buf):
+                return self._buf[self._pos]
+            if not self._read(self._chunk_size):
+                return ''
+
+    def expect(self, chars: str) -> str:
+        """Consumes the next character, which must be one of `chars`, and returns it."""
+        char = self.peek()
+        if not char or char not in chars:
+            raise ValueError("Expecting one of \"{}\" at position {}, got \"{}\""
+                .format(chars, self.position, char))
+        self._pos += 1
+        return char
+
+    def value(self):
+        """Decodes the complete JSON value at the current position."""
+        self.peek()
+        size = self._chunk_size
+        while True:
+            try:
+                value, end = self._json.raw_decode(self._buf, self._pos)
+            except json.JSONDecodeError as e:
+                # only errors at the end of the buffer can be due to the value continuing
+                # past what we've read so far, others are raised without reading further
+                if not self._is_truncated(e) or not self._read(size):
+                    raise
+                size *= 2
+                continue
+
+            # numbers and literals that end with the buffer may continue in the next chunk
+            if end == len(self._buf) and not self._eof and self._read(size):
+                continue
+            self._pos = end
+            return value
+
+    # the longest text a decoding error can point back from the end of the buffer when the
+    # value is merely cut off: a partial literal like "fals" or escape like "\u12"
+    _TRUNCATION_MARGIN = 6
+
+    def _is_truncated(self, error: json.JSONDecodeError) -> bool:
+        """Whether a decoding error may be caused by the buffer ending within the value."""
+        if error.msg.startswith('Unterminated string'):
+            return True
+        return error.pos >= len(self._buf) - self._TRUNCATION_MARGIN
+
+    def _read(self, size: int) -> bool:
+        """Appends more text to the buffer, dropping what has been consumed. False at the end."""
+        if self._eof:
+            return False
+        data = self._handle.read(size)
+        if isinstance(data, bytes):
+            if self._decoder is None:
+                self._decoder = codecs.getincrementaldecoder('utf-8-sig')()
+            text = self._decoder.decode(data, final=not data)
+        else:
+            text = data
+            if self._offset == 0 and self._pos == 0 and not self._buf:
+                text = text.lstrip('\ufeff')
+        if not data:
+            self._eof = True
+
+        self._offset += self._pos
+        self._buf = self._buf[self._pos:] + text
+        self._pos = 0
+        return bool(data)
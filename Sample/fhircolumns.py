@@ -0,0 +1,158 @@
+"""Extract columns of values from many resources at once, for analytics."""
+# 2024, SMART Health IT.
+
+import collections
+import re
+from typing import Dict, Iterable, Sequence
+
+from .fhirabstractbase import FHIRAbstractBase
+
+
+FHIRColumn = collections.namedtuple('FHIRColumn', ['values', 'mask'])
+FHIRColumn.__doc__ = """
+One extracted column: the values, one per row, and a mask that is True where a row has a
+value. Rows without a value hold None, or a fill value in NumPy arrays.
+"""
+
+_STEP = re.compile(r"([A-Za-z0-9_]+)(?:\[([0-9]+)\])?")
+
+# the classes of JSON values accepted for elements of a Python type; strings for all others
+_JSON_TYPES = {bool: (bool,), int: (int,), float: (int, float)}
+
+# dtypes and fill values for rows without a value, in NumPy output
+_NUMPY_COLUMNS = {bool: ('bool', False), int: ('int64', 0), float: ('float64', float('nan'))}
+
+
+class FHIRColumnExtractor:
+    """
+    Extracts columns of values, selected by element paths, from many instances of a class
+    or from their JSON dictionaries.
+
+    Paths are dotted JSON names, like "code.coding.code" or "valueQuantity.value", and may
+    start with the resource type. Where a path steps into a list, the first item is used;
+    append an index, as in "code.coding[1].code", to use another one. Paths are checked
+    against the classes' `elementProperties()` once, when the extractor is created, and
+    must end at a primitive element, like a string, number, boolean or date.
+
+    Dates, dateTimes, instants and times are parsed with their class' `parse_many()`,
+    also when extracted from instances. In JSON dictionaries, values not of the element's
+    type count as missing; JSON data isn't validated otherwise.
+    """
+
+    def __init__(self, klass, paths: Iterable[str]):
+        """
+        :raises: ValueError if a path doesn't name a primitive element of the class
+        :param klass: The FHIRAbstractBase subclass of the instances to extract from
+        :param paths: The element paths of the columns
+        """
+        self.klass = klass
+        self.paths = tuple(paths)
+        self._plans = [self._plan(path) for path in self.paths]
+
+    def extract(self, items: Iterable, as_numpy: bool = False) -> Dict[str, FHIRColumn]:
+        """
+        Extracts the columns from instances of the extractor's class, or from their JSON
+        dictionaries.
+
+        With `as_numpy`, values are returned as NumPy arrays: bool, int64 and float64 for
+        booleans, integers and decimals, datetime64 or timedelta64 for dates and times (see
+        `parse_many()`), and object arrays for strings. Masks are bool arrays. Rows without
+        a value hold False, 0, NaN, NaT or None.
+
+        :param items: Instances of the extractor's class or JSON dictionaries, one per row
+        :param as_numpy: Whether to return NumPy arrays; needs NumPy to be installed
+        :returns: A dictionary of FHIRColumn named tuples, by path
+        """
+        if not isinstance(items, Sequence):
+            items = list(items)
+        return {path: self._column(plan, items, as_numpy) for path, plan in zip(self.paths, self._plans)}
+
+    def _plan(self, path: str):
+        """
+        Resolves an element path into the steps to walk for JSON dictionaries and for
+        instances, as (key, index) tuples with index None for non-list elements, and the
+        type of the final element.
+        """
+        klass = self.klass
+        names = path.split('.')
+        if names[0] == getattr(klass, 'resource_type', None) and len(names) > 1:
+            names = names[1:]
+
+        json_steps = []
+        attr_steps = []
+        typ = klass
+        for step in names:
+            match = _STEP.fullmatch(step)
+            if not isinstance(typ, type) or not issubclass(typ, FHIRAbstractBase) or match is None:
+                raise ValueError("Invalid element path \"{}\" for {}".format(path, klass.__name__))
+            prop = typ.elementTable().by_jsname.get(match.group(1))
+            if prop is None:
+                raise ValueError("{} has no element \"{}\", in path \"{}\""
+                    .format(typ.__name__, match.group(1), path))
+            name, jsname, typ, is_list, of_many, not_optional = prop
+            index = int(match.group(2) or 0) if is_list else None
+            json_steps.append((jsname, index))
+            attr_steps.append((name, index))
+
+        if isinstance(typ, type) and issubclass(typ, FHIRAbstractBase):
+            raise ValueError("Element path \"{}\" for {} doesn't end at a primitive element"
+                .format(path, klass.__name__))
+        return tuple(json_steps), tuple(attr_steps), typ
+
+    def _column(self, plan, items: Sequence, as_numpy: bool) -> FHIRColumn:
+        json_steps, attr_steps, typ = plan
+        parse_many = getattr(typ, 'parse_many', None)
+        json_types = _JSON_TYPES.get(typ, (str,))
+
+        values = []
+        for item in items:
+            value = item
+            if item.__class__ is dict:
+                for key, index in json_steps:
+                    value = value.get(key) if value.__class__ is dict else None
+                    if index is not None and value is not None:
+                        value = value[index] if value.__class__ is list and index < len(value) else None
+                    if value is None:
+                        break
+                else:
+                    if value.__class__ not in json_types:
+                        value = None
+            else:
+                for name, index in attr_steps:
+                    value = getattr(value, name)
+                    if index is not None and value is not None:
+                        value = value[index] if index < len(value) else None
+                    if value is None:
+                        break
+                else:
+                    if parse_many is not None:
+                        value = value.as_json()
+            values.append(value)
+
+        if parse_many is not None:
+            return FHIRColumn(*parse_many(values, as_numpy=as_numpy))
+        if not as_numpy:
+            return FHIRColumn(values, [value is not None for value in values])
+
+        import numpy
+        mask = numpy.array([value is not None for value in values], dtype=bool)
+        dtype, fill = _NUMPY_COLUMNS.get(typ, (object, None))
+        if fill is not None:
+            values = [fill if value is None else value for value in values]
+        return FHIRColumn(numpy.array(values, dtype=dtype), mask)
+
+
+def extract_columns(klass, paths: Iterable[str], items: Iterable, as_numpy: bool = False) -> Dict[str, FHIRColumn]:
+    """
+    Extracts columns of values, selected by element paths, from many instances of a class
+    or from their JSON dictionaries; see `FHIRColumnExtractor`, which saves checking the
+    paths again when extracting from several batches.
+
+    :raises: ValueError if a path doesn't name a primitive element of the class
+    :param klass: The FHIRAbstractBase subclass of the instances to extract from
+    :param paths: The element paths of the columns
+    :param items: Instances of the class or JSON dictionaries, one per row
+    :param as_numpy: Whether to return NumPy arrays; needs NumPy to be installed
+    :returns: A dictionary of FHIRColumn named tuples, by path
+    """
+    return FHIRColumnExtractor(klass, paths).extract(items, as_numpy=as_numpy)
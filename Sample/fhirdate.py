@@ -2,10 +2,9 @@
 # 2024, SMART Health IT.
 
 import datetime
-import re
 from typing import Any, Union
 
-from ._dateutils import _FHIRDateTimeMixin
+from ._dateutils import _FHIRDateTimeMixin, _compile_spec_regex
 
 
 class FHIRDate(_FHIRDateTimeMixin):
@@ -29,18 +28,17 @@ class FHIRDate(_FHIRDateTimeMixin):
 
     Public methods:
     - `as_json`: returns the original JSON used to construct the instance
+    - `parse_many`: class method parsing many JSON strings at once, returning a validity mask
     """
 
-    def __init__(self, jsonval: Union[str, None] = None):
-        self.date: Union[datetime.date, None] = None
-        super().__init__(jsonval)
+    date = _FHIRDateTimeMixin._value_property("datetime.date representing the JSON value")
 
     ##################################
     # Private properties and methods #
     ##################################
 
     # Pulled from spec for date
-    _REGEX = re.compile(r"([0-9]([0-9]([0-9][1-9]|[1-9]0)|[1-9]00)|[1-9]000)(-(0[1-9]|1[0-2])(-(0[1-9]|[1-2][0-9]|3[0-1]))?)?")
+    _REGEX = _compile_spec_regex(r"([0-9]([0-9]([0-9][1-9]|[1-9]0)|[1-9]00)|[1-9]000)(-(0[1-9]|1[0-2])(-(0[1-9]|[1-2][0-9]|3[0-1]))?)?")
     _FIELD = "date"
 
     @classmethod
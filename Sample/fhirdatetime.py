@@ -2,10 +2,9 @@
 # 2024, SMART Health IT.
 
 import datetime
-import re
 from typing import Any, Union
 
-from ._dateutils import _FHIRDateTimeMixin
+from ._dateutils import _FHIRDateTimeMixin, _compile_spec_regex
 
 
 class FHIRDateTime(_FHIRDateTimeMixin):
@@ -32,18 +31,17 @@ class FHIRDateTime(_FHIRDateTimeMixin):
 
     Public methods:
     - `as_json`: returns the original JSON used to construct the instance
+    - `parse_many`: class method parsing many JSON strings at once, returning a validity mask
     """
 
-    def __init__(self, jsonval: Union[str, None] = None):
-        self.datetime: Union[datetime.datetime, None] = None
-        super().__init__(jsonval)
+    datetime = _FHIRDateTimeMixin._value_property("datetime.datetime representing the JSON value (naive or aware)")
 
     ##################################
     # Private properties and methods #
     ##################################
 
     # Pulled from spec for datetime
-    _REGEX = re.compile(r"([0-9]([0-9]([0-9][1-9]|[1-9]0)|[1-9]00)|[1-9]000)(-(0[1-9]|1[0-2])(-(0[1-9]|[1-2][0-9]|3[0-1])(T([01][0-9]|2[0-3]):[0-5][0-9]:([0-5][0-9]|60)(\.[0-9]+)?(Z|(\+|-)((0[0-9]|1[0-3]):[0-5][0-9]|14:00)))?)?)?")
+    _REGEX = _compile_spec_regex(r"([0-9]([0-9]([0-9][1-9]|[1-9]0)|[1-9]00)|[1-9]000)(-(0[1-9]|1[0-2])(-(0[1-9]|[1-2][0-9]|3[0-1])(T([01][0-9]|2[0-3]):[0-5][0-9]:([0-5][0-9]|60)(\.[0-9]+)?(Z|(\+|-)((0[0-9]|1[0-3]):[0-5][0-9]|14:00)))?)?)?")
     _FIELD = "datetime"
 
     @classmethod
@@ -0,0 +1,265 @@
+"""Share repeated strings, parsed dates and element subtrees between instances created from JSON."""
+# 2024, SMART Health IT.
+
+import contextlib
+import sys
+from typing import Iterable, Iterator, Optional
+
+from .fhirabstractbase import FHIRAbstractBase
+from ._dateutils import _FHIRDateTimeMixin
+
+
+class FHIRInternTable:
+    """
+    Maps strings and parsed date values to one shared copy each.
+
+    Bulk data repeats the same systems, codes, statuses and timestamps over and over; every
+    occurrence decodes to a new string and, for dates, to a new parsed value. While a table
+    is installed with `interning()`, `update_with_json()` replaces the string properties it
+    sets with the table's copies, and date instances share the original JSON string and the
+    parsed `datetime`, `date` or `time`, skipping parsing for values seen before. Instances
+    themselves are not shared, so changing one never affects another.
+
+    Elements of the classes given as `shared_types`, like Coding, CodeableConcept or
+    Quantity, are hash-consed as well: an element of the same class holding the same values
+    as one created before is replaced by the first one. Only elements whose child elements,
+    if any, are shared themselves can be shared, so list the classes of child elements too;
+    as children are shared first, a parent is shared from its third occurrence on.
+
+    When first seen, only an element's values are remembered, so the table doesn't keep the
+    element, nor the resource owning it, alive; the element stays private to its owner. The
+    second equal element becomes the shared copy that later ones are replaced by: it is made
+    read-only and has no owner, and setting a property on it raises an AttributeError. To
+    change one, replace it with a private copy made by `unshared()`, as in
+    `obs.code = unshared(obs.code)`. Lists of a shared element aren't protected, so don't
+    change them in place either. Only list classes whose instances don't need their owner;
+    references, for example, use it to find contained resources.
+
+    The table holds at most `maxsize` values, so interning a stream of unique values costs a
+    bounded amount of memory. It approximates LRU eviction with two generations: values go
+    into the current generation, which becomes the old one when it holds half of `maxsize`
+    values, dropping the previous old one. Values found in the old generation move to the
+    current one, so only values not used for a while are dropped.
+
+    `hits` counts values replaced by a shared copy, `misses` values that were added to the
+    table, and `bytes_saved` adds up the sizes of the copies that could be dropped thanks
+    to the hits. Lookups don't take a lock, so with several threads parsing at once, the
+    counters may be slightly off.
+    """
+
+    def __init__(self, maxsize: int = 65536, shared_types: Iterable[type] = ()):
+        """
+        :param maxsize: The maximum number of values kept
+        :param shared_types: The element classes whose instances to share; subclasses must
+            be listed separately
+        """
+        self.maxsize = maxsize
+        self.shared_types = frozenset(shared_types)
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        self._current = {}
+        self._old = {}
+
+    def __len__(self) -> int:
+        return len(self._current.keys() | self._old.keys())
+
+    @property
+    def hit_rate(self) -> float:
+        """The fraction of values that were replaced by a shared copy."""
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def intern(self, value: str) -> str:
+        """
+        Returns the shared copy of a string, adding the string if there is none.
+
+        :param value: The string to intern
+        :returns: An equal string, shared with other callers
+        """
+        shared = self._lookup(value)
+        if shared is None:
+            self.misses += 1
+            self._store(value, value)
+            return value
+        self.bytes_saved += sys.getsizeof(value)
+        return shared
+
+    def parsed(self, klass, value: str):
+        """
+        Returns the shared Python representation of a date or time string, parsing it with
+        `klass` if there is none.
+
+        :raises: ValueError if the string can't be parsed
+        :param klass: The FHIRDate, FHIRDateTime, FHIRInstant or FHIRTime class
+        :param value: The JSON string, already checked against the class' format
+        :returns: The parsed value, shared with other callers
+        """
+        key = (klass, value)
+        shared = self._lookup(key)
+        if shared is None:
+            shared = klass._from_string(value)
+            self.misses += 1
+            self._store(key, shared)
+            return shared
+        self.bytes_saved += sys.getsizeof(shared)
+        return shared
+
+    def share(self, value):
+        """
+        Returns the shared copy of an element of one of the `shared_types`, or a list with
+        the shared copies of such elements, adding elements if there is none. The element's
+        own child elements should have been shared already. An element whose values were
+        seen once before becomes the shared copy, so it is made read-only. Other values are
+        returned as they are.
+
+        :param value: The element or list of elements to share
+        :returns: An equal element or list of elements, shared with other callers
+        """
+        if value.__class__ is list:
+            return [self.share(item) for item in value]
+        if value.__class__ not in self.shared_types:
+            return value
+        key = _subtree_key(value)
+        if key is None:
+            return value
+        shared = self._lookup(key)
+        if shared is None:
+            self.misses += 1
+            self._store(key, _seen_once)
+            return value
+        if shared is _seen_once:
+            # the second equal element becomes the shared copy, not replacing anything
+            self.hits -= 1
+            self.misses += 1
+            _freeze(value)
+            self._store(key, value)
+            return value
+        self.bytes_saved += sys.getsizeof(value) + sys.getsizeof(getattr(value, '__dict__', None))
+        return shared
+
+    def clear(self):
+        """Removes all values from the table and resets the counters."""
+        self._current = {}
+        self._old = {}
+        self.hits = self.misses = self.bytes_saved = 0
+
+    def _lookup(self, key):
+        shared = self._current.get(key)
+        if shared is None:
+            shared = self._old.get(key)
+            if shared is None:
+                return None
+            self._store(key, shared)
+        self.hits += 1
+        return shared
+
+    def _store(self, key, value):
+        current = self._current
+        current[key] = value
+        if len(current) >= max(self.maxsize // 2, 1):
+            self._old = current
+            self._current = {}
+
+
+_seen_once = object()
+"""Stands in for elements whose values were seen once, which the table doesn't keep."""
+
+
+class _Shared:
+    """Marks the read-only classes of elements shared by an intern table."""
+
+    __slots__ = ()
+
+    def __setattr__(self, name, value):
+        raise AttributeError("{} instances shared by an intern table are read-only, change a copy made by "
+                             "`unshared()` instead".format(type(self).__name__))
+
+    def __delattr__(self, name):
+        self.__setattr__(name, None)
+
+    def __reduce_ex__(self, protocol):
+        return unshared(self).__reduce_ex__(protocol)
+
+
+_frozen_classes = {}
+
+
+def _freeze(element):
+    """Makes an element read-only by switching it to a `_Shared` subclass of its class."""
+    klass = element.__class__
+    frozen = _frozen_classes.get(klass)
+    if frozen is None:
+        frozen = type(klass.__name__, (_Shared, klass), {
+            '__slots__': (),
+            '__module__': klass.__module__,
+            '_element_table': klass.elementTable(),
+        })
+        _frozen_classes[klass] = frozen
+    element._owner = None
+    element.__class__ = frozen
+
+
+def _subtree_key(element) -> Optional[tuple]:
+    """
+    Returns a key identifying an element by its class and values, with child elements and
+    other mutable values compared by identity, or None if a value can't be hashed or a
+    child element isn't shared, which would keep equal elements from ever matching.
+    """
+    key = [element.__class__]
+    for name in element.elementTable().by_name:
+        value = getattr(element, name)
+        if value is None:
+            continue
+        if value.__class__ is list:
+            value = tuple(value)
+            if any(isinstance(item, FHIRAbstractBase) and not isinstance(item, _Shared) for item in value):
+                return None
+        elif isinstance(value, FHIRAbstractBase) and not isinstance(value, _Shared):
+            return None
+        key.append((name, value.__class__, value))
+    key = tuple(key)
+    try:
+        hash(key)
+    except TypeError:
+        return None
+    return key
+
+
+def unshared(element):
+    """
+    Returns a private, changeable copy of an element shared by an intern table, or the
+    element itself if it isn't shared. The copy has no owner; its child elements are
+    still shared, and its lists are new lists.
+
+    :param element: The element to copy
+    :returns: An element that can be changed
+    """
+    if not isinstance(element, _Shared):
+        return element
+    copy = element.__class__.__bases__[1]()
+    for name in element.elementTable().by_name:
+        value = getattr(element, name)
+        setattr(copy, name, list(value) if value.__class__ is list else value)
+    return copy
+
+
+@contextlib.contextmanager
+def interning(table: Optional[FHIRInternTable] = None) -> Iterator[FHIRInternTable]:
+    """
+    Installs an intern table for instances created from JSON within the `with` block.
+
+    The table is installed for the whole process, not just the current thread, and the
+    previously installed one is restored on exit.
+
+    :param table: The table to use; a new one is created if None
+    :returns: A context manager providing the installed table
+    """
+    if table is None:
+        table = FHIRInternTable()
+    previous = (FHIRAbstractBase.intern_table, _FHIRDateTimeMixin.intern_table)
+    FHIRAbstractBase.intern_table = _FHIRDateTimeMixin.intern_table = table
+    try:
+        yield table
+    finally:
+        FHIRAbstractBase.intern_table, _FHIRDateTimeMixin.intern_table = previous
@@ -0,0 +1,154 @@
+"""Client-side cache for resources read from a server, revalidated with conditional requests."""
+# 2024, SMART Health IT.
+
+import collections
+import threading
+import time
+from typing import Callable, Optional
+
+
+_FHIR_JSON_MIME_TYPE = 'application/fhir+json'
+
+_CacheEntry = collections.namedtuple('_CacheEntry', ['instance', 'etag', 'last_modified', 'stored'])
+
+
+class FHIRReadError(Exception):
+    """A read through `FHIRReadCache` was answered with an unexpected status."""
+
+    def __init__(self, response):
+        super().__init__("{} reading from the server".format(response.status_code))
+        self.response = response
+
+
+class FHIRReadCache:
+    """
+    Caches resources read with `FHIRAbstractResource.read()` and `read_from()` by their
+    relative path, when passed as their `cache` argument.
+
+    Entries younger than `ttl` seconds are returned without contacting the server. Older
+    entries are revalidated: if the server sent an ETag or Last-Modified header with the
+    resource, it is asked for the resource with If-None-Match or If-Modified-Since, and a
+    "304 Not Modified" answer reuses the cached instance. Otherwise, or if the resource did
+    change, it is read and parsed again. With a `ttl` of None, entries never go stale.
+
+    Conditional requests need a server with a `request_conditional(path, headers)` method,
+    issuing a GET with the given headers added to its usual ones and returning the response,
+    with `status_code`, `headers` and `json()`, without raising for "304 Not Modified". With
+    other servers, stale entries are simply read again with `request_json()`. Answers other
+    than "200 OK" and, for revalidations, "304 Not Modified", raise a `FHIRReadError`, unless
+    the server raised already; if the resource is gone, with "404 Not Found" or "410 Gone",
+    its entry is dropped.
+
+    At most `maxsize` entries are kept, evicting the least recently used one. Cached
+    instances are shared by all readers, so don't modify them in place; call `invalidate()`
+    after writing a resource to the server.
+
+    The `hits` counter counts reads answered from the cache, including those revalidated by
+    a 304 (which `revalidations` counts, too); `misses` counts reads that had to transfer
+    and parse the resource.
+    """
+
+    def __init__(self, maxsize: int = 256, ttl: Optional[float] = 60.0,
+                 clock: Callable[[], float] = time.monotonic):
+        """
+        :param maxsize: The maximum number of cached resources
+        :param ttl: Seconds for which cached resources are used without revalidation, or
+            None to never revalidate
+        :param clock: A function returning the current time in seconds
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def read(self, klass, path: str, server):
+        """
+        Returns an instance of `klass` for the resource at `path`, from the cache if possible.
+
+        :param klass: The resource class to instantiate
+        :param path: The REST path to read from, relative to the server's base URL
+        :param server: An instance of a FHIR server or compatible class
+        :raises: FHIRReadError if the server answers a conditional request with an error
+        :returns: An instance of `klass`
+        """
+        key = self._key(path, server)
+        now = self.clock()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                if self.ttl is None or now - entry.stored < self.ttl:
+                    self.hits += 1
+                    return entry.instance
+
+        request_conditional = getattr(server, 'request_conditional', None)
+        if request_conditional is None:
+            jsondict, etag, last_modified = server.request_json(path), None, None
+        else:
+            headers = {'Accept': _FHIR_JSON_MIME_TYPE}
+            if entry is not None and entry.etag:
+                headers['If-None-Match'] = entry.etag
+            if entry is not None and entry.last_modified:
+                headers['If-Modified-Since'] = entry.last_modified
+            try:
+                response = request_conditional(path, headers)
+                status = response.status_code
+                if status != 200 and (status != 304 or entry is None):
+                    raise FHIRReadError(response)
+            except Exception as e:
+                if getattr(getattr(e, 'response', None), 'status_code', None) in (404, 410):
+                    with self._lock:
+                        self._entries.pop(key, None)
+                raise
+            if 304 == status:
+                with self._lock:
+                    self.hits += 1
+                    self.revalidations += 1
+                    self._store(key, entry._replace(stored=now))
+                return entry.instance
+            jsondict = response.json()
+            etag, last_modified = response.headers.get('ETag'), response.headers.get('Last-Modified')
+
+        instance = klass(jsondict=jsondict)
+        instance._server = server
+        with self._lock:
+            self.misses += 1
+            self._store(key, _CacheEntry(instance, etag, last_modified, now))
+        return instance
+
+    def invalidate(self, path: str, server=None):
+        """
+        Removes the resource at `path` from the cache.
+
+        :param path: The REST path of the resource
+        :param server: The server the resource was read from; if None, the resource is removed
+            for all servers
+        """
+        with self._lock:
+            if server is not None:
+                self._entries.pop(self._key(path, server), None)
+            else:
+                for key in [key for key in self._entries if key[1] == path]:
+                    del self._entries[key]
+
+    def clear(self):
+        """Removes all resources from the cache and resets the counters."""
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = self.revalidations = 0
+
+    def _key(self, path: str, server) -> tuple:
+        return (getattr(server, 'base_uri', None), path)
+
+    def _store(self, key: tuple, entry: _CacheEntry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
@@ -3,8 +3,10 @@
 #
 #  Subclassing FHIR's reference to add resolving capabilities
 
+import asyncio
 import logging
 from . import reference
+from . import fhirabstractbase
 
 
 class FHIRReference(reference.Reference):
@@ -15,10 +17,48 @@ class FHIRReference(reference.Reference):
         """ Resolves the reference and caches the result, returning instance(s)
         of the referenced classes.
         
+        Contained resources and Bundle entries are looked up in indexes built
+        on first use, see `_find_indexed()`; resources fetched from the server
+        are cached on the owning resource, see `didResolveReference()`.
+        
+        :param klass: The expected class of the resource
+        :returns: An instance (or list thereof) of the resolved reference if
+            dereferencing was successful, `None` otherwise
+        """
+        found, server = self._resolved_locally(klass)
+        if server is None:
+            return found
+        
+        # fetch remote resource; unable to verify klass since we use klass.read_from()
+        relative = klass.read_from(self.reference, server)
+        self.owningResource().didResolveReference(self.processedReferenceIdentifier(), relative)
+        return relative
+    
+    async def aresolved(self, klass):
+        """ Asynchronous `resolved()`: fetches remote resources with
+        `klass.aread_from()`, so the server must implement the asynchronous
+        server protocol, see `FHIRAbstractResource.aread_from()`.
+        
         :param klass: The expected class of the resource
         :returns: An instance (or list thereof) of the resolved reference if
             dereferencing was successful, `None` otherwise
         """
+        found, server = self._resolved_locally(klass)
+        if server is None:
+            return found
+        
+        relative = await klass.aread_from(self.reference, server)
+        self.owningResource().didResolveReference(self.processedReferenceIdentifier(), relative)
+        return relative
+    
+    def _resolved_locally(self, klass):
+        """ Resolves the reference without talking to a server: against
+        contained resources, Bundle entries and references resolved before.
+        
+        :param klass: The expected class of the resource
+        :returns: A tuple of the resolved resource (or None) and the server to
+            fetch the resource from, which is None unless it must be fetched
+        """
         owning_resource = self.owningResource()
         if owning_resource is None:
             raise Exception("Cannot resolve reference without having an owner (which must be a `DomainResource`)")
@@ -28,22 +68,44 @@ class FHIRReference(reference.Reference):
         refid = self.processedReferenceIdentifier()
         if not refid:
             logging.warning("No `reference` set, cannot resolve")
-            return None
+            return None, None
         
-        # already resolved and cached? -> must be implemented in abstract base/resource
+        found, source = self._find_locally(owning_resource, refid)
+        if source is not None:
+            if isinstance(found, klass):
+                return found, None
+            logging.warning("{} resource {} is not a {} but a {}".format(source, refid, klass, found.__class__))
+            return None, None
         
-        # not yet resolved, see if it's a contained resource
+        # relative references, use the same server
+        server = None
+        if self.isRelative():
+            server = owning_resource.server if owning_resource else None
+        
+        # TODO: instantiate server for absolute resource
+        if server is None:
+            logging.warning("Not implemented: resolving absolute reference to resource {}"
+                .format(self.reference))
+            return None, None
+        
+        return None, server
+    
+    def _find_locally(self, owning_resource, refid):
+        """ Looks the reference up in the owning resource's contained
+        resources, in the Bundles the receiver is in and in the references
+        resolved before, regardless of the resource's class.
+        
+        :returns: A tuple of the resource found and where it was found, one
+            of "Contained", "Bundled" and "Resolved", or (None, None)
+        """
+        # see if it's a contained resource
         if owning_resource.contained is not None:
-            for contained in owning_resource.contained:
-                if contained.id == refid:
-                    owning_resource.didResolveReference(refid, contained)
-                    if isinstance(contained, klass):
-                        return contained
-                    logging.warning("Contained resource {} is not a {} but a {}".format(refid, klass, contained.__class__))
-                    return None
+            contained = _find_indexed(owning_resource, '_contained_index', owning_resource.contained, 'id', refid)
+            if contained is not None:
+                return contained, "Contained"
         
         # are we in a bundle?
-        ref_is_relative = '://' not in self.reference and 'urn:' != self.reference[:4]
+        ref_is_relative = self.isRelative()
         if (sys.version_info < (3, 0)):
             from . import bundle
         bundle = self.owningBundle()
@@ -54,30 +116,22 @@ class FHIRReference(reference.Reference):
                     base = bundle.server.base_uri if bundle.server else ''
                     fullUrl = base + self.reference
                 
-                for entry in bundle.entry:
-                    if entry.fullUrl == fullUrl:
-                        found = entry.resource
-                        if isinstance(found, klass):
-                            return found
-                        logging.warning("Bundled resource {} is not a {} but a {}".format(refid, klass, found.__class__))
-                        return None
+                entry = _find_indexed(bundle, '_entry_index', bundle.entry, 'fullUrl', fullUrl)
+                if entry is not None:
+                    return entry.resource, "Bundled"
             bundle = bundle.owningBundle()
         
-        # relative references, use the same server
-        server = None
-        if ref_is_relative:
-            server = owning_resource.server if owning_resource else None
-        
-        # TODO: instantiate server for absolute resource
-        if server is None:
-            logging.warning("Not implemented: resolving absolute reference to resource {}"
-                .format(self.reference))
-            return None
-        
-        # fetch remote resource; unable to verify klass since we use klass.read_from()
-        relative = klass.read_from(self.reference, server)
-        owning_resource.didResolveReference(refid, relative)
-        return relative
+        # already fetched and cached?
+        cached = owning_resource.resolvedReference(refid)
+        if cached is not None:
+            return cached, "Resolved"
+        return None, None
+    
+    def isRelative(self):
+        """ Whether the reference is relative to the server, like
+        "Patient/123", rather than an absolute URL or a URN.
+        """
+        return '://' not in self.reference and 'urn:' != self.reference[:4]
     
     def processedReferenceIdentifier(self):
         """ Normalizes the reference-id.
@@ -87,6 +141,207 @@ class FHIRReference(reference.Reference):
         return self.reference
 
 
+
+class _ListIndex(object):
+    """ Positions of the items in a list, by the value of one of their
+    properties. Remembers the list, its length and the `_index_version`
+    when built.
+    """
+    
+    __slots__ = ('items', 'count', 'version', 'positions')
+    
+    def __init__(self, items, key_name):
+        self.items = items
+        self.count = len(items)
+        self.version = fhirabstractbase._index_version
+        self.positions = {}
+        for pos, item in enumerate(items):
+            key = getattr(item, key_name, None)
+            if key is not None and key not in self.positions:     # the first one wins, like in a linear scan
+                self.positions[key] = pos
+    
+    def is_current(self, items):
+        return self.items is items and self.count == len(items)
+
+
+def _find_indexed(owner, index_name, items, key_name, key):
+    """ Returns the first item in `items` whose property `key_name` equals
+    `key`, using an index stored on `owner` under `index_name`.
+    
+    The index is rebuilt whenever the list was replaced or changed length,
+    when the item at an indexed position no longer has the key, and before
+    reporting a miss if the key of any item changed since it was built,
+    which includes creating items from JSON. So items that were replaced or
+    given a new key in place are found like a linear scan would find them,
+    while misses on unchanged lists only cost a lookup.
+    
+    :returns: The item, or None if there is none
+    """
+    index = getattr(owner, index_name, None)
+    if index is None or not index.is_current(items):
+        index = _ListIndex(items, key_name)
+        setattr(owner, index_name, index)
+    while True:
+        pos = index.positions.get(key)
+        if pos is not None:
+            item = items[pos]
+            if getattr(item, key_name, None) == key:
+                return item
+        elif index.version == fhirabstractbase._index_version:
+            return None
+        index = _ListIndex(items, key_name)
+        setattr(owner, index_name, index)
+
+
+async def aresolve_all(references, klass, limit=10):
+    """ Resolves many references concurrently, like `FHIRReference.aresolved()`
+    does, with at most `limit` requests to servers in flight. References to
+    the same path on the same server are fetched once.
+    
+    :param references: An iterable of `FHIRReference` instances
+    :param klass: The expected class of the resources
+    :param int limit: The maximum number of concurrent requests
+    :returns: A list with the resolved resource (or None) for each reference
+    """
+    semaphore = asyncio.Semaphore(limit)
+    fetches = {}
+    
+    async def fetch(path, server):
+        async with semaphore:
+            return await klass.aread_from(path, server)
+    
+    async def resolve(ref):
+        found, server = ref._resolved_locally(klass)
+        if server is None:
+            return found
+        key = (id(server), ref.reference)
+        if key not in fetches:
+            fetches[key] = asyncio.ensure_future(fetch(ref.reference, server))
+        relative = await fetches[key]
+        ref.owningResource().didResolveReference(ref.processedReferenceIdentifier(), relative)
+        return relative
+    
+    tasks = [asyncio.ensure_future(resolve(ref)) for ref in references]
+    try:
+        return await asyncio.gather(*tasks)
+    finally:
+        for task in list(tasks) + list(fetches.values()):
+            task.cancel()
+
+
+def prefetch_references(element, server=None, batch_size=50):
+    """ Fetches the resources of all unresolved relative references within
+    a resource or Bundle in a few batched requests: one `Type?_id=a,b,c`
+    search per resource type and `batch_size` ids. The resources found are
+    cached on `element`, so that `FHIRReference.resolved()` returns them
+    without further requests.
+    
+    :param element: The resource or Bundle whose references to prefetch
+    :param server: The server to fetch from; defaults to the server of each
+        reference's owning resource
+    :param int batch_size: The maximum number of ids per request
+    :returns: A dict of the fetched resources, by reference
+    """
+    fetched = {}
+    for srv, path, refids in _prefetch_requests(element, server, batch_size):
+        fetched.update(_seed_prefetched(element, srv, srv.request_json(path), refids))
+    return fetched
+
+
+async def aprefetch_references(element, server=None, batch_size=50, limit=10):
+    """ Asynchronous `prefetch_references()`, sending up to `limit` requests
+    at a time to servers implementing the asynchronous server protocol.
+    
+    :param element: The resource or Bundle whose references to prefetch
+    :param server: The asynchronous server to fetch from; defaults to the
+        server of each reference's owning resource
+    :param int batch_size: The maximum number of ids per request
+    :param int limit: The maximum number of concurrent requests
+    :returns: A dict of the fetched resources, by reference
+    """
+    semaphore = asyncio.Semaphore(limit)
+    
+    async def fetch(srv, path, refids):
+        async with semaphore:
+            bundle_json = await srv.request_json(path)
+        return _seed_prefetched(element, srv, bundle_json, refids)
+    
+    fetched = {}
+    requests = _prefetch_requests(element, server, batch_size)
+    for result in await asyncio.gather(*(fetch(*request) for request in requests)):
+        fetched.update(result)
+    return fetched
+
+
+def _prefetch_requests(element, server, batch_size):
+    """ Collects the references within `element` that can't be resolved
+    locally and groups them into search requests.
+    
+    :returns: A list of (server, search path, [reference]) tuples
+    """
+    groups = {}
+    for ref in _iter_references(element):
+        if not ref.reference or '#' == ref.reference[0] or not ref.isRelative():
+            continue
+        res_type, _, res_id = ref.reference.partition('/')
+        if not res_id or '/' in res_id:
+            continue
+        owning_resource = ref.owningResource()
+        if owning_resource is None or ref._find_locally(owning_resource, ref.reference)[1] is not None:
+            continue
+        srv = server or owning_resource.server
+        if srv is None:
+            continue
+        group = groups.setdefault((id(srv), res_type), (srv, res_type, {}))
+        group[2][res_id] = None
+    
+    requests = []
+    for srv, res_type, ids in groups.values():
+        ids = list(ids)
+        for start in range(0, len(ids), batch_size):
+            batch = ids[start:start + batch_size]
+            path = '{}?_id={}&_count={}'.format(res_type, ','.join(batch), len(batch))
+            requests.append((srv, path, ['{}/{}'.format(res_type, res_id) for res_id in batch]))
+    return requests
+
+
+def _seed_prefetched(element, server, bundle_json, refids):
+    """ Caches the requested resources of a search result Bundle on `element`.
+    
+    :returns: A dict of the cached resources, by reference
+    """
+    wanted = set(refids)
+    fetched = {}
+    for entry in bundle.Bundle(bundle_json).entry or []:
+        resource = entry.resource
+        if resource is None or resource.id is None:
+            continue
+        refid = resource.relativePath()
+        if refid in wanted:
+            resource._server = server
+            element.didResolveReference(refid, resource)
+            fetched[refid] = resource
+    return fetched
+
+
+def _iter_references(element):
+    """ Yields all `FHIRReference` instances within an element. """
+    stack = [element]
+    while stack:
+        elem = stack.pop()
+        if isinstance(elem, FHIRReference):
+            yield elem
+        for name, jsname, typ, is_list, of_many, not_optional in elem.elementTable().properties:
+            if not (isinstance(typ, type) and issubclass(typ, fhirabstractbase.FHIRAbstractBase)):
+                continue
+            value = getattr(elem, name)
+            if value is None:
+                continue
+            if is_list:
+                stack.extend(reversed(value))
+            else:
+                stack.append(value)
+
 import sys
 if (sys.version_info > (3, 0)):     # Python 2 imports are POS
     from . import bundle
@@ -2,10 +2,9 @@
 # 2024, SMART Health IT.
 
 import datetime
-import re
 from typing import Any, Union
 
-from ._dateutils import _FHIRDateTimeMixin
+from ._dateutils import _FHIRDateTimeMixin, _compile_spec_regex
 
 
 class FHIRTime(_FHIRDateTimeMixin):
@@ -29,18 +28,17 @@ class FHIRTime(_FHIRDateTimeMixin):
 
     Public methods:
     - `as_json`: returns the original JSON used to construct the instance
+    - `parse_many`: class method parsing many JSON strings at once, returning a validity mask
     """
 
-    def __init__(self, jsonval: Union[str, None] = None):
-        self.time: Union[datetime.time, None] = None
-        super().__init__(jsonval)
+    time = _FHIRDateTimeMixin._value_property("datetime.time representing the JSON value")
 
     ##################################
     # Private properties and methods #
     ##################################
 
     # Pulled from spec for time
-    _REGEX = re.compile(r"([01][0-9]|2[0-3]):[0-5][0-9]:([0-5][0-9]|60)(\.[0-9]+)?")
+    _REGEX = _compile_spec_regex(r"([01][0-9]|2[0-3]):[0-5][0-9]:([0-5][0-9]|60)(\.[0-9]+)?")
     _FIELD = "time"
 
     @classmethod
@@ -0,0 +1,170 @@
+"""Track changes to instances, so that serializing unchanged elements reuses their JSON."""
+# 2024, SMART Health IT.
+
+import pickle
+
+from .fhirabstractbase import FHIRAbstractBase, _copy_json, _unmaterialized
+from .fhirintern import _Shared
+
+
+def track_changes(element):
+    """
+    Turns on change tracking for an element and its child elements, usually a resource
+    that is serialized over and over, like one served from a cache.
+
+    A tracked element caches the JSON that `as_json()` returns, and returns a new copy of
+    it until the element changes, which takes a fraction of the time serializing does.
+    `write_json()` reuses the cache, too. Setting a property of a tracked element drops
+    the cached JSON of the element and of its owners. Elements assigned to a property are
+    tracked as well, and the element becomes their owner.
+
+    Changes that don't set a property of a tracked element go unnoticed: changing a list
+    in place, changing a date's value, or changing an element that was assigned to
+    another tracked element, which only notifies its new owner. Call `mark_changed()` on
+    the element after such changes.
+
+    Tracking switches the elements to a subclass of their class, named the same. Copies,
+    made with the `copy` module or by pickling, aren't tracked.
+
+    :param element: The element to track
+    :returns: The element
+    """
+    if isinstance(element, (_Tracked, _Shared)):
+        return element
+    klass = element.__class__
+    tracked = _tracked_classes.get(klass)
+    if tracked is None:
+        tracked = type(klass.__name__, (_Tracked, klass), {
+            '__slots__': (),
+            '__module__': klass.__module__,
+            '_element_table': klass.elementTable(),
+            '_tracked_class': klass,
+        })
+        _tracked_classes[klass] = tracked
+    element.__class__ = tracked
+    element.__dict__.pop('_json_cache', None)
+
+    for name in element.elementTable().by_name:
+        value = element._stored_value(name)
+        for item in (value if value.__class__ is list else (value,)):
+            if isinstance(item, FHIRAbstractBase):
+                track_changes(item)
+    return element
+
+
+def mark_changed(element):
+    """
+    Drops the cached JSON of a tracked element and its owners, after a change that
+    tracking doesn't notice. Does nothing for elements that aren't tracked.
+
+    :param element: The element that changed
+    """
+    while element is not None:
+        element.__dict__.pop('_json_cache', None)
+        element = element._owner
+
+
+_tracked_classes = {}
+
+
+def _member_json(value, trusted: bool):
+    """Returns the JSON of a cached member: a child element, a tuple of them, or JSON."""
+    if value.__class__ is tuple:
+        return [_member_json(item, trusted) for item in value]
+    if isinstance(value, FHIRAbstractBase):
+        return value.as_json(trusted=trusted)
+    if hasattr(value, 'as_json'):
+        return value.as_json()
+    return _copy_json(value)
+
+
+class _Tracked:
+    """Marks the classes of tracked elements, caching their JSON until they change."""
+
+    __slots__ = ()
+
+    _json_cache = None
+    """ The JSON members of an unchanged element, with child elements that are to serialize
+    themselves, whether they were validated, and for the outermost tracked element, the
+    whole JSON pickled. """
+
+    def __setattr__(self, name, value):
+        super().__setattr__(name, value)
+        if name not in self._element_table.by_name:
+            return
+        self._adopt(value)
+
+        # child elements of lazy instances are created without cache, so that owners of an
+        # element without cache may still have theirs
+        mark_changed(self)
+
+    def _adopt(self, value):
+        """Tracks the elements of a property's value, owned by the receiver."""
+        for item in (value if value.__class__ is list else (value,)):
+            if isinstance(item, FHIRAbstractBase) and not isinstance(item, _Shared):
+                track_changes(item)
+                item._owner = self
+
+    def _materialize(self, prop):
+        # creating a property of a lazy instance only reads it, so keeps the cached JSON
+        value = self._lazy_json.get(prop[1])
+        if value is not None:
+            value = self._property_value(prop, value, lazy=True)
+        super().__setattr__(prop[0], value)
+        self._adopt(value)
+        return value
+
+    def __delattr__(self, name):
+        super().__delattr__(name)
+        mark_changed(self)
+
+    def as_json(self, trusted=False):
+        cache = self._json_cache
+        if cache is None or not (trusted or cache[1]):
+            js = super().as_json(trusted=trusted)
+            self.__dict__['_json_cache'] = self._cache_entry(js, not trusted)
+            return js
+        if cache[2] is not None:
+            return pickle.loads(cache[2])
+        return {key: _member_json(value, trusted) for key, value in cache[0].items()}
+
+    def _cache_entry(self, js, validated):
+        """
+        Creates the cache entry for the receiver's JSON. Each element only keeps its own
+        members, and refers to its child elements, which cache theirs, so that cached data
+        grows with the size of the tree rather than its size times its depth. The outermost
+        tracked element also keeps its whole JSON pickled: unpickling is the fastest way to
+        copy JSON. Other JSON members are copied, as `js` is returned to the caller, who may
+        change it.
+        """
+        members = {}
+        by_jsname = self._element_table.by_jsname
+        for key, value in js.items():
+            prop = by_jsname.get(key)
+            if prop is not None and isinstance(prop[2], type) and issubclass(prop[2], FHIRAbstractBase):
+                stored = self._stored_value(prop[0])
+                if stored is not _unmaterialized:
+                    members[key] = tuple(stored) if stored.__class__ is list else stored
+                    continue
+            members[key] = _copy_json(value)
+        pickled = None
+        if not isinstance(self._owner, _Tracked):
+            pickled = pickle.dumps(js, pickle.HIGHEST_PROTOCOL)
+        return members, validated, pickled
+
+    def _write_json(self, writer):
+        cache = self._json_cache
+        if cache is None or not cache[1]:
+            super()._write_json(writer)
+        else:
+            writer.parts.append(writer.encode(self.as_json()))
+
+    def __copy__(self):
+        copy = super().__copy__()
+        copy.__dict__.pop('_json_cache', None)
+        copy.__class__ = self._tracked_class
+        return copy
+
+    def __reduce_ex__(self, protocol):
+        unpickle, (klass, state) = super().__reduce_ex__(protocol)
+        return unpickle, (self._tracked_class, state)
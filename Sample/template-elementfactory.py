@@ -12,19 +12,48 @@ class FHIRElementFactory(object):
     """ Factory class to instantiate resources by resource name.
     """
     
+    _element_classes = {}
+    """ Classes already returned by `element_class()`, by resource type. """
+    
     @classmethod
-    def instantiate(cls, resource_type, jsondict):
+    def instantiate(cls, resource_type, jsondict, lazy=False, elements=None, trusted=False):
         """ Instantiate a resource of the type correlating to "resource_type".
         
         :param str resource_type: The name/type of the resource to instantiate
         :param dict jsondict: The JSON dictionary to use for data
+        :param bool lazy: Whether to create a lazy instance, see
+            `FHIRAbstractBase.with_json()`
+        :param elements: Optional element paths to restrict instantiation to
+        :param bool trusted: Whether the JSON data is known to be valid
         :returns: A resource of the respective type or `Element`
         """
+        klass = cls.element_class(resource_type)
+        if lazy or elements is not None or trusted:
+            return klass._with_json_dict(jsondict, lazy=lazy, elements=elements, trusted=trusted)
+        return klass(jsondict)
+    
+    @classmethod
+    def element_class(cls, resource_type):
+        """ Returns the class correlating to "resource_type".
+        
+        :param str resource_type: The name/type of the resource
+        :returns: The class of the respective type or `Element`
+        """
+        klass = cls._element_classes.get(resource_type)
+        if klass is None:
+            klass = cls._lookup_element_class(resource_type)
+            if klass is None:
+                from . import element
+                return element.Element
+            cls._element_classes[resource_type] = klass
+        return klass
+    
+    @classmethod
+    def _lookup_element_class(cls, resource_type):
         {%- for klass in classes %}{% if klass.resource_type %}
         if "{{ klass.resource_type }}" == resource_type:
             from . import {{ klass.module }}
-            return {{ klass.module }}.{{ klass.name }}(jsondict)
+            return {{ klass.module }}.{{ klass.name }}
         {%- endif %}{% endfor %}
-        from . import element
-        return element.Element(jsondict)
+        return None
 
@@ -28,13 +28,22 @@ class {{ klass.name }}({% if klass.superclass in imports %}{{ klass.superclass.m
     
     resource_type = "{{ klass.resource_type }}"
 {%- endif %}
+{%- if compact_instances %}
     
-    def __init__(self, jsondict=None, strict=True):
+    __slots__ = ({% if klass.properties %}
+    {%- for prop in klass.properties %}
+        "{{ prop.name }}",
+    {%- endfor %}
+    {% endif %})
+{%- endif %}
+    
+    def __init__(self, jsondict=None, strict=True, **kwargs):
         """ Initialize all valid properties.
         
         :raises: FHIRValidationError on validation errors, unless strict is False
         :param dict jsondict: A JSON dictionary to use for initialization
         :param bool strict: If True (the default), invalid variables will raise a TypeError
+        :param kwargs: Further options for `FHIRAbstractBase.__init__()`
         """
     {%- for prop in klass.properties %}
         
@@ -45,7 +54,7 @@ class {{ klass.name }}({% if klass.superclass in imports %}{{ klass.superclass.m
         {%- if prop.json_class != prop.class_name %} (represented as `{{ prop.json_class }}` in JSON){% endif %}. """
     {%- endfor %}
         
-        super({{ klass.name }}, self).__init__(jsondict=jsondict, strict=strict)
+        super({{ klass.name }}, self).__init__(jsondict=jsondict, strict=strict, **kwargs)
     
 {%- if klass.properties %}
     
@@ -93,7 +93,8 @@ class FHIRStructureDefinitionRenderer(FHIRRenderer):
                 'profile': profile,
                 'info': self.spec.info,
                 'imports': imports,
-                'classes': classes
+                'classes': classes,
+                'compact_instances': getattr(self.settings, 'compact_instances', False),
             }
             
             ptrn = profile.targetname.lower() if self.settings.resource_modules_lowercase else profile.targetname
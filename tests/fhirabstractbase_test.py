@@ -0,0 +1,350 @@
+import copy as copy_module
+import io
+import json
+import pickle
+import unittest
+
+from models.bundle import Bundle
+from models.fhirabstractbase import FHIRValidationError
+from models.observation import Observation
+from models.patient import Patient
+from models.resource import Resource
+
+
+def apply_patch(js, ops):
+    """Applies the add, remove and replace operations of a JSON Patch"""
+    js = copy_module.deepcopy(js)
+    for op in ops:
+        *parents, key = op["path"].split("/")[1:]
+        target = js
+        for parent in parents:
+            target = target[int(parent) if isinstance(target, list) else parent]
+        if isinstance(target, list):
+            key = len(target) if key == "-" else int(key)
+        if op["op"] == "remove":
+            del target[key]
+        elif op["op"] == "add" and isinstance(target, list):
+            target.insert(key, op["value"])
+        else:
+            target[key] = op["value"]
+    return js
+
+
+class TestFHIRAbstractBase(unittest.TestCase):
+
+    def test_element_table(self):
+        """Confirm the per-class property table is built once and matches elementProperties()"""
+        table = Patient.elementTable()
+        self.assertIs(table, Patient.elementTable())
+        self.assertIs(table, Patient({"id": "a"}).elementTable())
+        self.assertEqual(table.properties, tuple(Patient().elementProperties()))
+        self.assertIsNot(table, Observation.elementTable())
+
+        self.assertIn("birthDate", table.valid_keys)
+        self.assertIn("deceased", table.valid_keys)
+        self.assertEqual(table.of_many["deceased"], ("deceasedBoolean", "deceasedDateTime"))
+        self.assertEqual(table.by_name["birthDate"][1], "birthDate")
+        self.assertIn("status", Observation.elementTable().nonoptionals)
+
+    def test_update_with_json_errors(self):
+        """Confirm validation errors are still reported"""
+        with self.assertRaisesRegex(FHIRValidationError, "Superfluous entry \"bogus\""):
+            Patient({"bogus": 1})
+        with self.assertRaisesRegex(FHIRValidationError, "Non-optional property \"status\""):
+            Observation({"code": {"text": "X"}})
+
+        # primitive extensions are accepted, but only when they carry a value
+        Patient({"_gender": {"extension": [{"url": "http://example.org", "valueString": "x"}]}})
+        with self.assertRaisesRegex(FHIRValidationError, "Superfluous entry \"_gender\""):
+            Patient({"_gender": None})
+
+    def test_update_with_json_paths(self):
+        """Confirm the fast and the checked update paths agree"""
+        js = {
+            "resourceType": "Observation",
+            "status": "final",
+            "code": {"coding": [{"system": "http://loinc.org", "code": "8867-4"}]},
+            "valueQuantity": {"value": 72, "unit": "/min"},
+            "_status": {"extension": [{"url": "http://example.org", "valueString": "x"}]},
+        }
+        fast = Observation()
+        self.assertTrue(fast._update_with_json_fast(js))
+        checked = Observation()
+        checked._update_with_json_checked(js)
+        self.assertEqual(fast.as_json(), checked.as_json())
+        self.assertIs(fast.code._owner, fast)
+
+        # invalid data is handed over to the checked path, which keeps valid values
+        obs = Observation({"status": 1, "code": {"text": "X"}}, strict=False)
+        self.assertIsNone(obs.status)
+        self.assertEqual(obs.code.text, "X")
+        self.assertFalse(Observation()._update_with_json_fast({"status": 1}))
+
+    def test_from_json_bytes(self):
+        """Confirm instantiation from JSON text matches `with_json()`"""
+        js = {"resourceType": "Observation", "status": "final", "code": {"text": "Blutdruck – systolisch"}}
+        text = json.dumps(js, ensure_ascii=False)
+        for data in (text, text.encode("utf-8"), b"\xef\xbb\xbf" + text.encode("utf-8"), bytearray(text.encode("utf-16"))):
+            obs = Observation.from_json_bytes(data)
+            self.assertIsInstance(obs, Observation)
+            self.assertEqual(obs.as_json(), js)
+
+        # resources are dispatched by their "resourceType", arrays create lists
+        resources = Bundle.from_json_file(io.BytesIO(json.dumps([js, {"resourceType": "Patient"}]).encode("utf-8")))
+        self.assertEqual([type(r) for r in resources], [Observation, Patient])
+        self.assertEqual(Patient.from_json_file(io.StringIO('{"id": "p1"}')).id, "p1")
+
+        with self.assertRaisesRegex(FHIRValidationError, "^1:\n  Superfluous entry \"bogus\""):
+            Patient.from_json_bytes(b'[{}, {"bogus": 1}]')
+        with self.assertRaises(TypeError):
+            Patient.from_json_bytes(b'"Patient"')
+        with self.assertRaises(ValueError):
+            Patient.from_json_bytes(b'{"id": ')
+
+        # trusted data is not checked
+        patients = Patient.from_json_bytes(b'[{}, {"bogus": 1, "gender": 1}]', trusted=True)
+        self.assertEqual(patients[1].gender, 1)
+        obs = Resource.from_json_file(io.BytesIO(text.encode("utf-8")), trusted=True)
+        self.assertIsInstance(obs, Observation)
+        self.assertEqual(obs.as_json(trusted=True), js)
+
+    def test_trusted(self):
+        """Confirm trusted data is read and written like validated data, without checks"""
+        js = {
+            "resourceType": "Bundle",
+            "type": "collection",
+            "entry": [
+                {"resource": {"resourceType": "Patient", "id": "p1", "birthDate": "1970-01-01", "name": [{"family": "Doe"}]}},
+                {"resource": {"resourceType": "Observation", "status": "final", "code": {"text": "X"},
+                              "subject": {"reference": "Patient/p1"}}},
+            ],
+        }
+        bundle = Bundle(js, trusted=True)
+        self.assertIsInstance(bundle.entry[0].resource, Patient)
+        self.assertIs(bundle.entry[1].resource.subject._owner, bundle.entry[1].resource)
+        self.assertEqual(bundle.entry[0].resource.birthDate.isostring, "1970-01-01")
+        self.assertEqual(bundle.as_json(trusted=True), Bundle(js).as_json())
+        self.assertEqual(Bundle.with_json(js, trusted=True).as_json(), js)
+
+        # nothing is checked
+        obs = Observation({"code": {"text": 1}, "bogus": 1}, trusted=True)
+        self.assertEqual(obs.code.text, 1)
+        self.assertEqual(obs.as_json(trusted=True), {"resourceType": "Observation", "code": {"text": 1}})
+        with self.assertRaises(FHIRValidationError):
+            obs.as_json()
+
+    def test_lazy(self):
+        """Confirm lazy instances create their properties on first access"""
+        js = {
+            "resourceType": "Bundle",
+            "type": "collection",
+            "entry": [
+                {"resource": {"resourceType": "Patient", "id": "p1", "gender": "male", "name": [{"family": "Doe"}]}},
+                {"resource": {"resourceType": "Observation", "status": 1, "code": {"text": "X"}}},
+            ],
+        }
+        bundle = Bundle.with_json(js, lazy=True)
+        self.assertIsInstance(bundle, Bundle)
+        self.assertEqual(bundle.type, "collection")
+        self.assertIsNone(bundle.total)
+
+        patient = bundle.entry[0].resource
+        self.assertIsInstance(patient, Patient)
+        self.assertIs(patient.owningBundle(), bundle)
+        self.assertEqual(patient.id, "p1")
+
+        # invalid data only raises when accessed, or when validating explicitly
+        obs = bundle.entry[1].resource
+        self.assertEqual(obs.code.text, "X")
+        with self.assertRaisesRegex(FHIRValidationError, "Wrong type <class 'int'> for property \"status\""):
+            obs.status
+        with self.assertRaisesRegex(FHIRValidationError, "Wrong type <class 'int'> for property \"status\""):
+            bundle.validate()
+
+        # untouched data is passed through, changes are serialized
+        patient.gender = "female"
+        out = bundle.as_json()
+        self.assertEqual(out["entry"][0]["resource"]["gender"], "female")
+        self.assertEqual(out["entry"][0]["resource"]["name"], js["entry"][0]["resource"]["name"])
+
+        # passed through data is copied, so changing it leaves the instance alone
+        for trusted in (False, True):
+            out = bundle.as_json(trusted=trusted)
+            out["entry"][0]["resource"]["name"][0]["given"] = ["John"]
+            out["entry"][1]["resource"]["code"]["coding"] = [{"code": "injected"}]
+        self.assertEqual(bundle.as_json(trusted=True)["entry"][0]["resource"]["name"], [{"family": "Doe"}])
+        self.assertEqual(bundle.entry[0].resource.name[0].as_json(), {"family": "Doe"})
+        self.assertEqual(js["entry"][0]["resource"]["name"], [{"family": "Doe"}])
+
+    def test_projection(self):
+        """Confirm only the requested element paths are created"""
+        js = {
+            "resourceType": "Observation",
+            "status": "final",
+            "code": {"coding": [{"system": "http://loinc.org", "code": "8867-4"}], "text": "Heart rate"},
+            "valueQuantity": {"value": 72, "unit": "/min"},
+            "subject": {"reference": "Patient/1", "display": "Peter"},
+            "bogus": 1,
+        }
+        obs = Observation(js, elements=["Observation.code", "value[x]", "subject.reference"])
+        self.assertIsNone(obs.status)
+        self.assertEqual(obs.code.coding[0].code, "8867-4")
+        self.assertEqual(obs.valueQuantity.value, 72)
+        self.assertEqual(obs.subject.reference, "Patient/1")
+        self.assertIsNone(obs.subject.display)
+
+        # non-optional properties are only checked when selected
+        Observation({"code": {"text": "X"}}, elements=["code"])
+        with self.assertRaisesRegex(FHIRValidationError, "Non-optional property \"status\""):
+            Observation({"code": {"text": "X"}}, elements=["code", "status"])
+
+        # sub-paths are resolved against the actual resource type
+        bundle = Bundle.with_json({"resourceType": "Bundle", "type": "collection", "entry": [
+            {"resource": {"resourceType": "Patient", "id": "p1", "gender": "male"}},
+            {"resource": js},
+        ]}, elements=["entry.resource.Patient.gender", "entry.resource.Observation.status"])
+        self.assertIsNone(bundle.type)
+        self.assertEqual(bundle.entry[0].resource.gender, "male")
+        self.assertIsNone(bundle.entry[0].resource.id)
+        self.assertEqual(bundle.entry[1].resource.status, "final")
+        self.assertIsNone(bundle.entry[1].resource.code)
+
+    def test_write_json(self):
+        """Confirm JSON text is written like `json.dump(as_json())` with the same checks"""
+        bundle = Bundle({"resourceType": "Bundle", "type": "collection", "entry": [
+            {"resource": {"resourceType": "Patient", "id": "p1", "active": True, "name": [{"given": ["Zoë", "A"]}]}},
+            {"resource": {"resourceType": "Observation", "status": "final", "code": {"text": "X"},
+                          "valueQuantity": {"value": 72.5}, "effectiveDateTime": "2024-01-02T10:00:00+01:00"}},
+        ]})
+        for options in ({}, {"separators": (",", ":"), "ensure_ascii": False}):
+            out = io.StringIO()
+            bundle.write_json(out, **options)
+            self.assertEqual(out.getvalue(), json.dumps(bundle.as_json(), **options))
+
+        lazy = Bundle.with_json(bundle.as_json(), lazy=True)
+        lazy.entry[0].resource.gender = "other"
+        out = io.StringIO()
+        lazy.write_json(out)
+        self.assertEqual(out.getvalue(), json.dumps(lazy.as_json()))
+
+        obs = bundle.entry[1].resource
+        obs.status = None
+        obs.code.text = 1
+        with self.assertRaises(FHIRValidationError) as expected:
+            obs.as_json()
+        with self.assertRaises(FHIRValidationError) as actual:
+            obs.write_json(io.StringIO())
+        self.assertEqual(str(actual.exception), str(expected.exception))
+
+    def test_binary(self):
+        """Confirm the binary format reads back the same model, with the original date strings"""
+        js = {"resourceType": "Bundle", "type": "collection", "total": 70000, "entry": [
+            {"resource": {"resourceType": "Patient", "id": "p1", "active": False, "birthDate": "1970-01",
+                          "name": [{"given": ["Zoë", "x" * 40]}], "text": {"status": "generated", "div": "<div>" + "y" * 300 + "</div>"},
+                          "contained": [{"resourceType": "Organization", "id": "o1", "name": "Org"}]}},
+            {"resource": {"resourceType": "Observation", "status": "final", "code": {"text": "X"},
+                          "valueQuantity": {"value": -72.5}, "effectiveDateTime": "2024-01-02T10:00:00Z",
+                          "component": [{"code": {"text": "Y"}, "valueInteger": -5}, {"code": {"text": "Z"}, "valueInteger": -3000000000}]}},
+        ]}
+        bundle = Bundle(js)
+        data = bundle.as_binary()
+        self.assertLess(len(data), len(json.dumps(js, separators=(",", ":"))))
+
+        copy = Bundle.from_binary(bytearray(data))
+        self.assertEqual(copy.as_json(), js)
+        self.assertEqual(copy.entry[1].resource.effectiveDateTime.as_json(), "2024-01-02T10:00:00Z")
+        self.assertIsInstance(copy.entry[0].resource.contained[0], Resource)
+        self.assertIs(copy.entry[1].resource.code._owner, copy.entry[1].resource)
+
+        # resources are read as their own type
+        self.assertIsInstance(Resource.from_binary(bundle.entry[0].resource.as_binary()), Patient)
+
+        with self.assertRaisesRegex(ValueError, "Truncated"):
+            Bundle.from_binary(data[:-1])
+        with self.assertRaisesRegex(ValueError, "Extra data"):
+            Bundle.from_binary(data + b"\x00")
+
+        # integers are limited to 64 bits
+        for value in (2 ** 63 - 1, 2 ** 64 - 1, -2 ** 63):
+            self.assertEqual(Bundle.from_binary(Bundle({"type": "collection", "total": value}).as_binary()).total, value)
+        for value in (2 ** 64, -2 ** 63 - 1):
+            with self.assertRaisesRegex(ValueError, "64-bit"):
+                Bundle({"type": "collection", "total": value}).as_binary()
+
+    def test_pickle(self):
+        """Confirm pickling keeps set values and owners within the pickled tree, but not servers"""
+        js = {"resourceType": "Bundle", "type": "collection", "entry": [
+            {"resource": {"resourceType": "Observation", "status": "final", "code": {"coding": [{"code": "8867-4"}]},
+                          "effectiveDateTime": "2024-01-02T10:00:60Z", "valueQuantity": {"value": 72}}},
+        ]}
+        bundle = Bundle(js)
+        obs = bundle.entry[0].resource
+        obs._server = object()
+
+        copy = pickle.loads(pickle.dumps(bundle))
+        self.assertEqual(copy.as_json(), js)
+        self.assertIs(copy.entry[0].resource._owner, copy.entry[0])
+        self.assertIs(copy.entry[0].resource.code.coding[0]._owner, copy.entry[0].resource.code)
+        self.assertIsNone(copy.entry[0].resource._server)
+        self.assertEqual(copy.entry[0].resource.effectiveDateTime.as_json(), "2024-01-02T10:00:60Z")
+
+        # elements pickled on their own leave their owners behind
+        data = pickle.dumps(obs.code)
+        self.assertLess(len(data), 200)
+        self.assertIsNone(pickle.loads(data)._owner)
+        self.assertEqual(pickle.loads(pickle.dumps([obs, obs]))[1].as_json(), obs.as_json())
+
+        # deep copies are independent, shallow ones share child elements
+        copied = copy_module.deepcopy(obs)
+        copied.code.coding[0].code = "X"
+        self.assertEqual(obs.code.coding[0].code, "8867-4")
+        self.assertIs(copied.code._owner, copied)
+        copied = copy_module.copy(obs)
+        self.assertIs(copied.code, obs.code)
+        self.assertIs(obs.code._owner, obs)
+        self.assertIs(copied._owner, obs._owner)
+
+    def test_diff(self):
+        """Confirm diffs are JSON Patches turning one instance into the other"""
+        js = {"resourceType": "Observation", "id": "o1", "status": "final",
+              "code": {"coding": [{"system": "http://loinc.org", "code": "8867-4"}, {"code": "HR"}]},
+              "effectiveDateTime": "2024-01-02", "valueQuantity": {"value": 72}, "note": [{"text": "a"}]}
+        obs = Observation(js)
+        changed = copy_module.deepcopy(obs)
+        self.assertEqual(obs.diff(changed), [])
+
+        changed.status = "amended"
+        self.assertEqual(obs.diff(changed), [{"op": "replace", "path": "/status", "value": "amended"}])
+
+        changed.code.coding[0].code = "8310-5"
+        del changed.code.coding[1:]
+        changed.valueQuantity = None
+        changed.valueString = "72"
+        changed.note = []
+        changed.effectiveDateTime = None
+        changed.performer = [Resource({"id": "x"})]
+        ops = obs.diff(changed)
+        self.assertIn({"op": "remove", "path": "/code/coding/1"}, ops)
+        self.assertIn({"op": "replace", "path": "/code/coding/0/code", "value": "8310-5"}, ops)
+        self.assertEqual(apply_patch(js, ops), changed.as_json(trusted=True))
+        self.assertEqual(apply_patch(changed.as_json(trusted=True), changed.diff(obs)), js)
+
+        # shared and unmaterialized children are skipped
+        shared = Observation(js)
+        shared.code = obs.code
+        self.assertEqual(obs.diff(shared), [])
+        lazy = Observation.with_json(js, lazy=True)
+        other = Observation.with_json(dict(js, status="amended", code={"text": "X"}), lazy=True)
+        self.assertEqual(lazy.diff(other), [{"op": "remove", "path": "/code/coding"},
+                                            {"op": "add", "path": "/code/text", "value": "X"},
+                                            {"op": "replace", "path": "/status", "value": "amended"}])
+        self.assertEqual(lazy.diff(changed), obs.diff(changed))
+
+        # values taken from lazy instances are copies
+        lazy = Observation.with_json(copy_module.deepcopy(js), lazy=True)
+        ops = Observation.with_json({"status": "final"}, lazy=True).diff(lazy)
+        next(op for op in ops if op["path"] == "/code")["value"]["coding"].append({"code": "injected"})
+        self.assertEqual(lazy.code.as_json(), js["code"])
+
+        with self.assertRaises(TypeError):
+            obs.diff(Patient())
@@ -0,0 +1,226 @@
+import asyncio
+import copy
+import json
+import unittest
+
+from models.fhirreadcache import FHIRReadCache, FHIRReadError
+from models.observation import Observation
+from models.patient import Patient
+
+
+class MockResponse(object):
+
+    def __init__(self, jsondict):
+        self.text = json.dumps(jsondict) if jsondict is not None else ""
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class AsyncMockServer(object):
+    """Stand-in for an asynchronous FHIR server, keeping resources in memory"""
+
+    base_uri = "https://example.org/fhir/"
+
+    def __init__(self, resources=None):
+        self.resources = dict(resources or {})
+        self.requests = []
+        self.patches = []
+
+    async def request_json(self, path):
+        await asyncio.sleep(0)
+        self.requests.append(("GET", path))
+        return self.resources[path]
+
+    async def post_json(self, path, resource_json):
+        await asyncio.sleep(0)
+        self.requests.append(("POST", path))
+        resource_json = dict(resource_json, id=str(len(self.resources) + 1))
+        self.resources["{}/{}".format(path, resource_json["id"])] = resource_json
+        return MockResponse(resource_json)
+
+    async def put_json(self, path, resource_json):
+        await asyncio.sleep(0)
+        self.requests.append(("PUT", path))
+        self.resources[path] = resource_json
+        return MockResponse(resource_json)
+
+    async def patch_json(self, path, ops):
+        await asyncio.sleep(0)
+        self.requests.append(("PATCH", path))
+        self.patches.append(ops)
+        return MockResponse(None)
+
+    async def delete_json(self, path):
+        await asyncio.sleep(0)
+        self.requests.append(("DELETE", path))
+        del self.resources[path]
+        return MockResponse(None)
+
+
+class RecordingServer(object):
+    """Stand-in server recording the JSON Patch operations it is sent"""
+
+    base_uri = "https://example.org/fhir/"
+
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.patches = []
+
+    def patch_json(self, path, ops):
+        if self.fail:
+            raise Exception("422 Unprocessable Entity")
+        self.patches.append((path, ops))
+        return MockResponse({"resourceType": "Patient", "id": path.split("/")[1], "meta": {"versionId": "2"}})
+
+
+class ConditionalResponse(object):
+
+    def __init__(self, status_code, jsondict=None, headers=None):
+        self.status_code = status_code
+        self.jsondict = jsondict
+        self.headers = headers or {}
+
+    def json(self):
+        return self.jsondict
+
+
+class ConditionalMockServer(object):
+    """Stand-in for a server answering conditional requests"""
+
+    base_uri = "https://example.org/fhir/"
+
+    def __init__(self):
+        self.version = 1
+        self.requests = []
+        self.statuses = {}
+
+    def request_conditional(self, path, headers):
+        assert headers["Accept"] == "application/fhir+json"
+        self.requests.append((path, headers.get("If-None-Match")))
+        if path in self.statuses:
+            outcome = {"resourceType": "OperationOutcome", "issue": [{"severity": "error", "code": "not-found"}]}
+            return ConditionalResponse(self.statuses[path], outcome)
+        etag = 'W/"{}"'.format(self.version)
+        if headers.get("If-None-Match") == etag:
+            return ConditionalResponse(304)
+        return ConditionalResponse(200, {"resourceType": "Patient", "id": path.split("/")[1], "gender": "male"},
+                                   {"ETag": etag, "Last-Modified": "Mon, 01 Jan 2024 00:00:00 GMT"})
+
+
+class TestFHIRAbstractResource(unittest.TestCase):
+
+    def test_read_cache(self):
+        """Confirm cached reads are reused, revalidated and evicted"""
+        now = [0.0]
+        cache = FHIRReadCache(maxsize=2, ttl=10, clock=lambda: now[0])
+        server = ConditionalMockServer()
+
+        patient = Patient.read("p1", server, cache=cache)
+        self.assertIs(patient.server, server)
+        self.assertIs(Patient.read("p1", server, cache=cache), patient)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+        # stale entries are revalidated, and read again once changed
+        now[0] = 11
+        self.assertIs(Patient.read_from("Patient/p1", server, cache=cache), patient)
+        self.assertEqual(server.requests, [("Patient/p1", None), ("Patient/p1", 'W/"1"')])
+        server.version = 2
+        now[0] = 22
+        changed = Patient.read("p1", server, cache=cache)
+        self.assertIsNot(changed, patient)
+        self.assertEqual((cache.hits, cache.misses, cache.revalidations), (2, 2, 1))
+
+        # the least recently used entry is evicted, others can be invalidated
+        Patient.read("p2", server, cache=cache)
+        Patient.read("p1", server, cache=cache)
+        Patient.read("p3", server, cache=cache)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.misses, 4)
+        Patient.read("p1", server, cache=cache)
+        self.assertEqual(cache.misses, 4)
+        cache.invalidate("Patient/p1")
+        Patient.read("p1", server, cache=cache)
+        self.assertEqual(cache.misses, 5)
+
+    def test_read_cache_errors(self):
+        """Confirm error answers raise, and drop the entries of resources that are gone"""
+        now = [0.0]
+        cache = FHIRReadCache(ttl=10, clock=lambda: now[0])
+        server = ConditionalMockServer()
+        Patient.read("p1", server, cache=cache)
+        Patient.read("p2", server, cache=cache)
+
+        now[0] = 11
+        server.statuses = {"Patient/p1": 500, "Patient/p2": 410}
+        with self.assertRaises(FHIRReadError) as context:
+            Patient.read("p1", server, cache=cache)
+        self.assertEqual(context.exception.response.status_code, 500)
+        with self.assertRaises(FHIRReadError):
+            Patient.read("p2", server, cache=cache)
+        self.assertEqual(len(cache), 1)
+        self.assertEqual((cache.hits, cache.misses), (0, 2))
+
+        # unconditional reads aren't answered with 304
+        server.statuses = {"Patient/p3": 304}
+        with self.assertRaises(FHIRReadError):
+            Patient.read("p3", server, cache=cache)
+
+
+    def test_patch(self):
+        """Confirm updates send the JSON Patch from the original, or nothing if unchanged"""
+        server = RecordingServer()
+        original = Patient({"id": "p1", "gender": "male", "name": [{"family": "Doe", "given": ["John"]}]})
+        patient = copy.deepcopy(original)
+        self.assertIsNone(patient.patch(original, server))
+        self.assertEqual(server.patches, [])
+
+        patient.gender = "female"
+        patient.name[0].given.append("Q")
+        self.assertEqual(patient.patch(original, server)["meta"], {"versionId": "2"})
+        self.assertEqual(server.patches, [("Patient/p1", [
+            {"op": "replace", "path": "/gender", "value": "female"},
+            {"op": "add", "path": "/name/0/given/-", "value": "Q"},
+        ])])
+
+        # the instance's own server is used, and errors are passed on
+        patient._server = RecordingServer(fail=True)
+        with self.assertRaisesRegex(Exception, "422"):
+            patient.patch(original)
+        with self.assertRaisesRegex(Exception, "does not have a server"):
+            Patient({"id": "p2"}).patch(original)
+        with self.assertRaisesRegex(Exception, "does not have an id"):
+            Patient().patch(original, server)
+        with self.assertRaises(TypeError):
+            patient.patch(Observation(), server)
+        self.assertEqual(len(server.patches), 1)
+
+    def test_async(self):
+        """Confirm the asynchronous counterparts of read, create, update, patch and delete"""
+        server = AsyncMockServer({"Patient/p1": {"resourceType": "Patient", "id": "p1", "gender": "male"}})
+
+        async def run():
+            patient = await Patient.aread("p1", server)
+            self.assertEqual(patient.gender, "male")
+            self.assertIs(patient.server, server)
+
+            patient.gender = "female"
+            self.assertEqual((await patient.aupdate())["gender"], "female")
+
+            original = copy.deepcopy(patient)
+            self.assertIsNone(await patient.apatch(original))
+            patient.active = True
+            self.assertIsNone(await patient.apatch(original))
+            self.assertEqual(server.patches, [[{"op": "add", "path": "/active", "value": True}]])
+
+            created = await Patient({"gender": "other"}).acreate(server)
+            self.assertEqual(created["id"], "2")
+            with self.assertRaisesRegex(Exception, "already has an id"):
+                await patient.acreate(server)
+
+            self.assertIsNone(await patient.adelete())
+
+        asyncio.run(run())
+        self.assertEqual(server.requests, [("GET", "Patient/p1"), ("PUT", "Patient/p1"), ("PATCH", "Patient/p1"),
+                                           ("POST", "Patient"), ("DELETE", "Patient/p1")])
+        self.assertEqual(list(server.resources), ["Patient/2"])
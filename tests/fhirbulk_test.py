@@ -0,0 +1,293 @@
+import asyncio
+import io
+import json
+import threading
+import time
+import unittest
+
+from models.fhirabstractbase import FHIRValidationError
+from models.bundle import Bundle
+from models.fhirbulk import BundleEntryReader, aiter_search, iter_ndjson, iter_search, write_bundles, write_ndjson
+from models.observation import Observation
+from models.patient import Patient
+
+
+LINES = [
+    json.dumps({"resourceType": "Patient", "id": "p1"}),
+    json.dumps({"resourceType": "Observation", "id": "o1", "status": "final", "code": {"text": "X"}}),
+    "",
+    json.dumps({"resourceType": "Patient", "bogus": 1}),
+    "not json",
+    json.dumps({"resourceType": "Patient", "id": "p2"}),
+]
+
+
+class TestFHIRBulk(unittest.TestCase):
+
+    def ndjson(self):
+        return io.BytesIO("\n".join(LINES).encode("utf-8"))
+
+    def check_results(self, results):
+        self.assertEqual([r.line for r in results], [1, 2, 4, 5, 6])
+        self.assertIsInstance(results[0].resource, Patient)
+        self.assertIsInstance(results[1].resource, Observation)
+        self.assertEqual(results[4].resource.id, "p2")
+
+        self.assertIsNone(results[2].resource)
+        self.assertIsInstance(results[2].error, FHIRValidationError)
+        self.assertIn("Superfluous entry \"bogus\"", str(results[2].error))
+        self.assertIsInstance(results[3].error, ValueError)
+
+    def test_serial(self):
+        """Confirm lines are instantiated in order with per-line errors"""
+        self.check_results(list(iter_ndjson(self.ndjson(), chunk_size=2)))
+
+    def test_processes(self):
+        """Confirm worker processes give the same results"""
+        self.check_results(list(iter_ndjson(self.ndjson(), processes=2, chunk_size=2)))
+
+        unordered = list(iter_ndjson(self.ndjson(), processes=2, chunk_size=2, ordered=False))
+        self.check_results(sorted(unordered, key=lambda r: r.line))
+
+    def test_options(self):
+        """Confirm lazy and projected loading"""
+        results = list(iter_ndjson(self.ndjson(), elements=["id"]))
+        self.assertEqual(results[1].resource.id, "o1")
+        self.assertIsNone(results[1].resource.status)
+
+        results = list(iter_ndjson(self.ndjson(), lazy=True))
+        self.assertEqual(results[1].resource.code.text, "X")
+
+    def test_write_ndjson(self):
+        """Confirm resources are written one per line and read back"""
+        resources = [r.resource for r in iter_ndjson(self.ndjson()) if r.resource is not None]
+        out = io.StringIO()
+        self.assertEqual(write_ndjson(iter(resources), out), 3)
+        self.assertEqual(out.getvalue().splitlines(), [json.dumps(r.as_json(), separators=(",", ":")) for r in resources])
+        results = list(iter_ndjson(io.StringIO(out.getvalue())))
+        self.assertEqual([r.resource.as_json() for r in results], [r.as_json() for r in resources])
+
+        # lines before an invalid resource are complete, the invalid one is left out
+        resources[1].status = None
+        out = io.StringIO()
+        with self.assertRaisesRegex(FHIRValidationError, "^line 2:"):
+            write_ndjson(resources, out)
+        self.assertEqual(out.getvalue(), json.dumps(resources[0].as_json(), separators=(",", ":")) + "\n")
+
+
+BUNDLE = {
+    "resourceType": "Bundle",
+    "type": "transaction",
+    "entry": [
+        {
+            "fullUrl": "urn:uuid:1",
+            "resource": {"resourceType": "Patient", "id": "p1", "name": [{"family": "Doe"}]},
+            "request": {"method": "POST", "url": "Patient"},
+        },
+        {
+            "fullUrl": "urn:uuid:2",
+            "resource": {"resourceType": "Observation", "status": "final", "code": {"text": "X"}, "valueInteger": 12},
+            "request": {"method": "PUT", "url": "Observation/2"},
+        },
+    ],
+    "total": 2,
+}
+
+
+class TestBundleEntryReader(unittest.TestCase):
+
+    def test_entries(self):
+        """Confirm entries are read one at a time, at any chunk size"""
+        expected = [entry.as_json() for entry in Bundle(BUNDLE).entry]
+        text = json.dumps(BUNDLE, indent=2)
+        for chunk_size in (1, 5, 64, 65536):
+            for source in (io.BytesIO(text.encode("utf-8")), io.StringIO(text)):
+                reader = BundleEntryReader(source, chunk_size=chunk_size)
+                entries = list(reader)
+                self.assertEqual([entry.as_json() for entry in entries], expected)
+                self.assertIsInstance(entries[1].resource, Observation)
+                self.assertEqual(entries[1].request.method, "PUT")
+                self.assertEqual(reader.bundle_json, {"resourceType": "Bundle", "type": "transaction", "total": 2})
+
+        # literals, numbers and escapes cut off at chunk boundaries
+        text = '{"entry": [{"resource": {"resourceType": "Patient", "active": false, "name": [{"text": "\\u00e9x"}]}}]}'
+        for chunk_size in range(1, 9):
+            patient = list(BundleEntryReader(io.StringIO(text), chunk_size=chunk_size))[0].resource
+            self.assertEqual((patient.active, patient.name[0].text), (False, "\u00e9x"))
+
+    def test_errors(self):
+        """Confirm invalid entries and documents are reported"""
+        bundle = dict(BUNDLE, entry=[{"resource": {"resourceType": "Patient", "bogus": 1}}])
+        with self.assertRaisesRegex(FHIRValidationError, r"entry\.0:\n  resource:"):
+            list(BundleEntryReader(io.BytesIO(json.dumps(bundle).encode("utf-8"))))
+        with self.assertRaisesRegex(ValueError, "Expecting one of"):
+            list(BundleEntryReader(io.BytesIO(b'{"entry": [{"fullUrl": "x"} {}]}')))
+        with self.assertRaisesRegex(ValueError, "Expecting a Bundle"):
+            list(BundleEntryReader(io.BytesIO(b'{"resourceType": "Patient", "entry": []}')))
+
+        # syntax errors are raised without reading the rest of the document
+        entries = ['{"resource": {"resourceType": "Patient", "active": tru}}'] + ['{"fullUrl": "x"}'] * 100000
+        source = io.BytesIO('{{"entry": [{}]}}'.format(", ".join(entries)).encode("utf-8"))
+        with self.assertRaisesRegex(ValueError, "Expecting value"):
+            list(BundleEntryReader(source, chunk_size=64))
+        self.assertLess(source.tell(), 4096)
+
+
+class MockResponse(object):
+
+    def __init__(self, jsondict):
+        self.text = json.dumps(jsondict)
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class RecordingServer(object):
+    """Stand-in server answering batch and transaction Bundles, recording them"""
+
+    def __init__(self):
+        self.bundles = []
+        self.lock = threading.Lock()
+
+    def post_json(self, path, resource_json):
+        with self.lock:
+            self.bundles.append(resource_json)
+            number = len(self.bundles)
+        entries = []
+        for i, entry in enumerate(resource_json["entry"]):
+            if entry["resource"].get("gender") == "unknown":
+                if resource_json["type"] == "transaction":
+                    raise Exception("400 Bad Request")
+                outcome = {"resourceType": "OperationOutcome", "issue": [{"severity": "error", "code": "invalid", "diagnostics": "No"}]}
+                entries.append({"response": {"status": "400 Bad Request", "outcome": outcome}})
+            elif entry["request"]["method"] == "POST":
+                entries.append({"response": {"status": "201 Created", "location": "Patient/n{}-{}/_history/1".format(number, i)}})
+            else:
+                entries.append({"response": {"status": "200 OK", "location": entry["request"]["url"] + "/_history/2"}})
+        return MockResponse({"resourceType": "Bundle", "type": resource_json["type"] + "-response", "entry": entries})
+
+
+class TestWriteBundles(unittest.TestCase):
+
+    def resources(self):
+        return [Patient({"id": "p1"}), Patient(), Patient({"gender": "unknown"}), Patient(),
+                Observation({"status": "final", "code": {"text": "X"}}), Patient({"id": "p2"})]
+
+    def test_batch(self):
+        """Confirm resources are sent in batches and results are mapped back"""
+        resources = self.resources()
+        resources[4].status = None
+        for workers in (0, 2):
+            server = RecordingServer()
+            results = list(write_bundles(resources, server, chunk_size=2, workers=workers))
+            self.assertEqual([len(bundle["entry"]) for bundle in server.bundles], [2, 2, 1])
+            self.assertEqual([r.resource for r in results], resources)
+            self.assertEqual([r.id for r in results], ["p1", "n1-1", None, "n2-1", None, "p2"])
+            self.assertEqual(results[0].status, "200 OK")
+            self.assertEqual(str(results[2].error), "400 Bad Request: No")
+            self.assertIsInstance(results[4].error, FHIRValidationError)
+
+        requests = [entry["request"] for entry in server.bundles[0]["entry"]]
+        self.assertEqual(requests, [{"method": "PUT", "url": "Patient/p1"}, {"method": "POST", "url": "Patient"}])
+        self.assertTrue(server.bundles[0]["entry"][1]["fullUrl"].startswith("urn:uuid:"))
+
+    def test_transaction(self):
+        """Confirm a failing transaction fails all of its resources"""
+        server = RecordingServer()
+        results = list(write_bundles(self.resources(), server, bundle_type="transaction", chunk_size=3))
+        self.assertEqual([b["type"] for b in server.bundles], ["transaction", "transaction"])
+        self.assertEqual([str(r.error) if r.error else r.id for r in results],
+                         ["400 Bad Request"] * 3 + ["n2-0", "n2-1", "p2"])
+        with self.assertRaises(ValueError):
+            list(write_bundles([], server, bundle_type="collection"))
+
+    def test_transaction_invalid(self):
+        """Confirm a transaction with a resource failing validation isn't sent at all"""
+        resources = self.resources()
+        resources[4].status = None
+        server = RecordingServer()
+        results = list(write_bundles(resources, server, bundle_type="transaction", chunk_size=3))
+        self.assertEqual(len(server.bundles), 1)
+        self.assertEqual([r.id for r in results[:3]], [None] * 3)
+        self.assertEqual([r.status for r in results[3:]], [None] * 3)
+        self.assertIsInstance(results[4].error, FHIRValidationError)
+        self.assertTrue(str(results[3].error).startswith("Not sent"))
+        self.assertTrue(str(results[5].error).startswith("Not sent"))
+
+
+class PagingServer(object):
+    """Stand-in server returning search results in pages of two"""
+
+    base_uri = "https://example.org/fhir/"
+
+    def __init__(self, pages=5):
+        self.pages = pages
+        self.requests = []
+
+    def page(self, url):
+        self.requests.append(url)
+        number = int(url.rsplit("=", 1)[1]) if "page=" in url else 0
+        bundle = {"resourceType": "Bundle", "type": "searchset", "entry": [
+            {"resource": {"resourceType": "Patient", "id": "p{}".format(2 * number + i)}} for i in range(2)]}
+        if number + 1 < self.pages:
+            bundle["link"] = [{"relation": "self", "url": url},
+                              {"relation": "next", "url": self.base_uri + "Patient?page={}".format(number + 1)}]
+        return bundle
+
+    def request_json(self, url):
+        return self.page(url)
+
+
+class AsyncPagingServer(PagingServer):
+
+    async def request_json(self, url):
+        await asyncio.sleep(0)
+        return self.page(url)
+
+
+class TestIterSearch(unittest.TestCase):
+
+    def test_iter_search(self):
+        """Confirm all pages are followed, with or without prefetching"""
+        for prefetch in (0, 1, 3):
+            server = PagingServer()
+            patients = list(iter_search(server, "Patient?gender=male", prefetch=prefetch))
+            self.assertEqual([p.id for p in patients], ["p{}".format(i) for i in range(10)])
+            self.assertIsInstance(patients[0], Patient)
+            self.assertIs(patients[0].server, server)
+            self.assertEqual(len(server.requests), 5)
+
+    def test_iter_search_stop(self):
+        """Confirm no further pages are requested once iteration stops"""
+        server = PagingServer(pages=100)
+        results = iter_search(server, "Patient", prefetch=2)
+        self.assertEqual(next(results).id, "p0")
+        results.close()
+        self.assertLessEqual(len(server.requests), 5)
+
+        # the fetching threads of abandoned iterations finish
+        threads = threading.active_count()
+        for _ in range(5):
+            results = iter_search(PagingServer(pages=100), "Patient", prefetch=1)
+            next(results)
+            results.close()
+        deadline = time.monotonic() + 5
+        while threading.active_count() > threads and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self.assertLessEqual(threading.active_count(), threads)
+
+    def test_aiter_search(self):
+        """Confirm the asynchronous search iterator"""
+        async def run(server, prefetch, limit=None):
+            ids = []
+            async for patient in aiter_search(server, "Patient", prefetch=prefetch):
+                ids.append(patient.id)
+                if limit is not None and len(ids) >= limit:
+                    break
+            return ids
+
+        for prefetch in (0, 2):
+            self.assertEqual(asyncio.run(run(AsyncPagingServer(), prefetch)), ["p{}".format(i) for i in range(10)])
+        server = AsyncPagingServer(pages=100)
+        self.assertEqual(asyncio.run(run(server, 2, limit=3)), ["p0", "p1", "p2"])
+        self.assertLessEqual(len(server.requests), 6)
@@ -0,0 +1,68 @@
+import datetime
+import unittest
+
+from models.fhircolumns import FHIRColumnExtractor, extract_columns
+from models.observation import Observation
+from models.patient import Patient
+
+
+OBSERVATIONS = [
+    {"resourceType": "Observation", "status": "final", "effectiveDateTime": "2024-01-02",
+     "code": {"coding": [{"system": "http://loinc.org", "code": "8867-4"}, {"code": "HR"}]},
+     "valueQuantity": {"value": 72, "unit": "/min"}},
+    {"resourceType": "Observation", "status": "amended", "code": {"text": "X"}, "valueBoolean": True},
+    {"resourceType": "Observation", "status": "final", "effectiveDateTime": "2024-03",
+     "code": {"coding": [{"code": "8310-5"}]}, "valueQuantity": {"value": 36.6}},
+]
+
+PATHS = ["status", "Observation.code.coding.code", "code.coding[1].code", "valueQuantity.value",
+         "valueBoolean", "effectiveDateTime"]
+
+
+class TestFHIRColumns(unittest.TestCase):
+
+    def check_columns(self, columns):
+        self.assertEqual(list(columns), PATHS)
+        self.assertEqual(columns["status"].values, ["final", "amended", "final"])
+        self.assertEqual(columns["Observation.code.coding.code"], (["8867-4", None, "8310-5"], [True, False, True]))
+        self.assertEqual(columns["code.coding[1].code"].values, ["HR", None, None])
+        self.assertEqual(columns["valueQuantity.value"], ([72, None, 36.6], [True, False, True]))
+        self.assertEqual(columns["valueBoolean"].values, [None, True, None])
+        self.assertEqual(columns["effectiveDateTime"],
+                         ([datetime.datetime(2024, 1, 2), None, datetime.datetime(2024, 3, 1)], [True, False, True]))
+
+    def test_extract(self):
+        """Confirm columns are the same for JSON dictionaries and instances"""
+        extractor = FHIRColumnExtractor(Observation, PATHS)
+        self.check_columns(extractor.extract(OBSERVATIONS))
+        self.check_columns(extractor.extract(Observation(js) for js in OBSERVATIONS))
+        self.check_columns(extract_columns(Observation, PATHS, Observation.with_json(OBSERVATIONS, lazy=True)))
+
+        # JSON values of the wrong type are missing
+        columns = extract_columns(Observation, ["status", "valueQuantity.value"],
+                                  [{"status": 1, "valueQuantity": {"value": "72"}}, {"valueQuantity": []}])
+        self.assertEqual(columns["status"].mask, [False, False])
+        self.assertEqual(columns["valueQuantity.value"].mask, [False, False])
+
+        for path in ("bogus", "code.bogus", "code", "status.value", "code.coding.[0]"):
+            with self.assertRaises(ValueError):
+                FHIRColumnExtractor(Observation, [path])
+        columns = extract_columns(Patient, ["Patient.name.given"], [{"name": [{"given": ["A", "B"]}]}])
+        self.assertEqual(columns["Patient.name.given"].values, ["A"])
+
+    def test_extract_numpy(self):
+        """Confirm columns as NumPy arrays"""
+        try:
+            import numpy
+        except ImportError:
+            self.skipTest("NumPy is not installed")
+
+        columns = extract_columns(Observation, PATHS, OBSERVATIONS, as_numpy=True)
+        values, mask = columns["valueQuantity.value"]
+        self.assertEqual(values.dtype, numpy.dtype("float64"))
+        self.assertEqual(mask.tolist(), [True, False, True])
+        self.assertEqual(values[mask].tolist(), [72.0, 36.6])
+        self.assertEqual(columns["valueBoolean"].values.tolist(), [False, True, False])
+        self.assertEqual(columns["status"].values.dtype, numpy.dtype(object))
+        self.assertEqual(columns["effectiveDateTime"].values[0], numpy.datetime64("2024-01-02T00:00:00"))
+        self.assertTrue(numpy.isnat(columns["effectiveDateTime"].values[1]))
@@ -1,4 +1,5 @@
 import datetime
+import pickle
 import unittest
 
 from models.fhirabstractbase import FHIRValidationError
@@ -202,3 +203,77 @@ class TestFHIRDate(unittest.TestCase):
         self.assertRaises(ValueError, FHIRTime, "2015")
         self.assertRaises(ValueError, FHIRTime, "2015-02-07T13:28:17Z")
         self.assertRaises(ValueError, FHIRTime, "10:12")
+
+    def test_lazy_parsing(self):
+        """Confirm lazy parsing defers work to first access, still validating the format"""
+        FHIRDateTime.lazy_parsing = True
+        try:
+            date = FHIRDateTime("2024-01-02T10:00:00Z")
+            self.assertEqual(date.as_json(), "2024-01-02T10:00:00Z")
+            self.assertEqual(date.datetime, datetime.datetime(2024, 1, 2, 10, tzinfo=datetime.timezone.utc))
+            self.assertEqual(date.as_json(), "2024-01-02T10:00:00Z")
+            self.assertRaises(ValueError, FHIRDateTime, "2024-01-02T10:00:00")
+
+            # out-of-range values only raise when parsed
+            date = FHIRDateTime("2023-02-31")
+            self.assertEqual(date.as_json(), "2023-02-31")
+            with self.assertRaises(ValueError):
+                date.datetime
+
+            # unparsed values survive pickling
+            date = pickle.loads(pickle.dumps(FHIRDateTime("2024-05")))
+            self.assertEqual(date.as_json(), "2024-05")
+            self.assertEqual(date.isostring, "2024-05-01T00:00:00")
+        finally:
+            FHIRDateTime.lazy_parsing = False
+
+    def test_compact(self):
+        """Confirm values are slotted, other attributes and earlier pickles still work"""
+        date = FHIRDate("2024")
+        self.assertEqual(date.__dict__, {})
+        date.date = datetime.date(2023, 4, 5)
+        self.assertEqual(date.as_json(), "2023-04-05")
+        date.note = "extra"
+
+        for date in (FHIRDate("2024-02"), FHIRTime("10:11:12"), FHIRDate(), date):
+            copy = pickle.loads(pickle.dumps(date))
+            self.assertEqual((copy.isostring, copy.as_json()), (date.isostring, date.as_json()))
+        self.assertEqual(copy.note, "extra")
+
+        # pickled before values moved to slots
+        old = pickle.loads(b'\x80\x02cmodels.fhirdatetime\nFHIRDateTime\nq\x00)\x81q\x01}q\x02(X\n\x00\x00\x00_orig_jsonq'
+                           b'\x03X\x14\x00\x00\x002024-01-02T10:00:00Zq\x04X\x08\x00\x00\x00datetimeq\x05cdatetime\ndatetime'
+                           b'\nq\x06c_codecs\nencode\nq\x07X\x0b\x00\x00\x00\x07\xc3\xa8\x01\x02\n\x00\x00\x00\x00\x00q'
+                           b'\x08X\x06\x00\x00\x00latin1q\t\x86q\nRq\x0bcdatetime\ntimezone\nq\x0ccdatetime\ntimedelta'
+                           b'\nq\rK\x00K\x00K\x00\x87q\x0eRq\x0f\x85q\x10Rq\x11\x86q\x12Rq\x13ub.')
+        self.assertEqual(old.as_json(), "2024-01-02T10:00:00Z")
+        self.assertEqual(old.datetime, datetime.datetime(2024, 1, 2, 10, tzinfo=datetime.timezone.utc))
+        self.assertEqual(old.__dict__, {})
+
+    def test_parse_many(self):
+        """Confirm batch parsing gives the same values as instances, with a validity mask"""
+        values = ["2024", "2024-01-02T10:00:60Z", None, "2023-02-31", "bogus", 2024, "2024-01-02T10:00:60Z", "2024-03-04T05:06:07-05:00"]
+        parsed, valid = FHIRDateTime.parse_many(values)
+        self.assertEqual(valid, [True, True, False, False, False, False, True, True])
+        self.assertEqual(parsed[0], FHIRDateTime("2024").datetime)
+        self.assertEqual(parsed[1], FHIRDateTime("2024-01-02T10:00:60Z").datetime)
+        self.assertIsNone(parsed[3])
+        self.assertEqual(FHIRInstant.parse_many(["2024"])[1], [False])
+        self.assertEqual(FHIRTime.parse_many(iter(["10:11:12"])), ([datetime.time(10, 11, 12)], [True]))
+
+    def test_parse_many_numpy(self):
+        """Confirm batch parsing into NumPy arrays"""
+        try:
+            import numpy
+        except ImportError:
+            self.skipTest("NumPy is not installed")
+
+        parsed, valid = FHIRDateTime.parse_many(["2024-01-02T10:00:00+02:00", "2024-05", "bogus"], as_numpy=True)
+        self.assertEqual(parsed.dtype, numpy.dtype("datetime64[us]"))
+        self.assertEqual(parsed[0], numpy.datetime64("2024-01-02T08:00:00"))
+        self.assertEqual(parsed[1], numpy.datetime64("2024-05-01T00:00:00"))
+        self.assertTrue(numpy.isnat(parsed[2]))
+        self.assertEqual(valid.tolist(), [True, True, False])
+
+        self.assertEqual(FHIRDate.parse_many(["1970-01-02"], as_numpy=True)[0][0], numpy.datetime64("1970-01-02"))
+        self.assertEqual(FHIRTime.parse_many(["00:01:00.5"], as_numpy=True)[0][0], numpy.timedelta64(60500000, "us"))
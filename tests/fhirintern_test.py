@@ -0,0 +1,137 @@
+import gc
+import json
+import pickle
+import unittest
+import weakref
+
+from models.bundle import Bundle
+from models.codeableconcept import CodeableConcept
+from models.coding import Coding
+from models.fhirdatetime import FHIRDateTime
+from models.fhirintern import FHIRInternTable, interning, unshared
+from models.observation import Observation
+from models.quantity import Quantity
+
+
+def observation(i):
+    return {"resourceType": "Observation", "status": "final", "effectiveDateTime": "2024-01-02T10:00:00Z",
+            "code": {"coding": [{"system": "http://loinc.org", "code": "8867-4"}]},
+            "valueQuantity": {"value": i, "unit": "/min"}}
+
+
+class TestFHIRIntern(unittest.TestCase):
+
+    def test_interning(self):
+        """Confirm repeated strings and parsed dates are shared while a table is installed"""
+        # decoded JSON has a copy of each string per occurrence
+        js = json.loads(json.dumps({"resourceType": "Bundle", "type": "collection",
+                                    "entry": [{"resource": observation(i)} for i in range(3)]}))
+        with interning() as table:
+            for trusted in (False, True):
+                obs = [entry.resource for entry in Bundle(js, trusted=trusted).entry]
+                self.assertIs(obs[0].code.coding[0].system, obs[2].code.coding[0].system)
+                self.assertIs(obs[0].valueQuantity.unit, obs[1].valueQuantity.unit)
+                self.assertIsNot(obs[0].effectiveDateTime, obs[1].effectiveDateTime)
+                self.assertIs(obs[0].effectiveDateTime.datetime, obs[1].effectiveDateTime.datetime)
+                self.assertEqual([o.as_json() for o in obs], [observation(i) for i in range(3)])
+
+        self.assertGreater(table.hits, table.misses)
+        self.assertGreater(table.bytes_saved, 0)
+        self.assertAlmostEqual(table.hit_rate, table.hits / (table.hits + table.misses))
+
+        # instances can still be changed independently, and nothing is shared without a table
+        obs[0].effectiveDateTime.datetime = None
+        self.assertIsNotNone(obs[1].effectiveDateTime.datetime)
+        self.assertIsNone(Observation.intern_table)
+        self.assertIsNone(FHIRDateTime.intern_table)
+        obs = Bundle(js).entry
+        self.assertIsNot(obs[0].resource.code.coding[0].system, obs[1].resource.code.coding[0].system)
+
+    def test_table(self):
+        """Confirm the table is bounded, dropping values that were not used recently"""
+        table = FHIRInternTable(maxsize=4)
+        a = table.intern("".join(["a", "b"]))
+        table.intern("cd")
+        self.assertIs(table.intern("".join(["a", "b"])), a)
+        table.intern("ef")
+        table.intern("gh")
+        self.assertEqual(len(table), 3)
+        self.assertIs(table.intern("".join(["a", "b"])), a)
+        self.assertIsNot(table.intern("".join(["c", "d"])), "cd")
+        self.assertEqual((table.hits, table.misses), (2, 5))
+
+        self.assertIs(table.parsed(FHIRDateTime, "2024"), table.parsed(FHIRDateTime, "2024"))
+        with self.assertRaises(ValueError):
+            table.parsed(FHIRDateTime, "2023-02-31")
+        table.clear()
+        self.assertEqual((len(table), table.hits, table.misses, table.hit_rate), (0, 0, 0, 0.0))
+
+    def test_sharing(self):
+        """Confirm equal elements of the selected classes are shared and copied before changes"""
+        js = json.loads(json.dumps([observation(i % 2) for i in range(4)]))
+        table = FHIRInternTable(shared_types=[Coding, CodeableConcept, Quantity])
+        with interning(table):
+            obs = Observation.with_json(js)
+            trusted = Observation.with_json(js, trusted=True)
+
+        # elements are shared from their second occurrence, parents of shared children from their third
+        self.assertIs(obs[2].valueQuantity, trusted[0].valueQuantity)
+        self.assertIsNot(obs[0].valueQuantity, obs[2].valueQuantity)
+        self.assertIs(obs[1].code.coding[0], obs[2].code.coding[0])
+        self.assertIsNot(obs[0].code.coding[0], obs[1].code.coding[0])
+        self.assertIsNot(obs[1].code, obs[2].code)
+        self.assertIs(obs[2].code, obs[3].code)
+        self.assertIs(obs[2].code, trusted[0].code)
+        self.assertIsInstance(obs[2].code, CodeableConcept)
+        self.assertIsNone(obs[2].code._owner)
+        self.assertEqual([o.as_json() for o in obs], [observation(i % 2) for i in range(4)])
+
+        # shared elements are read-only, copies and elements seen once can be changed, pickled ones aren't shared
+        with self.assertRaisesRegex(AttributeError, "read-only"):
+            obs[2].code.text = "Changed"
+        obs[1].code.text = "Changed"
+        obs[2].code = unshared(obs[2].code)
+        obs[2].code.text = "Changed"
+        self.assertIsNone(obs[3].code.text)
+        self.assertIs(obs[2].code.coding[0], obs[3].code.coding[0])
+        self.assertIs(unshared(obs[2].code), obs[2].code)
+        copy = pickle.loads(pickle.dumps(obs[3]))
+        copy.code.text = "Changed"
+        self.assertEqual(copy.valueQuantity.as_json(), obs[3].valueQuantity.as_json())
+
+        # values of different types are not confused
+        with interning(table):
+            self.assertEqual([type(q.value) for q in Quantity.with_json([{"value": 1}, {"value": 1.0}])], [int, float])
+
+    def test_sharing_memory(self):
+        """Confirm the table doesn't keep resources with elements seen once alive"""
+        table = FHIRInternTable(shared_types=[Coding, CodeableConcept, Quantity])
+        refs = []
+        with interning(table):
+            for i in range(100):
+                obs = Observation(observation(i))
+                refs.append(weakref.ref(obs))
+            del obs
+        gc.collect()
+        self.assertEqual([ref() for ref in refs], [None] * 100)
+        self.assertGreater(table.hits, 0)
+
+    def test_sharing_changes(self):
+        """Confirm elements seen once stay changeable, and parents of unshared children aren't shared"""
+        def quantity():
+            return Observation({"status": "final", "code": {"text": "X"}, "valueQuantity": {"value": 1, "unit": "mg"}}).valueQuantity
+
+        with interning(FHIRInternTable(shared_types=[Quantity])):
+            first = quantity()
+            first.unit = "g"
+            second = quantity()
+            self.assertIsNot(second, first)
+            first.unit = "kg"
+            self.assertIs(quantity(), second)
+            self.assertEqual(first.unit, "kg")
+
+        with interning(FHIRInternTable(shared_types=[CodeableConcept])):
+            codes = [Observation({"status": "final", "code": {"coding": [{"code": "x"}]}}).code for _ in range(3)]
+        self.assertEqual(len({id(code) for code in codes}), 3)
+        for code in codes:
+            code.text = "Changed"
@@ -0,0 +1,183 @@
+import asyncio
+import unittest
+
+from models.bundle import Bundle, BundleEntry
+from models.fhirreference import aprefetch_references, aresolve_all, prefetch_references
+from models.observation import Observation
+from models.patient import Patient
+from models.practitioner import Practitioner
+
+
+class MockServer(object):
+
+    base_uri = "https://example.org/fhir/"
+
+    def __init__(self, resources):
+        self.resources = resources
+        self.requests = []
+
+    def request_json(self, path):
+        self.requests.append(path)
+        if "?_id=" in path:
+            res_type, _, ids = path.partition("?_id=")
+            ids = ids.split("&")[0].split(",")
+            return {"resourceType": "Bundle", "type": "searchset", "entry": [
+                {"resource": self.resources["{}/{}".format(res_type, res_id)]} for res_id in ids
+                if "{}/{}".format(res_type, res_id) in self.resources]}
+        return self.resources[path]
+
+
+class AsyncMockServer(MockServer):
+
+    def __init__(self, resources):
+        super().__init__(resources)
+        self.active = 0
+        self.max_active = 0
+
+    async def request_json(self, path):
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        await asyncio.sleep(0.001)
+        self.active -= 1
+        return super().request_json(path)
+
+
+class TestFHIRReference(unittest.TestCase):
+
+    def bundle(self):
+        return Bundle({"resourceType": "Bundle", "type": "collection", "entry": [
+            {"fullUrl": "urn:uuid:p1", "resource": {"resourceType": "Patient", "id": "p1"}},
+            {"fullUrl": "urn:uuid:o1", "resource": {
+                "resourceType": "Observation", "status": "final", "code": {"text": "X"},
+                "subject": {"reference": "urn:uuid:p1"}, "performer": [{"reference": "#pr1"}],
+                "contained": [{"resourceType": "Patient", "id": "pr1"}]}},
+        ]})
+
+    def test_resolve_local(self):
+        """Confirm contained resources and Bundle entries are resolved and indexes follow changes"""
+        bundle = self.bundle()
+        obs = bundle.entry[1].resource
+        self.assertIs(obs.subject.resolved(Patient), bundle.entry[0].resource)
+        self.assertIs(obs.performer[0].resolved(Patient), obs.contained[0])
+        self.assertIsNone(obs.subject.resolved(Observation))
+
+        # replaced and added items are found
+        replacement = BundleEntry({"fullUrl": "urn:uuid:p1", "resource": {"resourceType": "Patient", "id": "p1b"}})
+        bundle.entry[0] = replacement
+        self.assertIs(obs.subject.resolved(Patient), replacement.resource)
+        obs.contained.append(Patient({"id": "pr2"}))
+        obs.performer[0].reference = "#pr2"
+        self.assertIs(obs.performer[0].resolved(Patient), obs.contained[1])
+
+        # as are items whose key was changed at an indexed position
+        obs.contained[0].id = "pr3"
+        obs.performer[0].reference = "#pr1"
+        self.assertIsNone(obs.performer[0].resolved(Patient))
+        obs.contained = [Patient({"id": "pr1"})]
+        self.assertIs(obs.performer[0].resolved(Patient), obs.contained[0])
+
+        # items renamed or replaced in place, keeping the list's length, are found too
+        obs.contained.append(Patient({"id": "pr4"}))
+        obs.performer[0].reference = "#pr4"
+        self.assertIs(obs.performer[0].resolved(Patient), obs.contained[1])
+        obs.contained[0].id = "pr5"
+        obs.performer[0].reference = "#pr5"
+        self.assertIs(obs.performer[0].resolved(Patient), obs.contained[0])
+        obs.contained[1] = Patient({"id": "pr6"})
+        obs.performer[0].reference = "#pr6"
+        self.assertIs(obs.performer[0].resolved(Patient), obs.contained[1])
+
+    def test_index_misses(self):
+        """Confirm repeated misses don't rebuild indexes unless an item's key changed"""
+        bundle = self.bundle()
+        obs = bundle.entry[1].resource
+        obs.subject.reference = "urn:uuid:missing"
+        self.assertIsNone(obs.subject.resolved(Patient))
+        index = bundle._entry_index
+        for _ in range(3):
+            self.assertIsNone(obs.subject.resolved(Patient))
+        self.assertIs(bundle._entry_index, index)
+
+        # until an entry's fullUrl changes
+        bundle.entry[0].fullUrl = "urn:uuid:missing"
+        self.assertIs(obs.subject.resolved(Patient), bundle.entry[0].resource)
+        self.assertIsNot(bundle._entry_index, index)
+
+        # lazy instances creating their keys don't change them
+        lazy = Bundle.with_json(self.bundle().as_json(), lazy=True)
+        obs = lazy.entry[1].resource
+        self.assertIsNone(obs.performer[0].resolved(Practitioner))
+        obs.subject.reference = "urn:uuid:missing"
+        self.assertIsNone(obs.subject.resolved(Patient))
+        index = lazy._entry_index
+        self.assertIsNone(obs.subject.resolved(Patient))
+        self.assertIs(lazy._entry_index, index)
+
+    def test_resolve_remote(self):
+        """Confirm fetched resources are cached"""
+        server = MockServer({
+            "Observation/o1": {"resourceType": "Observation", "id": "o1", "status": "final", "code": {"text": "X"},
+                               "subject": {"reference": "Patient/p1"}},
+            "Patient/p1": {"resourceType": "Patient", "id": "p1"},
+        })
+        obs = Observation.read_from("Observation/o1", server)
+
+        patient = obs.subject.resolved(Patient)
+        self.assertEqual(patient.id, "p1")
+        self.assertIs(obs.subject.resolved(Patient), patient)
+        self.assertEqual(server.requests, ["Observation/o1", "Patient/p1"])
+        self.assertIs(obs.resolvedReference("Patient/p1"), patient)
+
+    def test_resolve_async(self):
+        """Confirm references are resolved concurrently, fetching each resource once"""
+        resources = {"Patient/p{}".format(i): {"resourceType": "Patient", "id": "p{}".format(i)} for i in range(10)}
+        server = AsyncMockServer(resources)
+        observations = []
+        for i in range(30):
+            obs = Observation({"status": "final", "code": {"text": "X"}, "subject": {"reference": "Patient/p{}".format(i % 10)}})
+            obs._server = server
+            observations.append(obs)
+
+        patients = asyncio.run(aresolve_all([obs.subject for obs in observations], Patient, limit=3))
+        self.assertEqual([p.id for p in patients], ["p{}".format(i % 10) for i in range(30)])
+        self.assertEqual(sorted(server.requests), sorted(resources))
+        self.assertEqual(server.max_active, 3)
+        self.assertIs(observations[0].resolvedReference("Patient/p0"), patients[0])
+
+        # resolved references are cached, local ones don't need a server
+        self.assertIs(asyncio.run(observations[0].subject.aresolved(Patient)), patients[0])
+        bundle = self.bundle()
+        self.assertIs(asyncio.run(bundle.entry[1].resource.subject.aresolved(Patient)), bundle.entry[0].resource)
+        self.assertEqual(len(server.requests), 10)
+
+    def prefetch_bundle(self):
+        entries = [{"fullUrl": "urn:uuid:p0", "resource": {"resourceType": "Patient", "id": "p0"}}]
+        for i in range(6):
+            entries.append({"resource": {"resourceType": "Observation", "status": "final", "code": {"text": "X"},
+                                         "subject": {"reference": "urn:uuid:p0" if i == 0 else "Patient/p{}".format(i % 3 + 1)},
+                                         "performer": [{"reference": "Practitioner/d1"}, {"reference": "Practitioner/gone"}]}})
+        return Bundle({"resourceType": "Bundle", "type": "collection", "entry": entries})
+
+    def check_prefetched(self, bundle, fetched, server):
+        self.assertEqual(sorted(fetched), ["Patient/p1", "Patient/p2", "Patient/p3", "Practitioner/d1"])
+        self.assertEqual(sorted(server.requests), ["Patient?_id=p1&_count=1", "Patient?_id=p2,p3&_count=2",
+                                                   "Practitioner?_id=d1,gone&_count=2"])
+        requests = len(server.requests)
+        obs = bundle.entry[2].resource
+        self.assertIs(obs.subject.resolved(Patient), fetched["Patient/p2"])
+        self.assertEqual(obs.performer[0].resolved(Practitioner).id, "d1")
+        self.assertEqual(len(server.requests), requests)
+
+    def test_prefetch(self):
+        """Confirm unresolved references are fetched in batches and cached"""
+        resources = {"Patient/p{}".format(i): {"resourceType": "Patient", "id": "p{}".format(i)} for i in range(4)}
+        resources["Practitioner/d1"] = {"resourceType": "Practitioner", "id": "d1"}
+
+        server = MockServer(resources)
+        bundle = self.prefetch_bundle()
+        self.check_prefetched(bundle, prefetch_references(bundle, server, batch_size=2), server)
+        self.assertEqual(prefetch_references(bundle, server), {})
+
+        server = AsyncMockServer(resources)
+        bundle = self.prefetch_bundle()
+        self.check_prefetched(bundle, asyncio.run(aprefetch_references(bundle, server, batch_size=2)), server)
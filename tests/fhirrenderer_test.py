@@ -0,0 +1,59 @@
+import os
+import sys
+import types
+import unittest
+
+from jinja2 import Environment, FileSystemLoader
+
+ROOT = os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir)
+sys.path.insert(0, ROOT)
+from fhirrenderer import do_wordwrap
+
+
+def prop(name, class_name, is_array=False, module_name=None):
+    return types.SimpleNamespace(name=name, orig_name=name, class_name=class_name, module_name=module_name,
+                                 is_array=is_array, one_of_many=None, nonoptional=False, short="The " + name,
+                                 reference_to_names=[], json_class="dict" if module_name else class_name)
+
+
+def render_module(compact_instances):
+    """Renders the resource template for two classes and imports the result into the models package"""
+    env = Environment(loader=FileSystemLoader(os.path.join(ROOT, "Sample")))
+    env.filters["wordwrap"] = do_wordwrap
+    base = types.SimpleNamespace(name="FHIRAbstractBase", module="fhirabstractbase")
+    coding = types.SimpleNamespace(name="Coding", module="coding")
+    thing = types.SimpleNamespace(name="Thing", module="thing", superclass=base, resource_type=None,
+                                  short="A thing", formal=None,
+                                  properties=[prop("active", "bool"), prop("code", "Coding", module_name="coding"),
+                                              prop("item", "str", is_array=True)])
+    empty = types.SimpleNamespace(name="EmptyThing", module="thing", superclass=base, resource_type=None,
+                                  short="An empty thing", formal=None, properties=[])
+    source = env.get_template("template-resource.py").render(
+        profile=types.SimpleNamespace(url="http://example.org"), imports=[base, coding], classes=[thing, empty],
+        info=types.SimpleNamespace(version="4.0.1", date="2024-01-01", year="2024"),
+        compact_instances=compact_instances)
+
+    module = types.ModuleType("models.thing")
+    module.__package__ = "models"
+    exec(compile(source, "thing.py", "exec"), module.__dict__)
+    return module
+
+
+class TestFHIRRenderer(unittest.TestCase):
+
+    def test_compact_instances(self):
+        """Confirm classes rendered with `compact_instances` declare their properties as slots"""
+        module = render_module(compact_instances=True)
+        self.assertEqual(module.Thing.__slots__, ("active", "code", "item"))
+        self.assertEqual(module.EmptyThing.__slots__, ())
+
+        js = {"active": True, "code": {"code": "x"}, "item": ["a", "b"]}
+        thing = module.Thing(js)
+        self.assertEqual(thing.__dict__, {})
+        self.assertIs(thing.code._owner, thing)
+        self.assertEqual(thing.as_json(), js)
+        self.assertEqual(module.EmptyThing({}).as_json(), {})
+
+        module = render_module(compact_instances=False)
+        self.assertNotIn("__slots__", module.Thing.__dict__)
+        self.assertEqual(module.Thing(js).as_json(), js)
@@ -0,0 +1,118 @@
+import copy
+import io
+import json
+import pickle
+import unittest
+
+from models.codeableconcept import CodeableConcept
+from models.coding import Coding
+from models.fhirabstractbase import FHIRValidationError
+from models.fhirtracking import mark_changed, track_changes
+from models.observation import Observation
+from models.patient import Patient
+
+
+OBSERVATION = {
+    "resourceType": "Observation", "id": "o1", "status": "final",
+    "code": {"coding": [{"system": "http://loinc.org", "code": "8867-4"}], "text": "Heart rate"},
+    "valueQuantity": {"value": 72, "unit": "/min"},
+}
+
+
+class TestFHIRTracking(unittest.TestCase):
+
+    def test_tracking(self):
+        """Confirm cached JSON is reused until a property of the element or a child element is set"""
+        obs = track_changes(Observation(OBSERVATION))
+        self.assertIsInstance(obs, Observation)
+        self.assertIsInstance(obs.code.coding[0], Coding)
+        self.assertEqual(type(obs).__name__, "Observation")
+        js = obs.as_json()
+        self.assertEqual(js, OBSERVATION)
+        self.assertIsNotNone(obs.code._json_cache)
+
+        # only the outermost element keeps its whole JSON, others refer to their children
+        self.assertIsNotNone(obs._json_cache[2])
+        self.assertIsNone(obs.code._json_cache[2])
+        self.assertIs(obs._json_cache[0]["code"], obs.code)
+        self.assertEqual(obs.code._json_cache[0]["coding"], tuple(obs.code.coding))
+        code_js = obs.code.as_json()
+        code_js["coding"][0]["code"] = "Changed"
+        self.assertEqual(obs.code.as_json(), OBSERVATION["code"])
+
+        # returned JSON is a copy
+        js["code"]["text"] = "Changed"
+        self.assertEqual(obs.as_json(), OBSERVATION)
+        self.assertIsNot(obs.as_json()["code"], obs.as_json()["code"])
+
+        obs.code.coding[0].code = "8310-5"
+        self.assertIsNone(obs._json_cache)
+        self.assertIsNotNone(obs.valueQuantity._json_cache)
+        self.assertEqual(obs.as_json()["code"]["coding"][0]["code"], "8310-5")
+
+        # assigned elements are tracked and owned
+        obs.code = CodeableConcept({"text": "New"})
+        self.assertIs(obs.code._owner, obs)
+        self.assertEqual(obs.as_json()["code"], {"text": "New"})
+        obs.code.text = "Newer"
+        self.assertEqual(obs.as_json()["code"], {"text": "Newer"})
+
+        # changes in place need to be marked
+        obs.code.coding = []
+        obs.as_json()
+        obs.code.coding.append(Coding({"code": "X"}))
+        self.assertNotIn("coding", obs.as_json()["code"])
+        mark_changed(obs.code)
+        self.assertEqual(obs.as_json()["code"]["coding"], [{"code": "X"}])
+
+        out = io.StringIO()
+        obs.write_json(out)
+        self.assertEqual(json.loads(out.getvalue()), obs.as_json())
+
+    def test_returned_json(self):
+        """Confirm changing returned JSON doesn't change the JSON cached by any element"""
+        patient_json = {"resourceType": "Patient", "id": "p1", "name": [{"family": "Doe", "given": ["John"]}]}
+        patient = track_changes(Patient(patient_json))
+        patient.as_json()["name"][0]["given"].append("Injected")
+        patient.name[0].as_json()["given"].append("Injected")
+        self.assertEqual(patient.as_json(), patient_json)
+
+        # serialized again from the cached members of child elements
+        patient.active = False
+        self.assertEqual(patient.as_json()["name"], patient_json["name"])
+        self.assertEqual(patient.name[0].given, ["John"])
+
+    def test_lazy(self):
+        """Confirm reading properties of lazy instances keeps the cached JSON"""
+        obs = track_changes(Observation.with_json(OBSERVATION, lazy=True))
+        self.assertEqual(obs.as_json(), OBSERVATION)
+        cache = obs._json_cache
+        self.assertEqual(obs.code.coding[0].code, "8867-4")
+        self.assertIs(obs._json_cache, cache)
+        self.assertIs(obs.code._owner, obs)
+        self.assertEqual(obs.as_json(), OBSERVATION)
+
+        # materialized elements are tracked
+        obs.code.coding[0].code = "8310-5"
+        self.assertIsNone(obs._json_cache)
+        self.assertEqual(obs.as_json()["code"]["coding"][0]["code"], "8310-5")
+
+    def test_validation(self):
+        """Confirm JSON cached without checks isn't returned by checked serialization"""
+        obs = track_changes(Observation(OBSERVATION))
+        obs.status = None
+        self.assertNotIn("status", obs.as_json(trusted=True))
+        with self.assertRaises(FHIRValidationError):
+            obs.as_json()
+        obs.status = "final"
+        self.assertEqual(obs.as_json(), OBSERVATION)
+        self.assertEqual(obs.as_json(trusted=True), OBSERVATION)
+
+    def test_copies(self):
+        """Confirm copies aren't tracked"""
+        obs = track_changes(Observation(OBSERVATION, trusted=True))
+        obs.as_json()
+        for duplicate in (copy.copy(obs), copy.deepcopy(obs), pickle.loads(pickle.dumps(obs))):
+            self.assertIs(type(duplicate), Observation)
+            self.assertEqual(duplicate.as_json(), OBSERVATION)
+        self.assertIs(type(pickle.loads(pickle.dumps(obs.code)).coding[0]), Coding)